@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, List
+import aiohttp
+from checksum import ChecksumMismatch, StreamHasher
+from scheduler import OriginLimiter
+from disk_ledger import DiskReservation
+from retry import is_transient_status
+from model import DANEResponse, DownloadMetadata, DownloadProgress, DownloadResult
+from http_util import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT,
+    get_http_session,
+    to_output_filename,
+    url_to_safe_filename,
+)
+from download_cache import find_downloaded_file
+from content_sniff import ContentSniffer
+from disk_io import WriteOptions
+from metrics import BLOCKED_SECONDS
+from http_download import (
+    COPY_BUFFER_SIZE,
+    PART_SUFFIX,
+    PROGRESS_SUFFIX,
+    ProgressTracker,
+    describe_source,
+    new_progress,
+    publish_part_file,
+    remove_part_file,
+    status_to_dane_response,
+    verify_part_file,
+)
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAX_CONNECTIONS = 100  # open connections of the engine, over all hosts
+DEFAULT_IO_THREADS = 4
+
+
+class AsyncHttpEngine:
+    """Runs HTTP downloads as coroutines on one event loop (in its own thread),
+    so many small downloads share the loop and its keep-alive connections,
+    instead of each blocking a thread for its round trips. Writing, hashing
+    and the chunk callbacks are offloaded to a few I/O threads, downloads are
+    throttled on the loop (so a limited origin does not hold up the writes of
+    the others). Downloads use a single stream and are not resumed,
+    the engine is meant for batches of small files"""
+
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        io_threads: int = DEFAULT_IO_THREADS,
+        write_options: WriteOptions | None = None,  # only its fsync applies
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+    ):
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_options = write_options or WriteOptions()
+        self._io = ThreadPoolExecutor(io_threads, thread_name_prefix="async-http-io")
+        self._session: aiohttp.ClientSession | None = None  # created on the loop
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="async-http", daemon=True
+        )
+        self._thread.start()
+
+    # blocking version of download_async, for the task threads of the worker
+    def download(
+        self,
+        target_url: str,
+        download_dir: str,
+        revalidate: bool = False,
+        checksums: List[str] | None = None,
+        limiter: OriginLimiter | None = None,
+        progress_callback: Callable[[int], None] | None = None,
+        reservation: DiskReservation | None = None,
+    ) -> DownloadResult:
+        limiter = limiter or OriginLimiter()
+        with limiter.connections(1):  # waits in the task thread, not on the loop
+            return asyncio.run_coroutine_threadsafe(
+                self.download_async(
+                    target_url,
+                    download_dir,
+                    revalidate,
+                    checksums,
+                    limiter,
+                    progress_callback,
+                    reservation,
+                ),
+                self._loop,
+            ).result()
+
+    async def download_async(
+        self,
+        target_url: str,
+        download_dir: str,
+        revalidate: bool = False,
+        checksums: List[str] | None = None,
+        limiter: OriginLimiter | None = None,
+        progress_callback: Callable[[int], None] | None = None,
+        reservation: DiskReservation | None = None,
+    ) -> DownloadResult:
+        session = await self._get_session()
+
+        # without extension in the URL, it is determined from the GET response
+        safe_filename = url_to_safe_filename(target_url)
+        download_file_path = os.path.join(download_dir, safe_filename)
+
+        cached_result = await self._find_valid_download(
+            session, target_url, download_file_path, revalidate
+        )
+        if cached_result:
+            return cached_result
+
+        callbacks: List[Callable[[int], None]] = []
+        if progress_callback is not None:
+            callbacks.append(progress_callback)
+        part_file_path = f"{download_file_path}{PART_SUFFIX}"
+        progress_file_path = f"{part_file_path}{PROGRESS_SUFFIX}"
+        hasher = StreamHasher(checksums) if checksums else None
+        sniffer = ContentSniffer()
+        try:
+            async with session.get(target_url) as response:
+                if response.status >= 400:
+                    return DownloadResult(
+                        download_file_path,
+                        status_to_dane_response(response.status, response.reason or ""),
+                        False,
+                        {},
+                        is_transient_status(response.status),
+                    )
+                progress = new_progress(target_url, response.headers, 1, 0)
+                if reservation is not None:  # raises InsufficientDiskSpace
+                    reservation.reserve(max(0, progress.content_length))
+                    callbacks.append(reservation.on_chunk)
+                tracker = ProgressTracker(
+                    progress, progress_file_path, hasher, callbacks, sniffer
+                )
+                await self._stream_to_file(
+                    response, part_file_path, tracker, limiter or OriginLimiter()
+                )
+        except aiohttp.ClientPayloadError as e:  # connection lost mid-body
+            logger.warning(f"Download incomplete for: {safe_filename} ({str(e)})")
+            return DownloadResult(
+                download_file_path,
+                DANEResponse(502, f"Received incomplete file: {safe_filename}"),
+                False,
+                {},
+                True,
+            )
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            logger.warning(f"Connection to {target_url} failed: {str(e)}")
+            return DownloadResult(
+                download_file_path,
+                DANEResponse(502, f"Connection to source failed: {str(e)}"),
+                False,
+                {},
+                True,
+            )
+
+        out_size = progress.bytes_written()
+        if progress.content_length > -1 and out_size != progress.content_length:
+            logger.warning(f"Download incomplete for: {safe_filename}")
+            return DownloadResult(
+                download_file_path,
+                DANEResponse(
+                    502,
+                    f"Received incomplete file: {safe_filename} "
+                    f"({out_size} out of {progress.content_length} bytes)",
+                ),
+                False,
+                {},
+                True,
+            )
+        return await self._run(
+            self._publish,
+            target_url,
+            download_dir,
+            safe_filename,
+            part_file_path,
+            progress_file_path,
+            progress,
+            hasher,
+            sniffer,
+        )
+
+    def close(self):
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._io.shutdown()
+
+    # the earlier download of the target_url, if it is still valid
+    async def _find_valid_download(
+        self,
+        session: aiohttp.ClientSession,
+        target_url: str,
+        download_file_path: str,
+        revalidate: bool,
+    ) -> DownloadResult | None:
+        cached = await self._run(
+            find_downloaded_file,
+            download_file_path,
+            target_url,
+            # blocking, but only for the rare download without sidecar
+            lambda file_path: describe_source(
+                get_http_session(), target_url, file_path
+            ),
+        )
+        if not cached:
+            return None
+        cached_file_path, metadata = cached
+        if revalidate and not await is_unmodified(session, target_url, metadata):
+            return None
+        return DownloadResult(
+            cached_file_path,
+            DANEResponse(201, f"{cached_file_path} was already downloaded"),
+            True,
+            metadata.file_info,
+        )
+
+    # the session must be created on the loop; only the loop thread gets here
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            logger.info(
+                f"Initiating async HTTP session (max_connections={self.max_connections})"
+            )
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                # we store the exact bytes of the source, like the requests session
+                headers={"Accept-Encoding": "identity"},
+                auto_decompress=False,
+                # no total, large files may be slow, but a stalled source fails
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self.connect_timeout,
+                    sock_read=self.read_timeout,
+                ),
+            )
+        return self._session
+
+    # starts func on an I/O thread (only call it on the loop)
+    def _run(self, func: Callable[..., Any], *args) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(self._io, func, *args)
+
+    # the next chunk is received while the previous one is being written
+    async def _stream_to_file(
+        self,
+        response: aiohttp.ClientResponse,
+        part_file_path: str,
+        tracker: ProgressTracker,
+        limiter: OriginLimiter,
+    ):
+        out_file = await self._run(open, part_file_path, "wb")
+        pending_write: asyncio.Future | None = None
+        blocked_on_disk = 0.0  # waiting for the previous write, see metrics
+        try:
+            async for chunk in response.content.iter_chunked(COPY_BUFFER_SIZE):
+                if pending_write is not None:
+                    start = time.perf_counter()
+                    await pending_write
+                    blocked_on_disk += time.perf_counter() - start
+                pending_write = self._run(_write_chunk, out_file, tracker, chunk)
+                delay = limiter.delay(len(chunk))  # over the origin's bandwidth
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if pending_write is not None:
+                await pending_write
+            if self.write_options.fsync:
+                await self._run(_sync_part_file, out_file)
+        finally:
+            if pending_write is not None:
+                await asyncio.wait([pending_write])  # never close during a write
+            await self._run(_close_part_file, out_file, tracker)
+            BLOCKED_SECONDS.labels("disk").inc(blocked_on_disk)
+
+    # runs on an I/O thread: verification reads the file back if needed
+    def _publish(
+        self,
+        target_url: str,
+        download_dir: str,
+        safe_filename: str,
+        part_file_path: str,
+        progress_file_path: str,
+        progress: DownloadProgress,
+        hasher: StreamHasher | None,
+        sniffer: ContentSniffer,
+    ) -> DownloadResult:
+        try:
+            digests = verify_part_file(part_file_path, progress, hasher)
+        except ChecksumMismatch as e:
+            logger.warning(f"Corrupt download of {target_url}: {str(e)}")
+            remove_part_file(part_file_path, progress_file_path)
+            return DownloadResult(
+                os.path.join(download_dir, safe_filename),
+                DANEResponse(502, f"Checksum verification failed: {str(e)}"),
+                False,
+                {},
+            )
+        sniffed = sniffer.sniffed(part_file_path)
+        download_file_path = os.path.join(
+            download_dir, to_output_filename(safe_filename, progress.headers, sniffed)
+        )
+        file_info = publish_part_file(
+            part_file_path,
+            progress_file_path,
+            download_file_path,
+            progress,
+            digests,
+            sniffed,
+        )
+        return DownloadResult(
+            download_file_path, DANEResponse(200, "Success"), False, file_info
+        )
+
+
+def _write_chunk(out_file: BinaryIO, tracker: ProgressTracker, chunk: bytes):
+    out_file.write(chunk)
+    tracker.add(0, chunk)
+
+
+def _sync_part_file(out_file: BinaryIO):
+    out_file.flush()
+    os.fdatasync(out_file.fileno())
+
+
+def _close_part_file(out_file: BinaryIO, tracker: ProgressTracker):
+    out_file.close()
+    tracker.save()  # also after errors, so download_http can resume it
+
+
+# conditional HEAD request: a 304 means the cached download is still valid
+async def is_unmodified(
+    session: aiohttp.ClientSession, target_url: str, cached: DownloadMetadata
+) -> bool:
+    headers = {}
+    if cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+    if not headers:
+        logger.info(f"No validators known for {target_url}, cannot revalidate")
+        return False
+    try:
+        async with session.head(
+            target_url, headers=headers, allow_redirects=True
+        ) as response:
+            status = response.status
+    except aiohttp.ClientError as e:
+        logger.warning(f"Could not revalidate {target_url} ({str(e)}), using cache")
+        return True
+    if status == 304:
+        return True
+    if status < 400:
+        logger.info(f"{target_url} was modified since it was downloaded")
+        return False
+    logger.warning(f"Could not revalidate {target_url} ({status}), using cache")
+    return True
@@ -1,7 +1,10 @@
 import os
 from pathlib import Path
 import logging
-import validators
+from checksum import is_supported
+from http_util import HTTP_ENGINES
+from placement import PLACEMENT_POLICIES
+from disk_io import FSYNC_AT_END
 
 
 LOG_FORMAT = "%(asctime)s|%(levelname)s|%(process)d|%(module)s|%(funcName)s|%(lineno)d|%(message)s"
@@ -84,10 +87,22 @@ def validate_config(config, validate_file_paths=True):
         assert __check_setting(
             config.DOWNLOADER.WHITELIST, list
         ), "DOWNLOADER.WHITELIST"
+        if config.DOWNLOADER.WHITELIST:
+            import validators  # slow to import, S3-only workers have no whitelist
         for domain in config.DOWNLOADER.WHITELIST:
             assert validators.domain(
                 domain
             ), f"Invalid domain in DOWNLOADER.WHITELIST: {domain}"
+        assert __check_setting(
+            config.DOWNLOADER.get("METRICS_PORT"), int, True
+        ), "DOWNLOADER.METRICS_PORT"
+        __validate_origin_limits(config.DOWNLOADER.get("ORIGIN_LIMITS", []))
+        __validate_transfer_settings(config.DOWNLOADER, parent_dirs_to_check)
+        __validate_s3_transfer_settings(config.DOWNLOADER.get("S3_TRANSFER", {}))
+        __validate_retry_settings(
+            config.DOWNLOADER.get("RETRY", {}),
+            config.DOWNLOADER.get("CIRCUIT_BREAKER", {}),
+        )
 
         # validate file paths (not while unit testing)
         if validate_file_paths:
@@ -101,6 +116,134 @@ def validate_config(config, validate_file_paths=True):
     return True
 
 
+# optional DOWNLOADER settings to tune the transfers
+def __validate_transfer_settings(downloader, parent_dirs_to_check: list) -> None:
+    assert __check_setting(
+        downloader.get("CONCURRENCY"), int, True
+    ), "DOWNLOADER.CONCURRENCY"
+    assert __check_setting(downloader.get("PREFETCH"), int, True), "DOWNLOADER.PREFETCH"
+    assert __check_setting(
+        downloader.get("HTTP_SEGMENTS"), int, True
+    ), "DOWNLOADER.HTTP_SEGMENTS"
+    assert __check_file_size_setting(
+        downloader.get("HTTP_MIN_SEGMENT_SIZE")
+    ), "DOWNLOADER.HTTP_MIN_SEGMENT_SIZE"
+    assert (
+        downloader.get("HTTP_ENGINE") is None
+        or downloader.get("HTTP_ENGINE") in HTTP_ENGINES
+    ), f"DOWNLOADER.HTTP_ENGINE must be one of: {', '.join(HTTP_ENGINES)}"
+    assert __check_setting(
+        downloader.get("ASYNC_HTTP_CONNECTIONS"), int, True
+    ), "DOWNLOADER.ASYNC_HTTP_CONNECTIONS"
+    for timeout_setting in ["HTTP_CONNECT_TIMEOUT", "HTTP_READ_TIMEOUT"]:
+        assert __check_number_setting(
+            downloader.get(timeout_setting)
+        ), f"DOWNLOADER.{timeout_setting}"
+    assert __check_file_size_setting(
+        downloader.get("HTTP_BUFFER_SIZE")
+    ), "DOWNLOADER.HTTP_BUFFER_SIZE"
+    assert __check_setting(
+        downloader.get("HTTP_PREALLOCATE"), bool, True
+    ), "DOWNLOADER.HTTP_PREALLOCATE"
+    assert downloader.get("HTTP_DROP_CACHE_SIZE") == "" or __check_file_size_setting(
+        downloader.get("HTTP_DROP_CACHE_SIZE")
+    ), "DOWNLOADER.HTTP_DROP_CACHE_SIZE"
+    assert __check_setting(
+        downloader.get("HTTP_WRITE_BUFFERS"), int, True
+    ), "DOWNLOADER.HTTP_WRITE_BUFFERS"
+    assert downloader.get("HTTP_FSYNC") in [
+        "",
+        FSYNC_AT_END,
+    ] or __check_file_size_setting(
+        downloader.get("HTTP_FSYNC")
+    ), f"DOWNLOADER.HTTP_FSYNC must be empty, '{FSYNC_AT_END}' or a size"
+    assert __check_setting(
+        downloader.get("CACHE_REVALIDATE"), bool, True
+    ), "DOWNLOADER.CACHE_REVALIDATE"
+    assert __check_setting(
+        downloader.get("CONTENT_STORE"), str, True
+    ), "DOWNLOADER.CONTENT_STORE"
+    if downloader.get("CONTENT_STORE"):
+        parent_dirs_to_check.append(downloader.CONTENT_STORE)
+    assert __check_setting(
+        downloader.get("DOWNLOAD_ROOTS"), list, True
+    ), "DOWNLOADER.DOWNLOAD_ROOTS"
+    for root in downloader.get("DOWNLOAD_ROOTS") or []:
+        assert __check_setting(
+            root, str
+        ), f"Invalid dir in DOWNLOADER.DOWNLOAD_ROOTS: {root}"
+    assert (
+        downloader.get("PLACEMENT") is None
+        or downloader.get("PLACEMENT") in PLACEMENT_POLICIES
+    ), f"DOWNLOADER.PLACEMENT must be one of: {', '.join(PLACEMENT_POLICIES)}"
+    assert __check_setting(
+        downloader.get("RESULT_CACHE_FILE"), str, True
+    ), "DOWNLOADER.RESULT_CACHE_FILE"
+    if downloader.get("RESULT_CACHE_FILE"):
+        parent_dirs_to_check.append(downloader.RESULT_CACHE_FILE)
+    for int_setting in ["RESULT_CACHE_TTL", "RESULT_CACHE_SIZE"]:
+        assert __check_setting(
+            downloader.get(int_setting), int, True
+        ), f"DOWNLOADER.{int_setting}"
+    assert __check_setting(
+        downloader.get("RESULT_TIMINGS"), bool, True
+    ), "DOWNLOADER.RESULT_TIMINGS"
+    assert __check_setting(
+        downloader.get("CHECKSUMS"), list, True
+    ), "DOWNLOADER.CHECKSUMS"
+    for algorithm in downloader.get("CHECKSUMS") or []:
+        assert is_supported(
+            algorithm
+        ), f"Unsupported (or not installed) algorithm in DOWNLOADER.CHECKSUMS: {algorithm}"
+
+
+# optional DOWNLOADER.ORIGIN_LIMITS, e.g. [{ORIGIN: 'a.com', MAX_CONNECTIONS: 4}]
+def __validate_origin_limits(origin_limits) -> None:
+    assert __check_setting(origin_limits, list, True), "DOWNLOADER.ORIGIN_LIMITS"
+    for entry in origin_limits or []:
+        assert type(entry) == dict and __check_setting(
+            entry.get("ORIGIN"), str
+        ), f"DOWNLOADER.ORIGIN_LIMITS entry without ORIGIN: {entry}"
+        assert __check_setting(
+            entry.get("MAX_CONNECTIONS"), int, True
+        ), f"DOWNLOADER.ORIGIN_LIMITS.MAX_CONNECTIONS of {entry['ORIGIN']}"
+        assert entry.get("MAX_BANDWIDTH") == "" or __check_file_size_setting(
+            entry.get("MAX_BANDWIDTH")
+        ), f"DOWNLOADER.ORIGIN_LIMITS.MAX_BANDWIDTH of {entry['ORIGIN']}"
+
+
+# optional DOWNLOADER.S3_TRANSFER settings (boto3 TransferConfig)
+def __validate_s3_transfer_settings(s3_transfer) -> None:
+    for size_setting in ["MULTIPART_THRESHOLD", "MULTIPART_CHUNKSIZE"]:
+        assert __check_file_size_setting(
+            s3_transfer.get(size_setting)
+        ), f"DOWNLOADER.S3_TRANSFER.{size_setting}"
+    for int_setting in ["MAX_CONCURRENCY", "MAX_IO_QUEUE"]:
+        assert __check_setting(
+            s3_transfer.get(int_setting), int, True
+        ), f"DOWNLOADER.S3_TRANSFER.{int_setting}"
+    assert __check_setting(
+        s3_transfer.get("USE_THREADS"), bool, True
+    ), "DOWNLOADER.S3_TRANSFER.USE_THREADS"
+
+
+# optional DOWNLOADER.RETRY and DOWNLOADER.CIRCUIT_BREAKER settings
+def __validate_retry_settings(retry, circuit_breaker) -> None:
+    assert __check_setting(
+        retry.get("MAX_ATTEMPTS"), int, True
+    ), "DOWNLOADER.RETRY.MAX_ATTEMPTS"
+    for number_setting in ["BASE_DELAY", "MAX_DELAY"]:
+        assert __check_number_setting(
+            retry.get(number_setting)
+        ), f"DOWNLOADER.RETRY.{number_setting}"
+    assert __check_setting(
+        circuit_breaker.get("FAILURE_THRESHOLD"), int, True
+    ), "DOWNLOADER.CIRCUIT_BREAKER.FAILURE_THRESHOLD"
+    assert __check_number_setting(
+        circuit_breaker.get("RESET_TIMEOUT")
+    ), "DOWNLOADER.CIRCUIT_BREAKER.RESET_TIMEOUT"
+
+
 def __validate_environment_variables():
     # self.UNIT_TESTING = os.getenv('DW_DOWNLOAD_UNIT_TESTING', False)
     try:
@@ -130,6 +273,16 @@ def __check_setting(setting, t, optional=False):
     )
 
 
+# optional non-negative numbers, e.g. seconds
+def __check_number_setting(setting) -> bool:
+    return setting is None or (type(setting) in [int, float] and setting >= 0)
+
+
+# optional file size settings, e.g. '64MB'
+def __check_file_size_setting(setting) -> bool:
+    return setting is None or (type(setting) == str and parse_file_size(setting) != -1)
+
+
 def __check_log_level(level: str) -> bool:
     return level in ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 
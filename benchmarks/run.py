@@ -0,0 +1,333 @@
+"""End-to-end throughput benchmarks of the HTTP and S3 downloaders and of
+DownloadWorker.callback, against local stand-ins for the sources.
+
+Run from the repo root (the worker reads config.yml from there):
+
+    python -m benchmarks.run --sizes 1KB,1MB,64MB,1GB,4GB --runs 5
+    python -m benchmarks.run --save-baseline main
+    python -m benchmarks.run --compare main  # exits with 1 on a regression
+
+Each configuration runs in its own process, so its peak RSS and CPU time
+are its own; the source server runs in yet another process.
+"""
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+from base_util import parse_file_size
+from benchmarks.servers import BENCHMARK_BUCKET, generate_files, start_source_server
+
+
+logger = logging.getLogger(__name__)
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+DEFAULT_SIZES = "1KB,1MB,64MB,512MB"
+# generated once and reused, outside the repo (it is copied into the image)
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "dane-download-benchmark-data")
+DEFAULT_TOLERANCE = 0.1  # report a regression if 10% slower than the baseline
+
+# name -> (kind, parameters)
+BENCHMARKS: Dict[str, Any] = {
+    "http-single": ("http", {"segments": 1}),
+    "http-segmented-4": ("http", {"segments": 4}),
+    "http-single-md5": ("http", {"segments": 1, "checksums": ["md5"]}),
+    "http-single-drop-cache": (
+        "http",
+        {"segments": 1, "write_options": {"drop_cache_size": 1}},
+    ),
+    "http-single-no-writer-thread": (
+        "http",
+        {"segments": 1, "write_options": {"write_buffers": 1}},
+    ),
+    "s3-default": ("s3", {}),
+    "s3-tuned": (
+        "s3",
+        {
+            "transfer": {
+                "MULTIPART_THRESHOLD": "64MB",
+                "MULTIPART_CHUNKSIZE": "64MB",
+                "MAX_CONCURRENCY": 32,
+            }
+        },
+    ),
+    "worker-http": ("worker", {"scheme": "http"}),
+    "worker-s3": ("worker", {"scheme": "s3"}),
+}
+
+
+def _source_name(size_name: str) -> str:
+    return f"source-{size_name}.mp4"
+
+
+def _source_url(kind_params: Dict[str, Any], base_url: str, size_name: str) -> str:
+    if kind_params.get("scheme") == "s3":
+        return f"s3://{BENCHMARK_BUCKET}/{_source_name(size_name)}"
+    return f"{base_url}/archive/{_source_name(size_name)}"
+
+
+# returns a function that does one download into download_dir
+def _prepare(
+    kind: str, params: Dict[str, Any], base_url: str, size_name: str, download_dir: str
+) -> Callable[[], Any]:
+    if kind == "http":
+        from disk_io import WriteOptions
+        from http_download import download_http
+
+        url = _source_url({}, base_url, size_name)
+        write_options = WriteOptions(**params.get("write_options", {}))
+        return lambda: download_http(
+            url,
+            download_dir,
+            segments=params["segments"],
+            min_segment_size=8 * 10**6,
+            checksums=params.get("checksums"),
+            write_options=write_options,
+        ).dane_response
+
+    if kind == "s3":
+        from s3_download import download_s3_uri, to_transfer_config
+
+        uri = _source_url({"scheme": "s3"}, base_url, size_name)
+        transfer_config = to_transfer_config(params.get("transfer", {}))
+        return lambda: download_s3_uri(
+            uri, download_dir, transfer_config=transfer_config
+        ).dane_response
+
+    return prepare_worker(params, base_url, size_name, download_dir)
+
+
+class _ResultStore:
+    """Stands in for the DANE handler, the benchmark has no Elasticsearch"""
+
+    def registerResult(self, result, task_id):
+        return result
+
+    def searchResult(self, doc_id, task_key):
+        return []
+
+
+# a DownloadWorker without RabbitMQ and Elasticsearch; returns a function that
+# lets it process one task (also used by the startup benchmark)
+def prepare_worker(
+    params: Dict[str, Any], base_url: str, size_name: str, download_dir: str
+) -> Callable[[], Any]:
+    os.environ["DW_DOWNLOAD_UNIT_TESTING"] = "true"  # no RabbitMQ connection
+    from dane import Document, Task
+    from dane.config import cfg
+    from worker import DownloadWorker
+
+    logging.getLogger().setLevel(logging.WARNING)
+    worker = DownloadWorker(cfg)
+    worker.whitelist = ["127.0.0.1"]
+    worker.handler = _ResultStore()
+    worker.disk_ledger.threshold = 0  # the benchmark files are cleaned up
+    doc = Document.from_json(
+        json.dumps(
+            {
+                "target": {
+                    "id": f"benchmark-{size_name}",
+                    "url": _source_url(params, base_url, size_name),
+                    "type": "Video",
+                },
+                "creator": {"id": "benchmark", "type": "Organization"},
+                "_id": f"benchmark-{size_name}",
+            }
+        )
+    )
+    task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": download_dir}})
+    return lambda: worker.callback(task, doc)
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    ordered = sorted(values)
+    rank = max(0, math.ceil(percentile / 100 * len(ordered)) - 1)  # nearest rank
+    return ordered[rank]
+
+
+def _clear_dir(dir: str):
+    for name in os.listdir(dir):
+        path = os.path.join(dir, name)
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+
+def _state_of(response) -> int:
+    return response["state"] if isinstance(response, dict) else response.state
+
+
+# runs in a child process: warm up, then time each download
+def _measure(
+    name: str, size_name: str, base_url: str, runs: int, warmup: int, work_dir: str
+) -> Dict[str, Any]:
+    kind, params = BENCHMARKS[name]
+    download_dir = tempfile.mkdtemp(dir=work_dir)
+    download = _prepare(kind, params, base_url, size_name, download_dir)
+    size = parse_file_size(size_name)
+    latencies = []
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    for i in range(warmup + runs):
+        _clear_dir(download_dir)  # every run is a fresh download
+        if i == warmup:
+            usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        state = _state_of(download())
+        if i >= warmup:
+            latencies.append(time.perf_counter() - start)
+        if state != 200:
+            raise RuntimeError(f"{name} of {size_name} failed with {state}")
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    shutil.rmtree(download_dir)
+
+    seconds = sum(latencies)
+    cpu_seconds = (usage.ru_utime - usage_before.ru_utime) + (
+        usage.ru_stime - usage_before.ru_stime
+    )
+    return {
+        "benchmark": name,
+        "size": size_name,
+        "runs": runs,
+        "mb_per_s": size * runs / seconds / 10**6,
+        "p50_s": _percentile(latencies, 50),
+        "p99_s": _percentile(latencies, 99),
+        "peak_rss_mb": usage.ru_maxrss / 1024,  # KB on Linux
+        "cpu_s": cpu_seconds,
+        "cpu_percent": 100 * cpu_seconds / seconds,
+        "cpu_s_per_gb": cpu_seconds / (size * runs / 10**9),
+    }
+
+
+def _measure_in_process(args) -> Dict[str, Any]:
+    return _measure(*args)
+
+
+def _print_results(results: List[Dict[str, Any]], baseline: Dict[str, Any]):
+    print(
+        f"{'benchmark':<24} {'size':>7} {'MB/s':>9} {'p50 s':>8} {'p99 s':>8} "
+        f"{'RSS MB':>8} {'CPU %':>7} {'CPU s/GB':>9}  vs baseline"
+    )
+    for r in results:
+        compared = ""
+        base = baseline.get(f"{r['benchmark']}/{r['size']}")
+        if base:
+            change = r["mb_per_s"] / base["mb_per_s"] - 1
+            compared = f"{change:+.1%} MB/s, p50 {r['p50_s'] / base['p50_s'] - 1:+.1%}"
+            if base.get("cpu_s_per_gb"):
+                cpu_change = r["cpu_s_per_gb"] / base["cpu_s_per_gb"] - 1
+                compared += f", CPU/GB {cpu_change:+.1%}"
+        print(
+            f"{r['benchmark']:<24} {r['size']:>7} {r['mb_per_s']:>9.2f} "
+            f"{r['p50_s']:>8.3f} {r['p99_s']:>8.3f} {r['peak_rss_mb']:>8.1f} "
+            f"{r['cpu_percent']:>7.1f} {r.get('cpu_s_per_gb', 0):>9.2f}  {compared}"
+        )
+
+
+def _regressions(
+    results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    regressions = []
+    for r in results:
+        key = f"{r['benchmark']}/{r['size']}"
+        if key in baseline and r["mb_per_s"] < baseline[key]["mb_per_s"] * (
+            1 - tolerance
+        ):
+            regressions.append(key)
+    return regressions
+
+
+def _baseline_path(name: str) -> str:
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Download throughput benchmarks")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="e.g. 1KB,1MB,4GB")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--only", default="", help="regex on the benchmark names")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="source files")
+    parser.add_argument("--save-baseline", default="", metavar="NAME")
+    parser.add_argument("--compare", default="", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    for size_name in sizes:
+        assert parse_file_size(size_name) != -1, f"Invalid size: {size_name}"
+    names = [n for n in BENCHMARKS if re.search(args.only, n)]
+    manifest = generate_files(
+        args.data_dir, {_source_name(s): parse_file_size(s) for s in sizes}
+    )
+    server, base_url = start_source_server(args.data_dir, manifest)
+
+    # boto3 picks these up in the benchmark processes (path style: no DNS)
+    work_dir = tempfile.mkdtemp(prefix="dane-download-benchmark-")
+    aws_config_file = os.path.join(work_dir, "aws_config")
+    with open(aws_config_file, "w") as f:
+        f.write("[default]\ns3 =\n    addressing_style = path\n")
+    os.environ.update(
+        {
+            "AWS_ENDPOINT_URL_S3": base_url,
+            "AWS_CONFIG_FILE": aws_config_file,
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+    )
+
+    results = []
+    try:
+        context = multiprocessing.get_context("spawn")
+        for name in names:
+            for size_name in sizes:
+                logger.info(f"Running {name} with {size_name} files")
+                with context.Pool(1) as pool:  # a fresh process per configuration
+                    results.append(
+                        pool.apply(
+                            _measure_in_process,
+                            (
+                                (
+                                    name,
+                                    size_name,
+                                    base_url,
+                                    args.runs,
+                                    args.warmup,
+                                    work_dir,
+                                ),
+                            ),
+                        )
+                    )
+    finally:
+        server.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if args.compare:
+        with open(_baseline_path(args.compare), "r") as f:
+            baseline = json.load(f)
+    _print_results(results, baseline)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(_baseline_path(args.save_baseline), "w") as f:
+            json.dump(
+                {f"{r['benchmark']}/{r['size']}": r for r in results}, f, indent=2
+            )
+        logger.info(f"Saved baseline to {_baseline_path(args.save_baseline)}")
+
+    regressions = _regressions(results, baseline, args.tolerance)
+    if regressions:
+        print(f"Throughput regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,142 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Queue
+from typing import Dict, Tuple
+
+
+logger = logging.getLogger(__name__)
+WRITE_BUFFER_SIZE = 1024 * 1024
+BENCHMARK_BUCKET = "benchmark"
+MANIFEST_FILE = "manifest.json"  # file name -> md5, so the sources have a stable ETag
+
+
+# writes random (incompressible) files of the given sizes, unless they exist
+def generate_files(data_dir: str, sizes: Dict[str, int]) -> Dict[str, str]:
+    os.makedirs(data_dir, exist_ok=True)
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    for name, size in sizes.items():
+        file_path = os.path.join(data_dir, name)
+        if name in manifest and os.path.exists(file_path):
+            if os.path.getsize(file_path) == size:
+                continue
+        logger.info(f"Generating {file_path} ({size} bytes)")
+        md5 = hashlib.md5()
+        with open(file_path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = os.urandom(min(WRITE_BUFFER_SIZE, remaining))
+                md5.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+        manifest[name] = md5.hexdigest()
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+class SourceRequestHandler(BaseHTTPRequestHandler):
+    """Serves the files in the data dir like an archive host (any path ending
+    in the file name, with Range/If-Range support) and like S3 does for path
+    style requests (/<bucket>/<key>); both use the MD5 as ETag"""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real sources
+    disable_nagle_algorithm = True  # headers and body are sent separately
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self, send_body: bool):
+        name = self.path.split("?")[0].rstrip("/").split("/")[-1]
+        md5 = self.server.manifest.get(name)  # type: ignore[attr-defined]
+        if md5 is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        file_path = os.path.join(self.server.data_dir, name)  # type: ignore[attr-defined]
+        size = os.path.getsize(file_path)
+        etag = f'"{md5}"'
+        start, end = self._requested_range(size, etag)
+        if start > end and size > 0:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        partial = (start, end) != (0, size - 1)
+        self.send_response(206 if partial else 200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(max(0, end - start + 1)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(0, usegmt=True))
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            md5_b64 = base64.b64encode(bytes.fromhex(md5)).decode()
+            self.send_header("Content-MD5", md5_b64)
+        self.end_headers()
+        if send_body and end >= start:
+            try:
+                self._send_file(file_path, start, end - start + 1)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client stopped reading (e.g. a discarded stream)
+
+    # zero-copy, so the server is never the bottleneck of a benchmark
+    def _send_file(self, file_path: str, offset: int, count: int):
+        self.wfile.flush()
+        with open(file_path, "rb") as f:
+            while count > 0:
+                sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+
+    # returns the inclusive byte range to send (the full file by default)
+    def _requested_range(self, size: int, etag: str) -> Tuple[int, int]:
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if not match or (if_range and if_range != etag):
+            return 0, size - 1
+        first, last = match.groups()
+        if not first:  # suffix range: the last N bytes
+            return max(0, size - int(last)), size - 1
+        return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def _serve_forever(data_dir: str, manifest: Dict[str, str], port_queue: Queue):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SourceRequestHandler)
+    server.daemon_threads = True
+    server.data_dir = data_dir  # type: ignore[attr-defined]
+    server.manifest = manifest  # type: ignore[attr-defined]
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+# runs the source server in its own process, so it does not compete with the
+# measured downloads for the GIL (nor shows up in their CPU and RSS)
+def start_source_server(data_dir: str, manifest: Dict[str, str]) -> Tuple[Process, str]:
+    port_queue: Queue = Queue()
+    process = Process(
+        target=_serve_forever, args=(data_dir, manifest, port_queue), daemon=True
+    )
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=10)}"
@@ -0,0 +1,157 @@
+"""Startup benchmark of the worker: how long a fresh process takes to import
+worker.py and to process its first message (a small HTTP download, through
+DownloadWorker.callback like DANE's base_worker calls it), without RabbitMQ.
+
+Run from the repo root (the worker reads config.yml from there):
+
+    python -m benchmarks.startup --runs 10
+    python -m benchmarks.startup --save-baseline main
+    python -m benchmarks.startup --compare main  # exits with 1 on a regression
+
+It also lists the heavy dependencies the process loaded: a worker that only
+downloaded over HTTP should not have loaded boto3.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+# only the standard library above: everything else counts as startup
+
+
+logger = logging.getLogger(__name__)
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+SOURCE_SIZE = "1KB"
+HEAVY_MODULES = ["boto3", "botocore", "validators", "aiohttp", "elasticsearch7"]
+DEFAULT_TOLERANCE = 0.2  # report a regression if 20% slower than the baseline
+METRICS = ["import_s", "first_message_s", "process_s"]
+
+
+# runs in a fresh process: prints the timings as JSON (on the last line)
+def _measure_startup(base_url: str, download_dir: str):
+    start = time.perf_counter()
+    import worker  # noqa: F401
+
+    imported = time.perf_counter()
+    from benchmarks.run import prepare_worker
+
+    callback = prepare_worker({"scheme": "http"}, base_url, SOURCE_SIZE, download_dir)
+    response = callback()
+    done = time.perf_counter()
+    print(
+        json.dumps(
+            {
+                "state": response["state"],
+                "import_s": imported - start,
+                "first_message_s": done - start,
+                "loaded": [m for m in HEAVY_MODULES if m in sys.modules],
+            }
+        )
+    )
+
+
+def _run_once(base_url: str, work_dir: str) -> Dict[str, Any]:
+    download_dir = tempfile.mkdtemp(dir=work_dir)
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", base_url, download_dir],
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "DW_DOWNLOAD_UNIT_TESTING": "true"},
+    ).stdout
+    process_s = time.perf_counter() - start  # incl. starting the interpreter
+    shutil.rmtree(download_dir)
+    result = json.loads(output.strip().splitlines()[-1])
+    if result["state"] != 200:
+        raise RuntimeError(f"First message failed with {result['state']}")
+    return {**result, "process_s": process_s}
+
+
+def _median(values: List[float]) -> float:
+    ordered = sorted(values)
+    return ordered[(len(ordered) - 1) // 2]
+
+
+def _print_result(result: Dict[str, Any], baseline: Dict[str, Any]):
+    print(f"{'metric':<16} {'median s':>9} {'max s':>9}  vs baseline")
+    for metric in METRICS:
+        compared = ""
+        if baseline.get(metric):
+            compared = f"{result[metric] / baseline[metric] - 1:+.1%}"
+        print(
+            f"{metric:<16} {result[metric]:>9.3f} "
+            f"{result[f'{metric}_max']:>9.3f}  {compared}"
+        )
+    print(f"heavy modules loaded: {', '.join(result['loaded']) or '-'}")
+
+
+def _baseline_path(name: str) -> str:
+    return os.path.join(BASELINE_DIR, f"startup-{name}.json")
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Worker startup benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save-baseline", default="", metavar="NAME")
+    parser.add_argument("--compare", default="", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--child", nargs=2, metavar=("URL", "DIR"), help="internal")
+    args = parser.parse_args(argv)
+    if args.child:
+        _measure_startup(*args.child)
+        return 0
+
+    from base_util import parse_file_size
+    from benchmarks.run import DEFAULT_DATA_DIR
+    from benchmarks.servers import generate_files, start_source_server
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    source_name = f"source-{SOURCE_SIZE}.mp4"
+    manifest = generate_files(
+        DEFAULT_DATA_DIR, {source_name: parse_file_size(SOURCE_SIZE)}
+    )
+    server, base_url = start_source_server(DEFAULT_DATA_DIR, manifest)
+    work_dir = tempfile.mkdtemp(prefix="dane-download-startup-")
+    try:
+        runs = [_run_once(base_url, work_dir) for _ in range(args.runs)]
+    finally:
+        server.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result: Dict[str, Any] = {"runs": args.runs, "loaded": runs[-1]["loaded"]}
+    for metric in METRICS:
+        result[metric] = _median([r[metric] for r in runs])
+        result[f"{metric}_max"] = max(r[metric] for r in runs)
+
+    baseline = {}
+    if args.compare:
+        with open(_baseline_path(args.compare), "r") as f:
+            baseline = json.load(f)
+    _print_result(result, baseline)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(_baseline_path(args.save_baseline), "w") as f:
+            json.dump(result, f, indent=2)
+        logger.info(f"Saved baseline to {_baseline_path(args.save_baseline)}")
+
+    regressions = [
+        m
+        for m in METRICS
+        if baseline.get(m) and result[m] > baseline[m] * (1 + args.tolerance)
+    ]
+    if regressions:
+        print(f"Startup regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,202 @@
+"""Downloads the sources listed in a manifest the way the worker downloads the
+target.url of a DANE document (whitelist, file names, disk space threshold,
+origin limits, retries), but without RabbitMQ and Elasticsearch, e.g. to
+backfill a collection:
+
+    python bulk_download.py manifest.jsonl results.jsonl --parallel 32
+
+The manifest is a JSONL file (an object per line) or a CSV file (with a
+header) with the "url" and "download_dir" of each source, and optionally an
+"id" to find it by in the results (the url by default). Each source gets a
+line in the results JSONL file: its id, url, download_dir, the state and
+message a task would return and, if it was downloaded (or was found already
+downloaded), the payload its DANE Result would have.
+
+Run it again with the same results file to continue where it stopped: the
+sources it downloaded before are skipped, the failed ones are tried again.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Set, TextIO
+from dane.config import cfg
+from disk_ledger import InsufficientDiskSpace
+from model import DANEResponse, DownloadResult
+from timing import Timings, recording
+from worker import DownloadWorker
+import timing
+
+
+logger = logging.getLogger(__name__)
+JSONL_EXTENSIONS = [".jsonl", ".ndjson", ".json"]  # anything else is CSV
+DONE_STATES = {200, 201}  # downloaded, or found already downloaded
+
+
+@dataclass
+class ManifestEntry:
+    id: str
+    url: str
+    download_dir: str
+
+
+# reads the manifest lazily, it may list more sources than fit in memory
+def read_manifest(manifest_path: str) -> Iterator[ManifestEntry]:
+    with open(manifest_path, "r", newline="") as f:
+        rows: Iterable[Dict[str, Any]]
+        if os.path.splitext(manifest_path)[1].lower() in JSONL_EXTENSIONS:
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for row in rows:
+            url = (row.get("url") or "").strip()  # None for a missing CSV column
+            yield ManifestEntry(
+                str(row.get("id") or url),
+                url,
+                (row.get("download_dir") or "").strip(),
+            )
+
+
+# the ids of the sources downloaded by earlier runs
+def read_done(results_path: str) -> Set[str]:
+    done: Set[str] = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path, "r") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:  # the last line of an interrupted run
+                continue
+            if result.get("state") in DONE_STATES:
+                done.add(result["id"])
+    return done
+
+
+# appends to the results file, after the last complete line
+def open_results(results_path: str) -> TextIO:
+    partial_line = False  # the last line of an interrupted run
+    if os.path.exists(results_path) and os.path.getsize(results_path) > 0:
+        with open(results_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            partial_line = f.read(1) != b"\n"
+    results = open(results_path, "a")
+    if partial_line:
+        results.write("\n")
+    return results
+
+
+def download_entry(worker: DownloadWorker, entry: ManifestEntry) -> Dict[str, Any]:
+    timings = Timings()
+    start = time.perf_counter()
+    with recording(timings):
+        result = _download(worker, entry)
+    timing.log(
+        timings,
+        time.perf_counter() - start,
+        id=entry.id,
+        state=result.dane_response.state,
+    )
+    record: Dict[str, Any] = {
+        "id": entry.id,
+        "url": entry.url,
+        "download_dir": entry.download_dir,
+        **result.dane_response.to_json(),
+        "already_downloaded": result.already_downloaded,
+    }
+    if result.dane_response.state in DONE_STATES:  # like a DANE Result payload
+        record["payload"] = {
+            "file_path": result.download_file_path,
+            **result.file_info,
+        }
+    return record
+
+
+def _download(worker: DownloadWorker, entry: ManifestEntry) -> DownloadResult:
+    if not entry.url or not entry.download_dir:
+        return DownloadResult(
+            "", DANEResponse(400, "No url or download_dir in the manifest"), False, {}
+        )
+    try:
+        os.makedirs(entry.download_dir, exist_ok=True)
+        return worker.download_to(entry.url, entry.download_dir)
+    except InsufficientDiskSpace as e:  # the next run tries it again
+        logger.error(f"Insufficient disk space: {str(e)}")
+        return DownloadResult(
+            "", DANEResponse(507, f"Insufficient disk space: {str(e)}"), False, {}
+        )
+    except Exception as e:  # a failing source must not stop the others
+        logger.exception(f"Error while downloading {entry.url}")
+        return DownloadResult("", DANEResponse(500, f"Error: {str(e)}"), False, {})
+
+
+# downloads the entries with (at most) parallel threads, writing the result of
+# each to results as soon as it is done; returns the number of results per state
+def download_all(
+    worker: DownloadWorker,
+    entries: Iterable[ManifestEntry],
+    results: TextIO,
+    parallel: int,
+) -> Dict[int, int]:
+    remaining = iter(entries)
+    states: Dict[int, int] = {}
+    lock = threading.Lock()  # for the manifest, results and states
+
+    def next_entry() -> ManifestEntry | None:
+        with lock:
+            return next(remaining, None)
+
+    def download_entries():
+        while (entry := next_entry()) is not None:
+            record = download_entry(worker, entry)
+            with lock:
+                results.write(f"{json.dumps(record)}\n")
+                results.flush()  # an interrupted run keeps its results
+                states[record["state"]] = states.get(record["state"], 0) + 1
+
+    threads = [
+        threading.Thread(target=download_entries, name=f"bulk-download-{i}")
+        for i in range(parallel)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return states
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Download the sources in a manifest")
+    parser.add_argument("manifest", help="CSV or JSONL with url and download_dir")
+    parser.add_argument("results", help="JSONL to append the results to")
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=0,
+        help="number of downloads at the same time (default: DOWNLOADER.CONCURRENCY)",
+    )
+    args = parser.parse_args(argv)
+
+    config = cfg.clone()
+    if args.parallel > 0:  # sizes the connection pools as well
+        config.defrost()
+        config.DOWNLOADER.CONCURRENCY = args.parallel
+        config.freeze()
+    worker = DownloadWorker(config, standalone=True)
+
+    done = read_done(args.results)
+    logger.info(f"Skipping {len(done)} sources downloaded before")
+    entries = (e for e in read_manifest(args.manifest) if e.id not in done)
+    with open_results(args.results) as results:
+        states = download_all(worker, entries, results, worker.concurrency)
+    logger.info(f"Results per state: {json.dumps(states)}")
+    return 0 if set(states) <= DONE_STATES else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
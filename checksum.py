@@ -0,0 +1,119 @@
+import base64
+import hashlib
+import logging
+from typing import Dict, List
+
+try:
+    import crc32c  # optional, only needed for the crc32c algorithm
+except ImportError:
+    crc32c = None
+
+
+logger = logging.getLogger(__name__)
+READ_BUFFER_SIZE = 1024 * 1024
+SUPPORTED_ALGORITHMS = ["md5", "sha1", "sha256", "crc32c"]
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class _CRC32C:
+    """hashlib-like wrapper around the crc32c package (as used by GCS and S3)"""
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = crc32c.crc32c(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f"{self._value:08x}"
+
+
+def is_supported(algorithm: str) -> bool:
+    if algorithm == "crc32c":
+        return crc32c is not None
+    return algorithm in SUPPORTED_ALGORITHMS
+
+
+def _new_hash(algorithm: str):
+    if algorithm == "crc32c":
+        if crc32c is None:
+            raise ValueError("The crc32c algorithm requires the crc32c package")
+        return _CRC32C()
+    return hashlib.new(algorithm)
+
+
+class StreamHasher:
+    """Computes one or more digests of a stream of bytes, in the order they
+    are passed to update()"""
+
+    def __init__(self, algorithms: List[str]):
+        self._hashes = {alg: _new_hash(alg) for alg in algorithms}
+        self.num_bytes = 0
+
+    def update(self, data):
+        for h in self._hashes.values():
+            h.update(data)
+        self.num_bytes += len(data)
+
+    def hexdigests(self) -> Dict[str, str]:
+        return {alg: h.hexdigest() for alg, h in self._hashes.items()}
+
+
+class HashingWriter:
+    """File object wrapper that hashes everything written to it. It is not
+    seekable, so writers like boto3's download_fileobj write in order"""
+
+    def __init__(self, fileobj, hasher: StreamHasher):
+        self._fileobj = fileobj
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self._fileobj.write(data)
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+# reads (the first num_bytes of) a file into the hasher, used when the bytes
+# could not be hashed while streaming (e.g. parallel segments, resumed downloads)
+def hash_file(
+    file_path: str, hasher: StreamHasher, num_bytes: int = -1
+) -> StreamHasher:
+    logger.info(f"Hashing {file_path} from disk")
+    with open(file_path, "rb") as f:
+        while num_bytes != 0:
+            to_read = READ_BUFFER_SIZE
+            if num_bytes > 0:
+                to_read = min(READ_BUFFER_SIZE, num_bytes)
+            data = f.read(to_read)
+            if not data:
+                break
+            hasher.update(data)
+            num_bytes -= len(data) if num_bytes > 0 else 0
+    return hasher
+
+
+# compares the computed digests with the ones declared by the source (if any)
+def verify_checksums(computed: Dict[str, str], declared: Dict[str, str]):
+    for alg in computed.keys() & declared.keys():
+        if computed[alg] != declared[alg]:
+            raise ChecksumMismatch(
+                f"{alg} mismatch: expected {declared[alg]}, got {computed[alg]}"
+            )
+        logger.info(f"Verified {alg} checksum: {computed[alg]}")
+
+
+# sources mostly declare their checksums base64 encoded, we use hex everywhere
+def b64_to_hex(value: str) -> str | None:
+    try:
+        return base64.b64decode(value, validate=True).hex()
+    except ValueError:  # includes binascii.Error
+        logger.warning(f"Ignoring invalid base64 checksum: {value}")
+        return None
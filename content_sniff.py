@@ -0,0 +1,184 @@
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+SNIFF_SIZE = 512  # first bytes of a file needed to recognize its format
+TS_PACKET_SIZE = 188
+M2TS_PACKET_SIZE = 192  # a 4 byte timecode before each TS packet
+MXF_PARTITION_KEY = b"\x06\x0e\x2b\x34\x02\x05\x01\x01\x0d\x01\x02"
+ASF_HEADER_GUID = b"\x30\x26\xb2\x75\x8e\x66\xcf\x11"
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"  # Matroska and WebM
+QUICKTIME_ATOMS = [b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"]
+HTML_STARTS = [b"<!doctype html", b"<html", b"<head", b"<body"]
+
+
+@dataclass
+class SniffedType:
+    extension: str
+    mime_type: str
+
+    @property
+    def file_type(self) -> str:  # e.g. video or audio
+        return self.mime_type.split("/")[0]
+
+
+# recognizes the format of a file from its first (SNIFF_SIZE) bytes
+def sniff(head: bytes) -> SniffedType | None:
+    return next((t for matches, t in SIGNATURES if matches(head)), None)
+
+
+def _is_html(head: bytes) -> bool:
+    start = head.lstrip(b"\xef\xbb\xbf \t\r\n")[:16].lower()  # BOM, whitespace
+    return any(start.startswith(s) for s in HTML_STARTS)
+
+
+# sync bytes at the start of three packets in a row
+def _is_transport_stream(head: bytes, offset: int, packet_size: int) -> bool:
+    positions = [offset + i * packet_size for i in range(3)]
+    return len(head) > positions[-1] and all(head[p] == 0x47 for p in positions)
+
+
+# frame sync (11 bits) followed by the MPEG audio layer III bits
+def _is_mp3_frame(head: bytes) -> bool:
+    return len(head) > 1 and head[0] == 0xFF and head[1] & 0xE6 == 0xE2
+
+
+# test on the first bytes -> format, the first match wins
+SIGNATURES: List[Tuple[Callable[[bytes], bool], SniffedType]] = [
+    (
+        lambda h: h[4:8] == b"ftyp" and h[8:12] == b"qt  ",
+        SniffedType(".mov", "video/quicktime"),
+    ),
+    (
+        lambda h: h[4:8] == b"ftyp" and h[8:12] in [b"M4A ", b"M4B "],
+        SniffedType(".m4a", "audio/mp4"),
+    ),
+    (lambda h: h[4:8] == b"ftyp", SniffedType(".mp4", "video/mp4")),
+    (  # QuickTime files from before ftyp
+        lambda h: h[4:8] in QUICKTIME_ATOMS,
+        SniffedType(".mov", "video/quicktime"),
+    ),
+    (
+        lambda h: h.startswith(MXF_PARTITION_KEY),
+        SniffedType(".mxf", "application/mxf"),
+    ),
+    (
+        lambda h: h[:4] in [b"RIFF", b"RF64"] and h[8:12] == b"WAVE",
+        SniffedType(".wav", "audio/wav"),
+    ),
+    (
+        lambda h: h[:4] == b"RIFF" and h[8:12] == b"AVI ",
+        SniffedType(".avi", "video/x-msvideo"),
+    ),
+    (  # the DocType in the EBML header
+        lambda h: h.startswith(EBML_MAGIC) and b"webm" in h[:64],
+        SniffedType(".webm", "video/webm"),
+    ),
+    (lambda h: h.startswith(EBML_MAGIC), SniffedType(".mkv", "video/x-matroska")),
+    (lambda h: h.startswith(ASF_HEADER_GUID), SniffedType(".wmv", "video/x-ms-wmv")),
+    (
+        lambda h: _is_transport_stream(h, 0, TS_PACKET_SIZE),
+        SniffedType(".ts", "video/mp2t"),
+    ),
+    (
+        lambda h: _is_transport_stream(h, 4, M2TS_PACKET_SIZE),
+        SniffedType(".m2ts", "video/mp2t"),
+    ),
+    (  # MPEG program stream pack header
+        lambda h: h.startswith(b"\x00\x00\x01\xba"),
+        SniffedType(".mpg", "video/mpeg"),
+    ),
+    (
+        lambda h: h.startswith(b"ID3") or _is_mp3_frame(h),
+        SniffedType(".mp3", "audio/mpeg"),
+    ),
+    (lambda h: h.startswith(b"MThd"), SniffedType(".mid", "audio/midi")),
+    (_is_html, SniffedType(".html", "text/html")),
+]
+
+
+def sniff_file(file_path: str) -> SniffedType | None:
+    with open(file_path, "rb") as f:
+        return sniff(f.read(SNIFF_SIZE))
+
+
+class ContentSniffer:
+    """Keeps the first SNIFF_SIZE bytes of a download while it is streamed
+    (fed with the offset of each chunk, so it only keeps them if they arrive
+    from the start, in order), to recognize its format without reading the
+    file back"""
+
+    def __init__(self) -> None:
+        self._head = bytearray()
+
+    def is_full(self) -> bool:
+        return len(self._head) >= SNIFF_SIZE
+
+    def feed(self, offset: int, chunk):
+        if offset == len(self._head) < SNIFF_SIZE:
+            self._head += chunk[: SNIFF_SIZE - offset]
+
+    # reads the first bytes from the file if they were not streamed (e.g. when
+    # the download was resumed), or if the file was not fully streamed through
+    def sniffed(self, file_path: str) -> SniffedType | None:
+        try:
+            if self.is_full():
+                return sniff(bytes(self._head))
+            return sniff_file(file_path)  # also for files shorter than SNIFF_SIZE
+        except OSError as e:
+            logger.warning(f"Cannot determine the format of {file_path}: {str(e)}")
+            return None
+
+
+class SniffingWriter:
+    """File object wrapper that feeds the bytes written to it to a
+    ContentSniffer, seekable if the file object it wraps is"""
+
+    def __init__(self, fileobj, sniffer: ContentSniffer):
+        self._fileobj = fileobj
+        self.sniffer = sniffer
+        self._offset = 0
+
+    def write(self, data):
+        if not self.sniffer.is_full():
+            self.sniffer.feed(self._offset, data)
+        num_bytes = self._fileobj.write(data)
+        self._offset += len(data)
+        return num_bytes
+
+    def seekable(self) -> bool:
+        return hasattr(self._fileobj, "seekable") and self._fileobj.seekable()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self._offset = self._fileobj.seek(offset, whence)
+        return self._offset
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+# the file info of a download, by the format it turned out to have rather than
+# what the source declared (if it could be recognized)
+def to_file_info(
+    content_type: str, content_length: int, sniffed: SniffedType | None
+) -> Dict[str, Any]:
+    if sniffed is not None:
+        file_type = sniffed.file_type
+    elif "/" in content_type:
+        file_type = content_type.split("/")[0]
+    else:
+        logger.warning("Handling unknown file type: {}".format(content_type))
+        file_type = "unknown"
+    file_info: Dict[str, Any] = {
+        "file_type": file_type,
+        "Content-Type": content_type,
+        "Content-Length": content_length,
+    }
+    if sniffed is not None:
+        file_info["sniffed_type"] = sniffed.mime_type
+    return file_info
@@ -0,0 +1,194 @@
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import uuid
+from typing import Callable, List, Tuple
+from checksum import StreamHasher, hash_file
+from download_cache import (
+    publish_download,
+    read_sidecar,
+    validate_cached_download,
+    write_sidecar,
+)
+from model import DownloadMetadata
+
+
+logger = logging.getLogger(__name__)
+DIGEST_ALGORITHM = "sha256"
+FICLONE = 0x40049409  # Linux ioctl to create a reflink (copy-on-write clone)
+LINK_SUFFIX = ".link"  # links are created next to their target, then renamed
+
+
+class ContentStore:
+    """Content-addressed store on the shared volume: each distinct file is kept
+    once under objects/<digest>, the document download dirs get a hardlink (or
+    reflink) to it. The index maps every source (URL or S3 URI) to the digest
+    of its content, so a source only has to be downloaded once. Links only work
+    within one file system, so download dirs on another one are left alone.
+
+    NOTE: hardlinked files share their content, so treat downloads as read-only
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, "objects")
+        self.index_dir = os.path.join(store_dir, "index")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.device = _device(store_dir)
+
+    # whether the store can link into (and from) path
+    def can_link(self, path: str) -> bool:
+        return _device(path) == self.device
+
+    # the download roots the store can link into, logs an error for the others
+    def check_roots(self, download_roots: List[str]) -> List[str]:
+        linkable = [root for root in download_roots if self.can_link(root)]
+        for root in set(download_roots) - set(linkable):
+            logger.error(
+                f"Download root {root} is not on the file system of the content "
+                f"store {self.store_dir}, its downloads cannot be deduplicated"
+            )
+        return linkable
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _index_path(self, source: str) -> str:
+        source_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        return os.path.join(self.index_dir, f"{source_hash}.json")
+
+    # returns the original filename and metadata of a stored download of source
+    def lookup(self, source: str) -> Tuple[str, DownloadMetadata] | None:
+        index_path = self._index_path(source)
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, "r") as f:
+                entry = json.load(f)
+            metadata = DownloadMetadata.from_json(entry["metadata"])
+        except (ValueError, TypeError, KeyError):
+            logger.warning(f"Ignoring corrupt content store index: {index_path}")
+            return None
+        object_path = self._object_path(metadata.checksums.get(DIGEST_ALGORITHM, ""))
+        if metadata.source != source or not _has_size(object_path, metadata.size):
+            return None
+        return entry["filename"], metadata
+
+    # links the stored content of source into download_dir (if available); an
+    # entry with a validator (ETag or Last-Modified) is only used if is_valid
+    # confirms the source did not change since it was stored
+    def link_into(
+        self,
+        source: str,
+        download_dir: str,
+        is_valid: Callable[[DownloadMetadata], bool] | None = None,
+    ) -> Tuple[str, DownloadMetadata] | None:
+        if not self.can_link(download_dir):
+            return None
+        stored = self.lookup(source)
+        if stored is None:
+            return None
+        filename, metadata = stored
+        download_file_path = os.path.join(download_dir, filename)
+        if validate_cached_download(download_file_path, source):
+            return None  # already there, the downloader reports it as such
+        has_validator = bool(metadata.etag or metadata.last_modified)
+        if (is_valid is None and has_validator) or (
+            is_valid is not None and not is_valid(metadata)
+        ):
+            logger.info(f"Stored content of {source} is outdated (or unverified)")
+            return None
+
+        link_path = _temp_path(download_file_path, LINK_SUFFIX)
+        if not _link(
+            self._object_path(metadata.checksums[DIGEST_ALGORITHM]), link_path
+        ):
+            return None
+        logger.info(f"Linked stored content of {source} into {download_file_path}")
+        publish_download(link_path, download_file_path, metadata)
+        return download_file_path, metadata
+
+    # adds a published download to the store; if the same content was stored
+    # before, the download is replaced by a link to it
+    def add(self, download_file_path: str):
+        if not self.can_link(os.path.dirname(download_file_path)):
+            logger.info(f"Not adding {download_file_path}: on another file system")
+            return
+        metadata = read_sidecar(download_file_path)
+        if metadata is None:
+            logger.warning(f"Not adding {download_file_path}: no sidecar found")
+            return
+        digest = metadata.checksums.get(DIGEST_ALGORITHM, "")
+        if not digest:
+            hasher = hash_file(download_file_path, StreamHasher([DIGEST_ALGORITHM]))
+            digest = hasher.hexdigests()[DIGEST_ALGORITHM]
+            metadata.checksums[DIGEST_ALGORITHM] = digest
+            write_sidecar(download_file_path, metadata)
+
+        object_path = self._object_path(digest)
+        if _has_size(object_path, metadata.size):
+            logger.info(f"Content of {download_file_path} was stored before")
+            link_path = _temp_path(download_file_path, LINK_SUFFIX)
+            if _link(object_path, link_path):
+                os.replace(link_path, download_file_path)
+        else:
+            # other threads or workers may store the same content at the same
+            # time, the last rename wins (each with a link to the same bytes)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            link_path = _temp_path(object_path, LINK_SUFFIX)
+            if not _link(download_file_path, link_path):
+                return
+            os.replace(link_path, object_path)
+
+        self._write_index(
+            metadata.source, os.path.basename(download_file_path), metadata
+        )
+
+    def _write_index(self, source: str, filename: str, metadata: DownloadMetadata):
+        index_path = self._index_path(source)
+        tmp_path = _temp_path(index_path, ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"filename": filename, "metadata": metadata.to_json()}, f)
+        os.replace(tmp_path, index_path)
+
+
+# a name next to path that no other thread or worker writes to at the same time
+# (workers in different containers may have the same pid)
+def _temp_path(path: str, suffix: str) -> str:
+    return f"{path}{suffix}.{uuid.uuid4().hex}"
+
+
+# the device of the file system path (or its nearest existing parent) is on
+def _device(path: str) -> int:
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def _has_size(path: str, size: int) -> bool:
+    return os.path.exists(path) and os.path.getsize(path) == size
+
+
+# hardlink, or reflink if that fails (e.g. at the file system's maximum number
+# of links); neither works across file systems (EXDEV)
+def _link(src: str, dst: str) -> bool:
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return True
+    except OSError as e:
+        logger.info(f"Could not hardlink {src} ({str(e)}), trying reflink")
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        return True
+    except OSError as e:
+        logger.warning(f"Could not reflink {src} ({str(e)}), not deduplicating")
+        if os.path.exists(dst):
+            os.remove(dst)
+    return False
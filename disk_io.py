@@ -0,0 +1,231 @@
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Tuple
+from metrics import BLOCKED_SECONDS
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_WRITE_BUFFERS = 4
+FSYNC_AT_END = "end"  # HTTP_FSYNC: only once the download is complete
+DROP_CACHE_INTERVAL = 64 * 1024 * 1024  # written bytes between page cache drops
+
+
+@dataclass
+class WriteOptions:
+    buffer_size: int = DEFAULT_BUFFER_SIZE  # reused read buffer per stream
+    preallocate: bool = True  # reserve the blocks of files of known size up front
+    drop_cache_size: int = 0  # files from this size skip the page cache (0 = never)
+    # buffers per stream between the network and a writer thread (1 = the
+    # reading thread writes, as it does for small bodies, see open_stream_writer)
+    write_buffers: int = DEFAULT_WRITE_BUFFERS
+    fsync: bool = False  # sync a complete download to disk before publishing it
+    fsync_interval: int = 0  # also sync every this many bytes per stream (0 = never)
+
+    def drops_cache(self, content_length: int) -> bool:
+        return 0 < self.drop_cache_size <= content_length
+
+
+# allocates the whole file at once, so it is not fragmented by growing chunk by
+# chunk; returns False if the file system (or OS) does not support it
+def preallocate(fd: int, size: int) -> bool:
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError as e:
+        logger.info(f"Cannot preallocate {size} bytes ({str(e)}), growing the file")
+        return False
+
+
+class PageCacheDropper:
+    """Evicts the written bytes of a stream from the page cache, so a huge
+    download does not push everything else out of it. Only clean pages can be
+    evicted, so every DROP_CACHE_INTERVAL bytes the file is synced first"""
+
+    def __init__(self, fd: int, offset: int):
+        self.fd = fd
+        self._start = offset  # of the bytes not dropped yet
+        self._end = offset
+
+    def written(self, offset: int, num_bytes: int):
+        self._end = offset + num_bytes
+        if self._end - self._start >= DROP_CACHE_INTERVAL:
+            self.drop()
+
+    def drop(self):
+        if self._end <= self._start or not hasattr(os, "posix_fadvise"):
+            return
+        os.fdatasync(self.fd)
+        os.posix_fadvise(
+            self.fd, self._start, self._end - self._start, os.POSIX_FADV_DONTNEED
+        )
+        self._start = self._end
+
+
+class IntervalSyncer:
+    """Syncs the written bytes of a stream to disk every interval bytes, so a
+    crash loses at most that much of it (and the dirty pages do not pile up)"""
+
+    def __init__(self, fd: int, interval: int):
+        self.fd = fd
+        self.interval = interval  # 0 means never
+        self._unsynced = 0
+
+    def written(self, num_bytes: int):
+        self._unsynced += num_bytes
+        if 0 < self.interval <= self._unsynced:
+            os.fdatasync(self.fd)
+            self._unsynced = 0
+
+
+class StreamWriter:
+    """Writes a stream to a file from its offset on, through reusable buffers:
+    the reader fills the one next_buffer returns and submits it. This one
+    writes it right away, on the reading thread"""
+
+    def __init__(
+        self,
+        fd: int,
+        offset: int,
+        options: WriteOptions,
+        on_written: Callable[[memoryview], None],
+        drop_cache: bool = False,
+    ):
+        self.fd = fd
+        self.offset = offset
+        self.on_written = on_written  # called with each chunk after writing it
+        self._syncer = IntervalSyncer(fd, options.fsync_interval)
+        self._dropper = PageCacheDropper(fd, offset) if drop_cache else None
+        self.buffer_size = options.buffer_size
+        self._buffer: memoryview | None = None  # allocated when first needed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def next_buffer(self) -> memoryview:
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(self.buffer_size))
+        return self._buffer
+
+    def submit(self, buffer: memoryview, num_bytes: int):
+        self._write(buffer[:num_bytes])
+
+    def close(self):
+        if self._dropper is not None:
+            self._dropper.drop()
+
+    def _write(self, chunk: memoryview):
+        os.pwrite(self.fd, chunk, self.offset)
+        self.on_written(chunk)
+        self._syncer.written(len(chunk))
+        if self._dropper is not None:
+            self._dropper.written(self.offset, len(chunk))
+        self.offset += len(chunk)
+
+
+class ThreadedStreamWriter(StreamWriter):
+    """Writes on its own thread, so the reading thread keeps receiving while
+    the disk is slow (e.g. a stalling network volume) and the TCP receive
+    window stays open: the reader fills a ring of reusable buffers, the writer
+    drains them in order. Only when all buffers wait to be written does the
+    reader block, the time each side waits for the other is measured. The
+    buffers and the thread are only created once the reader needs them"""
+
+    def __init__(
+        self,
+        fd: int,
+        offset: int,
+        options: WriteOptions,
+        on_written: Callable[[memoryview], None],
+        drop_cache: bool = False,
+    ):
+        super().__init__(fd, offset, options, on_written, drop_cache)
+        self._free: queue.Queue[memoryview] = queue.Queue()
+        self._unallocated = options.write_buffers
+        self._filled: queue.Queue[Tuple[memoryview, int] | None] = queue.Queue()
+        self.error: BaseException | None = None  # of the writer thread
+        self.blocked_on_disk = 0.0  # seconds the reader waited for a free buffer
+        self.blocked_on_network = 0.0  # seconds the writer waited for a full one
+        self._thread = threading.Thread(target=self._drain, name="stream-writer")
+
+    def next_buffer(self) -> memoryview:
+        if self._free.empty() and self._unallocated > 0:
+            self._unallocated -= 1
+            buffer = memoryview(bytearray(self.buffer_size))
+        else:
+            start = time.perf_counter()
+            buffer = self._free.get()
+            self.blocked_on_disk += time.perf_counter() - start
+        if self.error is not None:
+            self._free.put(buffer)
+            raise self.error
+        return buffer
+
+    def submit(self, buffer: memoryview, num_bytes: int):
+        if self._thread.ident is None:
+            self._thread.start()
+        self._filled.put((buffer, num_bytes))
+
+    # writes what was submitted (also if the reader failed, those bytes are
+    # valid), then raises the error of the writer, if any
+    def close(self):
+        if self._thread.ident is not None:
+            self._filled.put(None)
+            self._thread.join()
+        BLOCKED_SECONDS.labels("disk").inc(self.blocked_on_disk)
+        BLOCKED_SECONDS.labels("network").inc(self.blocked_on_network)
+        logger.debug(
+            f"Stream blocked {self.blocked_on_disk:.3f}s on disk, "
+            f"{self.blocked_on_network:.3f}s on network"
+        )
+        super().close()
+        if self.error is not None:
+            raise self.error
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+            return
+        try:  # keep the reader's error
+            self.close()
+        except BaseException:
+            logger.debug("Also the writer failed", exc_info=True)
+
+    def _drain(self):
+        while True:
+            start = time.perf_counter()
+            item = self._filled.get()
+            self.blocked_on_network += time.perf_counter() - start
+            if item is None:
+                return
+            buffer, num_bytes = item
+            if self.error is None:
+                try:
+                    self._write(buffer[:num_bytes])
+                except BaseException as e:
+                    self.error = e  # the reader raises it
+            self._free.put(buffer)  # also after an error, the reader may wait
+
+
+def open_stream_writer(
+    fd: int,
+    offset: int,
+    options: WriteOptions,
+    on_written: Callable[[memoryview], None],
+    drop_cache: bool = False,
+    length: int = -1,
+) -> StreamWriter:
+    # a stream of (at most) length bytes that fits in a couple of buffers is
+    # not worth a thread, the reading thread writes it
+    if options.write_buffers > 1 and not 0 <= length <= 2 * options.buffer_size:
+        return ThreadedStreamWriter(fd, offset, options, on_written, drop_cache)
+    return StreamWriter(fd, offset, options, on_written, drop_cache)
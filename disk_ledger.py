@@ -0,0 +1,88 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientDiskSpace(Exception):
+    pass
+
+
+class DiskReservation:
+    """Disk space claimed by one download: reserve() is called as soon as the
+    expected size is known, on_chunk() for every received chunk (the written
+    bytes show up in the free space, so they no longer need to be reserved).
+    Preallocated blocks show up in the free space at once, on_allocated()
+    releases them, so the chunks written into them are not counted twice"""
+
+    def __init__(self, ledger: "DiskLedger", download_dir: str):
+        self.ledger = ledger
+        self.download_dir = download_dir
+        self.device = os.stat(download_dir).st_dev
+        self.remaining = 0
+        self._allocated = 0  # preallocated bytes that were not written yet
+
+    def reserve(self, num_bytes: int):
+        self.ledger._reserve(self, num_bytes)
+
+    def on_allocated(self, num_bytes: int):
+        with self.ledger._lock:
+            self.remaining = max(0, self.remaining - num_bytes)
+            self._allocated += num_bytes
+
+    def on_chunk(self, num_bytes: int):
+        with self.ledger._lock:
+            in_allocated = min(self._allocated, num_bytes)
+            self._allocated -= in_allocated
+            self.remaining = max(0, self.remaining - (num_bytes - in_allocated))
+
+
+class DiskLedger:
+    """Admission control for the disk space of all downloads in flight (in this
+    worker): a download may only start if its expected size fits in the free
+    space of the volume, minus what the other downloads still need, minus the
+    threshold"""
+
+    def __init__(self, threshold: int, get_bytes_free: Callable[[str], int]):
+        self.threshold = threshold
+        self._get_bytes_free = get_bytes_free
+        self._reservations: Dict[int, set] = {}  # device -> reservations
+        self._lock = threading.Lock()
+
+    # the bytes still needed by the downloads on the volume of path
+    def reserved(self, path: str) -> int:
+        device = os.stat(path).st_dev
+        with self._lock:
+            return sum(r.remaining for r in self._reservations.get(device, set()))
+
+    @contextmanager
+    def reservation(self, download_dir: str) -> Iterator[DiskReservation]:
+        reservation = DiskReservation(self, download_dir)
+        with self._lock:
+            self._reservations.setdefault(reservation.device, set()).add(reservation)
+        try:
+            yield reservation
+        finally:  # released on completion as well as on failure
+            with self._lock:
+                self._reservations[reservation.device].discard(reservation)
+
+    def _reserve(self, reservation: DiskReservation, num_bytes: int):
+        bytes_free = self._get_bytes_free(reservation.download_dir)
+        with self._lock:
+            reserved_by_others = sum(
+                r.remaining
+                for r in self._reservations[reservation.device]
+                if r is not reservation
+            )
+            available = bytes_free - reserved_by_others - self.threshold
+            if num_bytes >= available:
+                raise InsufficientDiskSpace(
+                    f"Cannot reserve {num_bytes} bytes in {reservation.download_dir}"
+                    f" ({available} bytes available above the threshold)"
+                )
+            reservation.remaining = num_bytes
+        logger.info(f"Reserved {num_bytes} bytes in {reservation.download_dir}")
@@ -0,0 +1,161 @@
+import os
+import glob
+import json
+import logging
+from typing import Any, Callable, Dict, List, Tuple
+from model import DownloadMetadata
+
+
+logger = logging.getLogger(__name__)
+SIDECAR_SUFFIX = ".download.json"  # e.g. video.mp4 -> video.mp4.download.json
+# in the names of the files next to a download that are not downloads themselves
+# (sidecars, .part files and their progress, temp files of links and sidecars)
+NOT_DOWNLOAD_MARKERS = [SIDECAR_SUFFIX, ".part", ".tmp", ".link"]
+
+
+def to_sidecar_path(download_file_path: str) -> str:
+    return f"{download_file_path}{SIDECAR_SUFFIX}"
+
+
+def read_sidecar(download_file_path: str) -> DownloadMetadata | None:
+    sidecar_path = to_sidecar_path(download_file_path)
+    if not os.path.exists(sidecar_path):
+        return None
+    try:
+        with open(sidecar_path, "r") as f:
+            return DownloadMetadata.from_json(json.load(f))
+    except (ValueError, TypeError):
+        logger.warning(f"Ignoring corrupt sidecar: {sidecar_path}")
+        return None
+
+
+def write_sidecar(download_file_path: str, metadata: DownloadMetadata):
+    sidecar_path = to_sidecar_path(download_file_path)
+    tmp_path = f"{sidecar_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metadata.to_json(), f)
+    os.replace(tmp_path, sidecar_path)
+
+
+# keeps the payload of the DANE Result saved for doc_id in the sidecar of its
+# download, so it can be copied without searching Elasticsearch (also after a
+# restart of the worker); it goes when the download is replaced
+def record_result(download_file_path: str, doc_id: str, payload: Dict[str, Any]):
+    metadata = read_sidecar(download_file_path)
+    if metadata is None:
+        return
+    metadata.result = {"doc_id": doc_id, "payload": payload}
+    write_sidecar(download_file_path, metadata)
+
+
+# the payload recorded for doc_id in the sidecar of the download, if any
+def recorded_result(download_file_path: str, doc_id: str) -> Dict[str, Any] | None:
+    metadata = read_sidecar(download_file_path)
+    if metadata is None or not metadata.result:
+        return None
+    payload = metadata.result.get("payload") or {}
+    if (
+        metadata.result.get("doc_id") != doc_id
+        or payload.get("file_path") != download_file_path  # e.g. linked into it
+    ):
+        return None
+    return payload
+
+
+# the sidecar is written first, so a file without (matching) sidecar is never
+# considered complete; the rename itself is atomic on the same file system
+def publish_download(
+    tmp_file_path: str, download_file_path: str, metadata: DownloadMetadata
+):
+    logger.info(f"Publishing {tmp_file_path} as {download_file_path}")
+    write_sidecar(download_file_path, metadata)
+    os.replace(tmp_file_path, download_file_path)
+
+
+# returns the sidecar metadata if the file is a complete download of source
+def validate_cached_download(
+    download_file_path: str, source: str
+) -> DownloadMetadata | None:
+    if not os.path.exists(download_file_path):
+        return None
+    metadata = read_sidecar(download_file_path)
+    if metadata is None:
+        logger.warning(f"No sidecar found for {download_file_path}, not trusting it")
+        return None
+    if metadata.source != source:
+        logger.warning(f"{download_file_path} was downloaded from {metadata.source}")
+        return None
+    size = os.path.getsize(download_file_path)
+    if size != metadata.size:
+        logger.warning(
+            f"Size of {download_file_path} ({size}) does not match the sidecar "
+            f"({metadata.size}), not trusting it"
+        )
+        return None
+    return metadata
+
+
+# finds a verified download of source with a path starting with path_prefix, for
+# when the extension is only known after downloading (e.g. from Content-Type)
+def find_cached_download(
+    path_prefix: str, source: str
+) -> Tuple[str, DownloadMetadata] | None:
+    pattern = f"{glob.escape(path_prefix)}*{SIDECAR_SUFFIX}"
+    for sidecar_path in sorted(glob.glob(pattern)):
+        download_file_path = sidecar_path[: -len(SIDECAR_SUFFIX)]
+        metadata = validate_cached_download(download_file_path, source)
+        if metadata:
+            return download_file_path, metadata
+    return None
+
+
+# the verified download of the source at download_file_path or, if that has no
+# extension (one may be added when publishing), with any extension; with
+# describe_source, a download from before sidecars were written may be adopted
+def find_downloaded_file(
+    download_file_path: str,
+    source: str,
+    describe_source: Callable[[str], DownloadMetadata | None] | None = None,
+) -> Tuple[str, DownloadMetadata] | None:
+    if os.path.splitext(download_file_path)[1]:
+        metadata = validate_cached_download(download_file_path, source)
+        found = (download_file_path, metadata) if metadata else None
+    else:
+        found = find_cached_download(download_file_path, source)
+    if found is None and describe_source is not None:
+        return adopt_legacy_download(download_file_path, describe_source)
+    return found
+
+
+# files at download_file_path (or, without extension, with any extension) that
+# have no sidecar, e.g. downloaded by a worker version that wrote none
+def _legacy_downloads(download_file_path: str) -> List[str]:
+    paths = [download_file_path]
+    if not os.path.splitext(download_file_path)[1]:
+        paths += sorted(glob.glob(f"{glob.escape(download_file_path)}.*"))
+    return [
+        path
+        for path in paths
+        if os.path.isfile(path)
+        and not any(m in path[len(download_file_path) :] for m in NOT_DOWNLOAD_MARKERS)
+        and not os.path.exists(to_sidecar_path(path))
+    ]
+
+
+# trusts a legacy download (writing its sidecar) if it has the size the source
+# has now, so existing downloads are not all downloaded again after an upgrade;
+# describe_source gives the metadata of the source for a file path (e.g. from a
+# HEAD request), only called if there is a legacy download
+def adopt_legacy_download(
+    download_file_path: str,
+    describe_source: Callable[[str], DownloadMetadata | None],
+) -> Tuple[str, DownloadMetadata] | None:
+    for legacy_path in _legacy_downloads(download_file_path):
+        metadata = describe_source(legacy_path)
+        if metadata is None or metadata.size != os.path.getsize(legacy_path):
+            logger.info(f"{legacy_path} does not match its source, not adopting it")
+            continue
+        logger.info(f"Adopting {legacy_path}, downloaded without sidecar")
+        write_sidecar(legacy_path, metadata)
+        return legacy_path, metadata
+    return None
@@ -1,81 +1,769 @@
 import os
+import json
 import logging
-import urllib.request as req
-from urllib.error import HTTPError
-import shutil
-from model import DownloadResult, DANEResponse
-from http_util import url_to_output_filename
+import threading
+import requests
+from http.client import HTTPException
+from requests.exceptions import HTTPError, RequestException
+from email.message import Message
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.exceptions import HTTPError as Urllib3Error
+from typing import Any, Callable, Dict, List, Tuple
+from checksum import (
+    ChecksumMismatch,
+    StreamHasher,
+    b64_to_hex,
+    hash_file,
+    verify_checksums,
+)
+from scheduler import OriginLimiter
+from disk_ledger import DiskReservation
+from disk_io import WriteOptions, open_stream_writer, preallocate
+from retry import is_transient_status
+from timing import span
+from content_sniff import ContentSniffer, SniffedType, sniff_file, to_file_info
+from model import DownloadResult, DANEResponse, DownloadProgress, DownloadMetadata
+from http_util import (
+    get_http_session,
+    to_output_filename,
+    url_to_safe_filename,
+)
+from download_cache import find_downloaded_file, publish_download
 
 
 logger = logging.getLogger(__name__)
+DEFAULT_MIN_SEGMENT_SIZE = 64 * 10**6  # don't bother splitting smaller files
+COPY_BUFFER_SIZE = 1024 * 1024  # chunk size of the asyncio engine
+PART_SUFFIX = ".part"  # downloads are streamed into <download_file_path>.part
+PROGRESS_SUFFIX = ".json"  # progress record: <download_file_path>.part.json
+PROGRESS_SAVE_INTERVAL = 16 * 1024 * 1024  # persist progress every 16MB
+RECORDED_HEADERS = [
+    "Content-Type",
+    "Content-Disposition",
+    "Content-Length",
+    "ETag",
+    "Last-Modified",
+    "Content-MD5",
+    "Digest",
+    "x-goog-hash",
+    "x-amz-checksum-crc32c",
+    "x-amz-checksum-sha1",
+    "x-amz-checksum-sha256",
+]
+DIGEST_HEADER_ALGORITHMS = {"md5": "md5", "sha": "sha1", "sha-256": "sha256"}
 
 
-def download_http(target_url, download_dir) -> DownloadResult:
-    download_filename = url_to_output_filename(target_url)
-    download_file_path = os.path.join(download_dir, download_filename)
-    # first check if the file was already downloaded
-    if os.path.exists(download_file_path):
-        return DownloadResult(
-            download_file_path,
-            DANEResponse(201, f"{download_file_path} was already downloaded"),
-            True,
-            {},  # no file_info
-        )
+class SegmentError(Exception):
+    pass
+
+
+# a lost or failed connection while reading the source, raised by requests, by
+# urllib3 or by http.client and the socket underneath it
+CONNECTION_ERRORS = (
+    RequestException,
+    Urllib3Error,
+    HTTPException,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def download_http(
+    target_url: str,
+    download_dir: str,
+    segments: int = 1,
+    min_segment_size: int = DEFAULT_MIN_SEGMENT_SIZE,
+    revalidate: bool = False,
+    session: requests.Session | None = None,
+    checksums: List[str] | None = None,
+    limiter: OriginLimiter | None = None,
+    progress_callback: Callable[[int], None] | None = None,
+    reservation: DiskReservation | None = None,
+    write_options: WriteOptions | None = None,
+) -> DownloadResult:
+    session = session or get_http_session()
+    write_options = write_options or WriteOptions()
+    hasher = StreamHasher(checksums) if checksums else None
+    sniffer = ContentSniffer()  # the format, from the first bytes received
+
+    # without extension in the URL, it is determined from the GET response
+    safe_filename = url_to_safe_filename(target_url)
+    download_file_path = os.path.join(download_dir, safe_filename)
+
+    # first check if the file was (completely) downloaded before
+    cached_result = _find_valid_download(
+        session, target_url, download_file_path, revalidate
+    )
+    if cached_result:
+        return cached_result
 
     already_downloaded = False
     dane_response = None
+    transient = False  # worth another attempt, see retry.py
     file_info = {}
+    digests: Dict[str, str] = {}
+
+    # bytes are streamed into a .part file, which is only renamed when complete
+    part_file_path = f"{download_file_path}{PART_SUFFIX}"
+    progress_file_path = f"{part_file_path}{PROGRESS_SUFFIX}"
+    progress = load_progress(progress_file_path, part_file_path, target_url)
 
     # try to download
     try:
-        with req.urlopen(target_url) as response, open(
-            download_file_path, "wb"
-        ) as out_file:
-            headers = response.info()
-            shutil.copyfileobj(response, out_file)
-            out_size = out_file.tell()
-
-        content_length = int(headers.get("Content-Length", failobj=-1))
-        if content_length > -1 and out_size != content_length:
-            logger.warning("Download incomplete for: {}".format(download_filename))
+        if progress and progress.is_complete():
+            logger.info(f"{part_file_path} is complete, only needs to be published")
+        else:
+            progress = _download_to_part_file(
+                session,
+                target_url,
+                part_file_path,
+                progress_file_path,
+                progress,
+                segments,
+                min_segment_size,
+                hasher,
+                limiter,
+                progress_callback,
+                reservation,
+                write_options,
+                sniffer,
+            )
+
+        out_size = progress.bytes_written()
+        if progress.content_length > -1 and out_size != progress.content_length:
+            logger.warning("Download incomplete for: {}".format(safe_filename))
+            transient = True
             dane_response = DANEResponse(
                 502,
                 "Received incomplete file: {} ({} out of {} bytes)".format(
-                    download_filename, out_size, content_length
+                    safe_filename, out_size, progress.content_length
                 ),
             )
+        else:
+            with span("verify"):
+                digests = verify_part_file(part_file_path, progress, hasher)
 
     except HTTPError as e:
-        error_msg = f"Unkown {e.code} error: {e.reason}"
-        if e.code == 404:
-            error_msg = f"Source returned 404: {e.reason}"
-            dane_response = DANEResponse(404, e.reason)
-        elif e.code == 500:
-            error_msg = f"Source returned 500: {e.reason}"
-            dane_response = DANEResponse(503, error_msg)  # set to 503
-        else:
-            dane_response = DANEResponse(500, error_msg)
-        logger.warning(error_msg)
+        dane_response = http_error_to_dane_response(e)
+        transient = is_transient_status(e.response.status_code)
+    except SegmentError as e:
+        logger.warning(f"Segmented download failed: {str(e)}")
+        dane_response = DANEResponse(502, f"Segmented download failed: {str(e)}")
+        remove_part_file(part_file_path, progress_file_path)  # cannot be resumed
+    except CONNECTION_ERRORS as e:  # the .part file is resumed by the next attempt
+        logger.warning(f"Connection to {target_url} failed: {str(e)}")
+        dane_response = DANEResponse(502, f"Connection to source failed: {str(e)}")
+        transient = True
+    except ChecksumMismatch as e:
+        logger.warning(f"Corrupt download of {target_url}: {str(e)}")
+        dane_response = DANEResponse(502, f"Checksum verification failed: {str(e)}")
+        remove_part_file(part_file_path, progress_file_path)
     else:
-        # download was successful, try to extract the file info from the headers
-        file_info = extract_file_info(headers)
-        dane_response = DANEResponse(200, "Success")
+        # download was successful, publish it and extract the file info
+        if dane_response is None:
+            sniffed = sniffer.sniffed(part_file_path)
+            download_file_path = os.path.join(
+                download_dir,
+                to_output_filename(safe_filename, progress.headers, sniffed),
+            )
+            with span("publish"):
+                file_info = publish_part_file(
+                    part_file_path,
+                    progress_file_path,
+                    download_file_path,
+                    progress,
+                    digests,
+                    sniffed,
+                )
+            dane_response = DANEResponse(200, "Success")
 
     return DownloadResult(
-        download_file_path, dane_response, already_downloaded, file_info
+        download_file_path, dane_response, already_downloaded, file_info, transient
+    )
+
+
+# the earlier download of the target_url, if it is still valid
+def _find_valid_download(
+    session: requests.Session,
+    target_url: str,
+    download_file_path: str,
+    revalidate: bool,
+) -> DownloadResult | None:
+    cached = find_downloaded_file(
+        download_file_path,
+        target_url,
+        lambda file_path: describe_source(session, target_url, file_path),
+    )
+    if not cached:
+        return None
+    cached_file_path, metadata = cached
+    with span("revalidate"):
+        if revalidate and not is_unmodified(session, target_url, metadata):
+            return None
+    return DownloadResult(
+        cached_file_path,
+        DANEResponse(201, f"{cached_file_path} was already downloaded"),
+        True,
+        metadata.file_info,
+    )
+
+
+def http_error_to_dane_response(e: HTTPError) -> DANEResponse:
+    return status_to_dane_response(e.response.status_code, e.response.reason)
+
+
+def status_to_dane_response(code: int, reason: str) -> DANEResponse:
+    error_msg = f"Unkown {code} error: {reason}"
+    if code == 404:
+        error_msg = f"Source returned 404: {reason}"
+        dane_response = DANEResponse(404, reason)
+    elif code == 500:
+        error_msg = f"Source returned 500: {reason}"
+        dane_response = DANEResponse(503, error_msg)  # set to 503
+    else:
+        dane_response = DANEResponse(500, error_msg)
+    logger.warning(error_msg)
+    return dane_response
+
+
+# returns the checksums of the complete .part file, after verifying them against
+# the ones declared by the source
+def verify_part_file(
+    part_file_path: str, progress: DownloadProgress, hasher: StreamHasher | None
+) -> Dict[str, str]:
+    if hasher is None:
+        return {}
+    if hasher.num_bytes != progress.bytes_written():
+        # not hashed while streaming (parallel segments), so read it back
+        hasher = hash_file(part_file_path, StreamHasher(list(hasher.hexdigests())))
+    checksums = hasher.hexdigests()
+    verify_checksums(
+        checksums, extract_declared_checksums(_progress_to_headers(progress))
+    )
+    return checksums
+
+
+# renames the complete .part file and returns the extracted file info
+def publish_part_file(
+    part_file_path: str,
+    progress_file_path: str,
+    download_file_path: str,
+    progress: DownloadProgress,
+    checksums: Dict[str, str],
+    sniffed: SniffedType | None = None,
+) -> Dict[str, Any]:
+    headers = _progress_to_headers(progress)
+    file_info = extract_file_info(headers, sniffed)
+    if checksums:
+        file_info["checksums"] = checksums
+    publish_download(
+        part_file_path,
+        download_file_path,
+        DownloadMetadata(
+            progress.url,
+            progress.bytes_written(),
+            headers.get("ETag", ""),
+            headers.get("Last-Modified", ""),
+            checksums,
+            file_info,
+        ),
+    )
+    _remove_file(progress_file_path)
+    return file_info
+
+
+# conditional HEAD request: a 304 means the cached download is still valid
+def is_unmodified(
+    session: requests.Session, target_url: str, cached: DownloadMetadata
+) -> bool:
+    headers = {}
+    if cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+    if not headers:
+        logger.info(f"No validators known for {target_url}, cannot revalidate")
+        return False
+    try:
+        response = session.head(target_url, headers=headers, allow_redirects=True)
+    except RequestException as e:
+        logger.warning(f"Could not revalidate {target_url} ({str(e)}), using cache")
+        return True
+    if response.status_code == 304:
+        return True
+    if response.ok:
+        logger.info(f"{target_url} was modified since it was downloaded")
+        return False
+    logger.warning(
+        f"Could not revalidate {target_url} ({response.status_code}), using cache"
+    )
+    return True
+
+
+# the metadata a download of the source at file_path would have, from a HEAD
+# request, to adopt a download without sidecar (see adopt_legacy_download)
+def describe_source(
+    session: requests.Session, target_url: str, file_path: str
+) -> DownloadMetadata | None:
+    try:
+        with span("head"):
+            response = session.head(target_url, allow_redirects=True)
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length", -1))
+    except (RequestException, ValueError) as e:
+        logger.info(f"Could not describe {target_url} ({str(e)})")
+        return None
+    content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+    return DownloadMetadata(
+        target_url,
+        size,
+        response.headers.get("ETag", ""),
+        response.headers.get("Last-Modified", ""),
+        {},
+        to_file_info(content_type.lower(), size, sniff_file(file_path)),
+    )
+
+
+# the size the source announces (-1 if unknown), so disk space can be reserved
+# before the download starts
+def head_content_length(session: requests.Session, target_url: str) -> int:
+    try:
+        with span("head"):
+            response = session.head(target_url, allow_redirects=True)
+        response.raise_for_status()
+        return int(response.headers.get("Content-Length", -1))
+    except (RequestException, ValueError) as e:
+        logger.info(f"Could not determine the size of {target_url} ({str(e)})")
+        return -1
+
+
+# (re)starts or continues the download into the .part file
+def _download_to_part_file(
+    session: requests.Session,
+    target_url: str,
+    part_file_path: str,
+    progress_file_path: str,
+    progress: DownloadProgress | None,
+    segments: int,
+    min_segment_size: int,
+    hasher: StreamHasher | None = None,
+    limiter: OriginLimiter | None = None,
+    progress_callback: Callable[[int], None] | None = None,
+    reservation: DiskReservation | None = None,
+    write_options: WriteOptions | None = None,
+    sniffer: ContentSniffer | None = None,
+) -> DownloadProgress:
+    # one connection for the initial request; the ones for the other segments
+    # are reserved once the plan is known, as far as the origin's limit allows
+    # without waiting (fewer segments are planned, or pending segments of a
+    # resumed download are fetched by fewer connections)
+    limiter = limiter or OriginLimiter()
+    with limiter.connections(1):
+        with span("request"):  # until the response headers are in
+            response = _open_initial_request(session, target_url, progress)
+        with response:
+            headers = response.headers
+            resume = progress is not None and response.status_code == 206
+            if progress is None or not resume:
+                if progress:
+                    logger.info(f"Source changed, restarting download of {target_url}")
+                progress = new_progress(target_url, headers, segments, min_segment_size)
+            else:
+                logger.info(
+                    f"Resuming download of {target_url} at "
+                    f"{progress.bytes_written()} bytes"
+                )
+
+            callbacks: List[Callable[[int], None]] = [limiter.throttle]
+            if progress_callback is not None:
+                callbacks.append(progress_callback)
+            if reservation is not None:  # raises InsufficientDiskSpace
+                reservation.reserve(
+                    progress.content_length - progress.bytes_written()
+                    if progress.content_length > -1
+                    else 0  # unknown size, at least check the threshold
+                )
+                callbacks.append(reservation.on_chunk)
+            wanted = len(progress.pending_segments()) - 1
+            with limiter.available_connections(wanted) as extra_connections:
+                if not resume and extra_connections < wanted:
+                    progress = new_progress(
+                        target_url, headers, 1 + extra_connections, min_segment_size
+                    )
+                with span("transfer") as transfer:
+                    bytes_before = progress.bytes_written()
+                    try:
+                        download_segments(
+                            session,
+                            target_url,
+                            response,
+                            part_file_path,
+                            progress_file_path,
+                            progress,
+                            resume,
+                            hasher,
+                            callbacks,
+                            write_options,
+                            sniffer,
+                            reservation,
+                            1 + extra_connections,
+                        )
+                    finally:
+                        transfer.num_bytes = progress.bytes_written() - bytes_before
+    return progress
+
+
+# opens the full source or, when resuming, the remainder of the first incomplete
+# segment (If-Range makes the server send the full source again if it changed)
+def _open_initial_request(
+    session: requests.Session, target_url: str, progress: DownloadProgress | None
+) -> requests.Response:
+    headers = {}
+    if progress is not None:
+        start, _, written = progress.segments[progress.pending_segments()[0]]
+        headers = {"Range": f"bytes={start + written}-", "If-Range": progress.validator}
+    response = session.get(target_url, headers=headers, stream=True)
+    if progress is not None and response.status_code == 416:
+        logger.warning(f"Cannot resume {target_url}, restarting download")
+        response.close()
+        response = session.get(target_url, stream=True)
+    response.raise_for_status()
+    return response
+
+
+def new_progress(
+    target_url: str, resp_headers, segments: int, min_segment_size: int
+) -> DownloadProgress:
+    content_length = int(resp_headers.get("Content-Length", -1))
+    num_segments = determine_num_segments(resp_headers, segments, min_segment_size)
+    if num_segments > 1:
+        ranges = split_into_segments(content_length, num_segments)
+    else:
+        ranges = [(0, content_length - 1 if content_length > 0 else -1)]
+
+    # weak ETags cannot be used in If-Range, so fall back on Last-Modified
+    etag = resp_headers.get("ETag", "")
+    validator = etag if etag and not etag.startswith("W/") else ""
+    return DownloadProgress(
+        target_url,
+        validator or resp_headers.get("Last-Modified", ""),
+        content_length,
+        {k: resp_headers[k] for k in RECORDED_HEADERS if k in resp_headers},
+        [[start, end, 0] for start, end in ranges],
+    )
+
+
+# the progress record is only usable if it matches the .part file and the URL
+def load_progress(
+    progress_file_path: str, part_file_path: str, target_url: str
+) -> DownloadProgress | None:
+    if not os.path.exists(progress_file_path) or not os.path.exists(part_file_path):
+        return None
+    try:
+        with open(progress_file_path, "r") as f:
+            progress = DownloadProgress.from_json(json.load(f))
+    except (ValueError, TypeError):
+        logger.warning(f"Ignoring corrupt progress record: {progress_file_path}")
+        return None
+    part_size = os.path.getsize(part_file_path)
+    if (
+        progress.url != target_url
+        or not progress.validator
+        or any(start + written > part_size for start, _, written in progress.segments)
+    ):
+        logger.info(f"Progress record does not match {part_file_path}, ignoring it")
+        return None
+    return progress
+
+
+def save_progress(progress_file_path: str, progress: DownloadProgress):
+    tmp_file_path = f"{progress_file_path}.tmp"
+    with open(tmp_file_path, "w") as f:
+        json.dump(progress.to_json(), f)
+    os.replace(tmp_file_path, progress_file_path)
+
+
+class ProgressTracker:
+    """Thread-safe bookkeeping of the bytes written per segment, persisted to the
+    progress record every PROGRESS_SAVE_INTERVAL bytes, so a restarted worker
+    only has to fetch what is missing. Every chunk passes through here, so the
+    callbacks get its size too when it is received (e.g. to throttle the
+    bandwidth, for metrics)"""
+
+    def __init__(
+        self,
+        progress: DownloadProgress,
+        progress_file_path: str,
+        hasher: StreamHasher | None = None,
+        callbacks: List[Callable[[int], None]] | None = None,
+        sniffer: ContentSniffer | None = None,
+    ):
+        self.progress = progress
+        self.progress_file_path = progress_file_path
+        self.hasher = hasher  # only for single stream downloads
+        self.callbacks = callbacks or []
+        self.sniffer = sniffer  # gets the first bytes (segment 0 starts at 0)
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+    def add(self, segment_index: int, chunk: bytes):
+        self.written(segment_index, chunk)
+        self.received(len(chunk))
+
+    # once the chunk is in the file
+    def written(self, segment_index: int, chunk):
+        with self._lock:
+            if self.hasher is not None:
+                self.hasher.update(chunk)
+            if self.sniffer is not None and segment_index == 0:
+                self.sniffer.feed(self.progress.segments[0][2], chunk)
+            self.progress.segments[segment_index][2] += len(chunk)
+            self._unsaved += len(chunk)
+            if self._unsaved >= PROGRESS_SAVE_INTERVAL:
+                self._save()
+
+    # once the chunk is read from the network (may block, e.g. to throttle)
+    def received(self, num_bytes: int):
+        for callback in self.callbacks:
+            callback(num_bytes)
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._unsaved = 0
+        if self.progress.validator:  # without it a resume would not be safe
+            save_progress(self.progress_file_path, self.progress)
+
+
+# returns the number of parallel Range requests to use (1 means: single stream)
+def determine_num_segments(resp_headers, segments: int, min_segment_size: int) -> int:
+    if segments < 2:
+        return 1
+    if resp_headers.get("Accept-Ranges", "").lower() != "bytes":
+        logger.info("Server does not support byte ranges, using single stream")
+        return 1
+    if resp_headers.get("Content-Encoding", "identity").lower() != "identity":
+        logger.info("Encoded response, using single stream")
+        return 1
+    content_length = int(resp_headers.get("Content-Length", -1))
+    if content_length <= 0:
+        return 1
+    return max(1, min(segments, content_length // max(1, min_segment_size)))
+
+
+# splits [0, size) into num_segments inclusive (start, end) byte ranges
+def split_into_segments(size: int, num_segments: int) -> List[Tuple[int, int]]:
+    segment_size, remainder = divmod(size, num_segments)
+    ranges = []
+    start = 0
+    for i in range(num_segments):
+        end = start + segment_size + (1 if i < remainder else 0)
+        if end > start:
+            ranges.append((start, end - 1))
+        start = end
+    return ranges
+
+
+# the first incomplete segment is read from the already opened response, the
+# others are fetched with Range requests (on at most num_connections in total,
+# one after the other with a single connection) and written at their offset
+def download_segments(
+    session: requests.Session,
+    target_url: str,
+    first_response,
+    part_file_path: str,
+    progress_file_path: str,
+    progress: DownloadProgress,
+    resume: bool,
+    hasher: StreamHasher | None = None,
+    callbacks: List[Callable[[int], None]] | None = None,
+    write_options: WriteOptions | None = None,
+    sniffer: ContentSniffer | None = None,
+    reservation: DiskReservation | None = None,
+    num_connections: int | None = None,
+):
+    write_options = write_options or WriteOptions()
+    pending = progress.pending_segments()
+    workers = min(num_connections or len(pending), len(pending)) - 1
+    logger.info(f"Downloading {target_url} in {len(pending)} segment(s)")
+
+    # only a single stream arrives in order, so it can be hashed while streaming
+    if hasher is not None and len(progress.segments) == 1:
+        if resume:  # first catch up on the bytes of the earlier attempt
+            hash_file(part_file_path, hasher, progress.bytes_written())
+    else:
+        hasher = None
+    tracker = ProgressTracker(progress, progress_file_path, hasher, callbacks, sniffer)
+    with open(part_file_path, "r+b" if resume else "wb") as out_file:
+        fd = out_file.fileno()
+        if not resume and progress.content_length > 0:
+            _allocate(out_file, progress, write_options, reservation)
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                futures = [
+                    executor.submit(
+                        _download_range,
+                        session,
+                        target_url,
+                        fd,
+                        tracker,
+                        i,
+                        progress.validator,
+                        write_options,
+                    )
+                    for i in (pending[1:] if workers > 0 else [])
+                ]
+                _copy_range(first_response, fd, tracker, pending[0], write_options)
+                first_response.close()  # discard the rest of the body
+                for f in futures:
+                    f.result()
+            if workers < 1:  # one connection: the other segments after the first
+                for i in pending[1:]:
+                    _download_range(
+                        session,
+                        target_url,
+                        fd,
+                        tracker,
+                        i,
+                        progress.validator,
+                        write_options,
+                    )
+            if write_options.fsync:  # before the progress says it is complete
+                with span("fsync"):
+                    os.fdatasync(fd)
+        finally:
+            tracker.save()  # also after errors, so the download can be resumed
+
+
+# allocates the whole file up front, or else makes it sparse for the offsets
+def _allocate(
+    out_file,
+    progress: DownloadProgress,
+    write_options: WriteOptions,
+    reservation: DiskReservation | None,
+):
+    preallocated = write_options.preallocate and preallocate(
+        out_file.fileno(), progress.content_length
     )
+    if preallocated and reservation is not None:
+        reservation.on_allocated(progress.content_length)
+    if not preallocated and len(progress.segments) > 1:
+        out_file.truncate(progress.content_length)
+
+
+def _download_range(
+    session: requests.Session,
+    target_url: str,
+    fd: int,
+    tracker: ProgressTracker,
+    segment_index: int,
+    validator: str,
+    write_options: WriteOptions,
+):
+    start, end, written = tracker.progress.segments[segment_index]
+    headers = {"Range": f"bytes={start + written}-{end}"}
+    if validator:
+        headers["If-Range"] = validator  # the source must not change in between
+    with session.get(target_url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise SegmentError(
+                f"Expected 206 for bytes {start + written}-{end}, "
+                f"got {response.status_code}"
+            )
+        _copy_range(response, fd, tracker, segment_index, write_options)
+
+
+# reads into reusable buffers, which are written at their offset (by a writer
+# thread, see ThreadedStreamWriter); urllib3 reads each chunk as a bytes object
+# first, one copy that keeps its connection handling (and pool) intact
+def _copy_range(
+    response: requests.Response,
+    fd: int,
+    tracker: ProgressTracker,
+    segment_index: int,
+    write_options: WriteOptions,
+):
+    start, end, written = tracker.progress.segments[segment_index]
+    offset = start + written
+    with open_stream_writer(
+        fd,
+        offset,
+        write_options,
+        lambda chunk: tracker.written(segment_index, chunk),
+        write_options.drops_cache(tracker.progress.content_length),
+        end - offset + 1 if end > -1 else -1,
+    ) as writer:
+        while end == -1 or offset <= end:
+            buffer = writer.next_buffer()
+            to_read = len(buffer) if end == -1 else min(len(buffer), end - offset + 1)
+            num_bytes = response.raw.readinto(buffer[:to_read])
+            if not num_bytes:
+                break
+            writer.submit(buffer, num_bytes)
+            tracker.received(num_bytes)
+            offset += num_bytes
+
 
+# the file info is based on the headers of the complete (first) response
+def _progress_to_headers(progress: DownloadProgress) -> Message:
+    headers = Message()
+    for k, v in progress.headers.items():
+        headers[k] = v
+    return headers
 
-def extract_file_info(resp_headers):
+
+# checksums the source itself provides (base64 encoded), converted to hex
+def extract_declared_checksums(resp_headers) -> Dict[str, str]:
+    declared = {}
+    if resp_headers.get("Content-MD5"):
+        declared["md5"] = resp_headers["Content-MD5"]
+    # RFC 3230, e.g. Digest: SHA-256=X48E9q...=,MD5=HUXZLQ...==
+    for alg, value in _split_header_values(resp_headers.get("Digest", "")):
+        if alg.lower() in DIGEST_HEADER_ALGORITHMS:
+            declared[DIGEST_HEADER_ALGORITHMS[alg.lower()]] = value
+    # Google Cloud Storage, e.g. x-goog-hash: crc32c=n03x6A==,md5=Ojk9c3...==
+    for alg, value in _split_header_values(resp_headers.get("x-goog-hash", "")):
+        if alg.lower() in ["crc32c", "md5"]:
+            declared[alg.lower()] = value
+    # S3 (e.g. presigned URLs); multipart uploads have composite "<b64>-<n>" ones
+    for alg in ["crc32c", "sha1", "sha256"]:
+        value = resp_headers.get(f"x-amz-checksum-{alg}", "")
+        if value and "-" not in value:
+            declared[alg] = value
+
+    checksums = {}
+    for alg, value in declared.items():
+        hex_value = b64_to_hex(value)
+        if hex_value:
+            checksums[alg] = hex_value
+    return checksums
+
+
+# "a=1, b=2" -> [("a", "1"), ("b", "2")]; base64 values may end with "="
+def _split_header_values(header_value: str) -> List[Tuple[str, str]]:
+    values = []
+    for item in header_value.split(","):
+        alg, sep, value = item.strip().partition("=")
+        if sep and value:
+            values.append((alg, value))
+    return values
+
+
+def remove_part_file(part_file_path: str, progress_file_path: str):
+    logger.info(f"Removing unusable partial download: {part_file_path}")
+    _remove_file(part_file_path)
+    _remove_file(progress_file_path)
+
+
+def _remove_file(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def extract_file_info(resp_headers, sniffed: SniffedType | None = None):
     content_length = int(resp_headers.get("Content-Length", failobj=-1))
     c_type = resp_headers.get_content_type()  # TODO filter for allowed content-types?
-    if "/" in c_type:
-        file_type = c_type.split("/")[0]
-    else:
-        logger.warning("Handling unknown file type: {}".format(c_type))
-        file_type = "unknown"
-    return {
-        "file_type": file_type,
-        "Content-Type": c_type,
-        "Content-Length": content_length,
-    }
+    return to_file_info(c_type, content_length, sniffed)
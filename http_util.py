@@ -4,23 +4,82 @@ import requests
 import unicodedata
 import uuid
 import string
+from functools import lru_cache
+from typing import Mapping, Tuple
 from urllib.parse import unquote, urlparse
-from urllib3.response import HTTPResponse
-from requests import Response
+from requests.adapters import HTTPAdapter
+from content_sniff import SniffedType
 
 logger = logging.getLogger(__name__)
+# used when the format could not be recognized from the content itself
+EXTENSIONS_BY_CONTENT_TYPE = {
+    "video/mp4": ".mp4",
+    "video/x-msvideo": ".avi",
+    "video/x-ms-wmv": ".wmv",
+    "audio/mpeg": ".mp3",
+    "audio/wav": ".wav",
+    "audio/midi": ".mid",
+    "application/mxf": ".mxf",
+    "text/html": ".html",
+}
 VALID_FILENAME_CHARS = "-_. {}{}".format(string.ascii_letters, string.digits)
+DEFAULT_POOL_CONNECTIONS = 10  # number of hosts to keep a connection pool for
+DEFAULT_POOL_MAXSIZE = 10  # number of connections to keep per host
+DEFAULT_CONNECT_TIMEOUT = 10.0  # seconds
+DEFAULT_READ_TIMEOUT = 60.0  # seconds without receiving any bytes
+HTTP_ENGINE_THREADS = "threads"  # download_http, one blocking task thread each
+HTTP_ENGINE_ASYNCIO = "asyncio"  # AsyncHttpEngine, all downloads on one event loop
+HTTP_ENGINES = [HTTP_ENGINE_THREADS, HTTP_ENGINE_ASYNCIO]
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Sends the requests without a timeout of their own with (connect, read)
+    timeouts, so a stalled source fails the download (as a connection error,
+    which is retried) instead of hanging it"""
+
+    def __init__(self, timeout: Tuple[float, float], **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+# one session (with keep-alive connection pools) for all HTTP traffic of the
+# process, so connections and TLS sessions are reused between tasks
+@lru_cache(maxsize=None)
+def get_http_session(
+    pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    read_timeout: float = DEFAULT_READ_TIMEOUT,
+) -> requests.Session:
+    logger.info(
+        f"Initiating HTTP session (pool_connections={pool_connections}, "
+        f"pool_maxsize={pool_maxsize}, timeouts={connect_timeout}s/{read_timeout}s)"
+    )
+    session = requests.Session()
+    # we store the exact bytes of the source, also needed for Range requests
+    session.headers["Accept-Encoding"] = "identity"
+    adapter = TimeoutHTTPAdapter(
+        (connect_timeout, read_timeout),
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
-def determine_url_extension(url: str):
-    return determine_stream_extension(requests.head(url))
-
-
-# determine the file extension of the requested content via Content-Type and Content-Disposition
-def determine_stream_extension(http_resp: HTTPResponse | Response) -> str:
-    logger.info("Determining stream extension from http headers")
-    content_type = http_resp.headers.get("Content-Type", "")
-    content_disposition = http_resp.headers.get("Content-Disposition", "")
+# determine the file extension of the requested content via Content-Disposition,
+# the format sniffed from the content (if known) or else Content-Type
+def determine_extension_from_headers(
+    headers: Mapping, sniffed: SniffedType | None = None
+) -> str:
+    content_type = headers.get("Content-Type", "")
+    content_disposition = headers.get("Content-Disposition", "")
     logger.info(
         f"Content-Type: {content_type}; Content-Disposition: {content_disposition}"
     )
@@ -29,31 +88,16 @@ def determine_stream_extension(http_resp: HTTPResponse | Response) -> str:
     ext = extract_extension_from_content_disposition(content_disposition)
     if ext:
         return ext
+    if sniffed is not None:
+        logger.info(f"Content sniffed as {sniffed.mime_type}")
+        return sniffed.extension
 
     logger.info(f"Determine extension based on mime_type {content_type}")
-    # try to determine the extension based on the mime_type (taken from Content-Type)
-    # TODO this could be done much more completely with a good mime_type lib
-    if content_type.find("video/mp4") != -1:
-        ext = ".mp4"
-    elif content_type.find("video/x-msvideo") != -1:
-        ext = ".avi"
-    elif content_type.find("video/x-ms-wmv") != -1:
-        ext = ".wmv"
-    elif content_type.find("audio/mpeg") != -1:
-        ext = ".mp3"
-    elif content_type.find("audio/wav") != -1:
-        ext = ".wav"
-    elif content_type.find("audio/midi") != -1:
-        ext = ".mid"
-    elif content_type.find("application/mxf") != -1:
-        ext = ".mxf"
-    elif content_type.find("text/html") != -1:
-        ext = ".html"
-    else:
-        logger.warning(f"No supported extension found! (content_type={content_type})")
-        return ""
-
-    return ext
+    for mime_type, ext in EXTENSIONS_BY_CONTENT_TYPE.items():
+        if mime_type in content_type:
+            return ext
+    logger.warning(f"No supported extension found! (content_type={content_type})")
+    return ""
 
 
 # see: https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Disposition
@@ -82,15 +126,19 @@ def extract_extension_from_content_disposition(content_disposition: str) -> str:
     return ""
 
 
-def url_to_output_filename(target_url: str) -> str:
-    download_filename = url_to_safe_filename(target_url)
-    fn, ext = os.path.splitext(download_filename)
-    if not ext:
-        logger.info("No extension in URL, determining extension with HEAD request")
-        extension = determine_url_extension(target_url)  # includes .
-        download_filename += f"{extension}"
+# adds the extension (from the response headers or the content) if the filename
+# has none
+def to_output_filename(
+    safe_filename: str, resp_headers: Mapping, sniffed: SniffedType | None = None
+) -> str:
+    if has_extension(safe_filename):
+        return safe_filename
+    return f"{safe_filename}{determine_extension_from_headers(resp_headers, sniffed)}"
+
 
-    return download_filename
+def has_extension(filename: str) -> bool:
+    fn, ext = os.path.splitext(filename)
+    return ext != ""
 
 
 def url_to_safe_filename(url: str) -> str:
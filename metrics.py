@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+
+logger = logging.getLogger(__name__)
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+THROUGHPUT_BUCKETS = tuple(
+    10**6 * mb for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
+DOWNLOAD_DURATION = Histogram(
+    "dane_download_duration_seconds",
+    "Duration of (fresh) downloads",
+    ["source_type", "host"],
+    buckets=DURATION_BUCKETS,
+)
+DOWNLOAD_THROUGHPUT = Histogram(
+    "dane_download_throughput_bytes_per_second",
+    "Average throughput of (fresh) downloads",
+    ["source_type", "host"],
+    buckets=THROUGHPUT_BUCKETS,
+)
+RESPONSES = Counter(
+    "dane_download_responses", "DANE responses returned by the worker", ["state"]
+)
+CACHE_HITS = Counter(
+    "dane_download_cache_hits",
+    "Tasks served without downloading (download dir or content store)",
+    ["source_type", "cache"],
+)
+BYTES_IN_FLIGHT = Gauge(
+    "dane_download_bytes_in_flight", "Bytes received by the running downloads"
+)
+BLOCKED_SECONDS = Counter(
+    "dane_download_blocked_seconds",
+    "Time the network reader of a stream waited for its disk writer (side=disk) "
+    "and the other way around (side=network)",
+    ["side"],
+)
+BYTES_FREE = Gauge(
+    "dane_download_bytes_free", "Free bytes on the volume of the last download dir"
+)
+
+
+def start_metrics_server(port: int):
+    logger.info(f"Serving metrics on port {port}")
+    start_http_server(port)
+
+
+class DownloadMeter:
+    """Measures one download: its bytes are in flight while it runs (on_chunk
+    is called for each received chunk) and, if it was a fresh download, its
+    duration and throughput are observed"""
+
+    def __init__(self, source_type: str, host: str):
+        self.source_type = source_type
+        self.host = host
+        self.num_bytes = 0
+        self._lock = threading.Lock()  # chunks arrive from several threads
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        BYTES_IN_FLIGHT.dec(self.num_bytes)
+
+    def on_chunk(self, num_bytes: int):
+        with self._lock:
+            self.num_bytes += num_bytes
+        BYTES_IN_FLIGHT.inc(num_bytes)
+
+    # only the bytes received now count, not those of an earlier attempt
+    def observe(self):
+        duration = time.monotonic() - self._start
+        DOWNLOAD_DURATION.labels(self.source_type, self.host).observe(duration)
+        if self.num_bytes > 0 and duration > 0:
+            DOWNLOAD_THROUGHPUT.labels(self.source_type, self.host).observe(
+                self.num_bytes / duration
+            )
@@ -1,5 +1,5 @@
-from dataclasses import dataclass
-from typing import Dict, Any
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List
 
 
 @dataclass
@@ -17,3 +17,65 @@ class DownloadResult:
     dane_response: DANEResponse
     already_downloaded: bool
     file_info: Dict[str, Any]
+    transient: bool = False  # failed in a way another attempt may not (e.g. a 503)
+
+
+@dataclass
+class PreparedDownload:  # a task resolved before its transfer, see worker.py
+    target_url: str
+    is_s3: bool
+    download_dir: str
+    download_path: str  # without extension for HTTP (determined when downloading)
+    http_engine: str
+    cached: bool  # a verified download of the source is in the download dir
+    expected_size: int = -1  # -1 if unknown
+    s3_head: Any = None  # the s3_download.ObjectHead of an S3 source
+
+
+@dataclass
+class DownloadProgress:
+    url: str
+    validator: str  # ETag or Last-Modified of the source, used for If-Range
+    content_length: int  # -1 if unknown
+    headers: Dict[str, str]  # relevant headers of the (first) full response
+    segments: List[List[int]]  # [start, end (-1 if unknown), bytes written]
+
+    def to_json(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @staticmethod
+    def from_json(json_data: Dict[str, Any]) -> "DownloadProgress":
+        return DownloadProgress(**json_data)
+
+    # indices of the segments that still need bytes (open ended ones always do)
+    def pending_segments(self) -> List[int]:
+        return [
+            i
+            for i, (start, end, written) in enumerate(self.segments)
+            if end == -1 or start + written <= end
+        ]
+
+    def is_complete(self) -> bool:
+        return len(self.pending_segments()) == 0
+
+    def bytes_written(self) -> int:
+        return sum(written for _, _, written in self.segments)
+
+
+@dataclass
+class DownloadMetadata:  # stored next to each download, see download_cache.py
+    source: str  # URL or S3 URI
+    size: int
+    etag: str
+    last_modified: str
+    checksums: Dict[str, str]  # algorithm -> hex digest
+    file_info: Dict[str, Any]
+    # doc_id and payload of the DANE Result saved for it, see record_result
+    result: Dict[str, Any] | None = None
+
+    def to_json(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @staticmethod
+    def from_json(json_data: Dict[str, Any]) -> "DownloadMetadata":
+        return DownloadMetadata(**json_data)
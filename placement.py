@@ -0,0 +1,82 @@
+import hashlib
+import itertools
+import logging
+import os
+from typing import Callable, List
+
+
+logger = logging.getLogger(__name__)
+PLACEMENT_MOST_FREE = "most_free"  # the root with the most bytes available
+PLACEMENT_ROUND_ROBIN = "round_robin"
+PLACEMENT_HASH = "hash"  # rendezvous hashing on the doc id
+PLACEMENT_POLICIES = [PLACEMENT_MOST_FREE, PLACEMENT_ROUND_ROBIN, PLACEMENT_HASH]
+
+
+# free bytes on the volume of path, might only work on Unix
+def volume_bytes_free(path: str) -> int:
+    disk_stats = os.statvfs(path)
+    return disk_stats.f_frsize * disk_stats.f_bfree
+
+
+class DownloadRoots:
+    """The dirs (e.g. mounts of different disks or NFS exports) the downloads
+    are spread over, each doc getting a dir (its DANE TEMP_FOLDER path) under
+    one of them. A doc that already has a dir under a root stays there, so its
+    download is found (or resumed) whatever the policy; the others are placed
+    by the policy among the roots that are mounted (exist). With create_roots
+    (for the single PATHS.TEMP_FOLDER, like DANE does) missing roots are
+    created instead"""
+
+    def __init__(
+        self,
+        roots: List[str],
+        policy: str = PLACEMENT_MOST_FREE,
+        get_bytes_available: Callable[[str], int] = volume_bytes_free,
+        create_roots: bool = False,
+    ):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.policy = policy
+        self._get_bytes_available = get_bytes_available
+        self.create_roots = create_roots
+        self._next = itertools.count()  # thread-safe in CPython
+
+    # the dir for doc_id, relative_dir under the chosen root (created if
+    # needed), None if no root is available
+    def place(self, doc_id: str, relative_dir: str) -> str | None:
+        for root in self.roots:
+            if os.path.isdir(os.path.join(root, relative_dir)):
+                return os.path.join(root, relative_dir)
+        if self.create_roots:
+            for root in self.roots:
+                os.makedirs(root, exist_ok=True)
+        available = [root for root in self.roots if os.path.isdir(root)]
+        if len(available) < len(self.roots):
+            logger.warning(
+                "Download roots not available: "
+                + ", ".join(set(self.roots) - set(available))
+            )
+        if not available:
+            return None
+        download_dir = os.path.join(self._choose(doc_id, available), relative_dir)
+        os.makedirs(download_dir, exist_ok=True)
+        return download_dir
+
+    def _choose(self, doc_id: str, roots: List[str]) -> str:
+        if self.policy == PLACEMENT_ROUND_ROBIN:
+            return roots[next(self._next) % len(roots)]
+        if self.policy == PLACEMENT_HASH:
+            # only the docs of an added or removed root move to another one
+            return max(roots, key=lambda root: _weight(root, doc_id))
+        return max(roots, key=self._get_bytes_available)
+
+    # the root path is under, None if it is under none of them
+    def root_of(self, path: str) -> str | None:
+        path = os.path.abspath(path)
+        return next(
+            (r for r in self.roots if os.path.commonpath([r, path]) == r),
+            None,
+        )
+
+
+def _weight(root: str, doc_id: str) -> bytes:
+    return hashlib.md5(f"{root}\n{doc_id}".encode("utf-8")).digest()
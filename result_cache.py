@@ -0,0 +1,93 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_TTL = 7 * 24 * 3600  # seconds
+DEFAULT_MAX_ENTRIES = 100000
+IN_MEMORY = ":memory:"
+EVICT_INTERVAL = 1000  # puts between evictions, so each put stays cheap
+
+
+class ResultCache:
+    """doc_id -> payload of the DOWNLOAD result this worker saved for it, so a
+    task for an already downloaded file can copy it without searching
+    Elasticsearch. Kept in a SQLite file (or in memory), entries expire after
+    ttl seconds and the least recently used ones are evicted beyond
+    max_entries (checked every EVICT_INTERVAL puts)"""
+
+    def __init__(
+        self,
+        path: str = IN_MEMORY,
+        ttl: int = DEFAULT_TTL,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()  # one connection, shared by the task threads
+        self._puts = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")  # cheap commits, it is a cache
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (doc_id TEXT PRIMARY KEY, "
+                "payload TEXT NOT NULL, saved_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)"
+            )
+            self._evict()
+        logger.info(f"Using result cache: {path}")
+
+    def get(self, doc_id: str) -> Dict[str, Any] | None:
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT payload, saved_at FROM results WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            payload, saved_at = row
+            if saved_at < now - self.ttl:
+                self._db.execute("DELETE FROM results WHERE doc_id = ?", (doc_id,))
+                return None
+            self._db.execute(
+                "UPDATE results SET used_at = ? WHERE doc_id = ?", (now, doc_id)
+            )
+        try:
+            return json.loads(payload)
+        except ValueError:
+            logger.warning(f"Ignoring corrupt cached result of {doc_id}")
+            return None
+
+    def put(self, doc_id: str, payload: Dict[str, Any]):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (doc_id, json.dumps(payload), now, now),
+            )
+            self._puts += 1
+            if self._puts % EVICT_INTERVAL == 0:
+                self._evict()
+
+    # removes the expired entries and the least recently used ones
+    def _evict(self):
+        self._db.execute(
+            "DELETE FROM results WHERE saved_at < ?", (time.time() - self.ttl,)
+        )
+        self._db.execute(
+            "DELETE FROM results WHERE doc_id IN (SELECT doc_id FROM results "
+            "ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
@@ -0,0 +1,165 @@
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict
+from model import DownloadResult
+
+
+logger = logging.getLogger(__name__)
+# statuses of the source worth another attempt (timeout, throttling, 5xx)
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 1.0  # seconds
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60.0  # seconds
+
+
+def is_transient_status(status_code: int) -> bool:
+    return status_code in TRANSIENT_STATUS_CODES
+
+
+class CircuitOpen(Exception):
+    def __init__(self, origin: str, retry_after: float):
+        super().__init__(f"{origin} is failing, retry after {retry_after:.0f}s")
+        self.origin = origin
+        self.retry_after = retry_after
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS  # 1 means no retries
+    base_delay: float = DEFAULT_BASE_DELAY
+    max_delay: float = DEFAULT_MAX_DELAY
+
+    # "full jitter": a random delay up to the exponential backoff, so the
+    # retries of tasks that failed together do not hit the origin together
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    """Stops sending requests to an origin after failure_threshold transient
+    failures in a row: for reset_timeout seconds, attempts fail fast with
+    CircuitOpen. Then a single attempt may probe the origin, which closes the
+    circuit if it succeeds and opens it again if it fails"""
+
+    def __init__(
+        self,
+        origin: str,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,  # 0 means never open
+        reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.origin = origin
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # seconds until attempts are allowed again (0 if they are now)
+    def retry_after(self) -> float:
+        with self._lock:
+            return self._retry_after()
+
+    # raises CircuitOpen if the attempt must not be made
+    def before_attempt(self):
+        with self._lock:
+            retry_after = self._retry_after()
+            if retry_after > 0:
+                raise CircuitOpen(self.origin, retry_after)
+            if self._opened_at is not None:
+                self._probing = True  # this attempt probes the origin
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"{self.origin} recovered, closing its circuit")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    # the attempt ended without an outcome for the origin (e.g. the disk is
+    # full), so a probe must not keep the circuit waiting for it
+    def abandon_attempt(self):
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (
+                0 < self.failure_threshold <= self._failures and self._opened_at is None
+            ):
+                logger.warning(
+                    f"{self.origin} failed {self._failures} times in a row, "
+                    f"failing fast for {self.reset_timeout:.0f}s"
+                )
+                self._opened_at = self._clock()
+                self._probing = False
+
+    def _retry_after(self) -> float:
+        if self._opened_at is None:
+            return 0
+        remaining = self._opened_at + self.reset_timeout - self._clock()
+        if self._probing:  # wait for the outcome of the probe
+            return max(remaining, 1.0)
+        return max(remaining, 0)
+
+
+class CircuitBreakers:
+    """A CircuitBreaker per origin, shared by all tasks"""
+
+    def __init__(
+        self,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker_for(self, origin: str) -> CircuitBreaker:
+        with self._lock:
+            if origin not in self._breakers:
+                self._breakers[origin] = CircuitBreaker(
+                    origin, self.failure_threshold, self.reset_timeout
+                )
+            return self._breakers[origin]
+
+
+# retries the download while it fails transiently (see DownloadResult.transient),
+# with backoff; raises CircuitOpen if the origin is failing fast already
+def download_with_retries(
+    download: Callable[[], DownloadResult],
+    policy: RetryPolicy,
+    breaker: CircuitBreaker,
+    sleep: Callable[[float], None] = time.sleep,
+) -> DownloadResult:
+    attempt = 0
+    while True:
+        breaker.before_attempt()
+        try:
+            result = download()
+        except BaseException:  # e.g. InsufficientDiskSpace, raised on purpose
+            breaker.abandon_attempt()
+            raise
+        if not result.transient:
+            breaker.record_success()  # also for e.g. a 404: the origin responds
+            return result
+        breaker.record_failure()
+        attempt += 1
+        if attempt >= policy.max_attempts or breaker.retry_after() > 0:
+            return result  # out of attempts, or the origin is failing fast now
+        delay = policy.delay(attempt - 1)
+        logger.warning(
+            f"Attempt {attempt} failed ({result.dane_response.message}), "
+            f"retrying in {delay:.1f}s"
+        )
+        sleep(delay)
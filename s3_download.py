@@ -1,12 +1,207 @@
+from __future__ import annotations
 import logging
-import boto3
+import math
 import os
-from typing import Tuple
-from model import DownloadResult, DANEResponse
+from functools import lru_cache, partial
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
+from base_util import parse_file_size
+from checksum import (
+    ChecksumMismatch,
+    HashingWriter,
+    StreamHasher,
+    b64_to_hex,
+    verify_checksums,
+)
+from model import DownloadResult, DANEResponse, DownloadMetadata
+from download_cache import find_downloaded_file, publish_download
+from content_sniff import (
+    ContentSniffer,
+    SniffedType,
+    SniffingWriter,
+    sniff_file,
+    to_file_info,
+)
+from scheduler import OriginLimiter
+from disk_ledger import DiskReservation, InsufficientDiskSpace
+from retry import is_transient_status
+from timing import span
 import codecs
+import copy
+
+# boto3 takes long to import, so it is only loaded once S3 is used (a worker
+# that only downloads over HTTP never loads it)
+if TYPE_CHECKING:
+    from boto3.s3.transfer import TransferConfig
 
 
 logger = logging.getLogger(__name__)
+TMP_SUFFIX = ".part"  # downloads are written to <download_file_path>.part first
+DEFAULT_MAX_POOL_CONNECTIONS = 10  # botocore default
+# error codes of S3 (and compatible stores) for throttling and server trouble
+TRANSIENT_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "SlowDown",
+    "RequestTimeout",
+    "InternalError",
+    "ServiceUnavailable",
+}
+HEAD_CHECKSUM_FIELDS = {
+    "crc32c": "ChecksumCRC32C",
+    "sha1": "ChecksumSHA1",
+    "sha256": "ChecksumSHA256",
+}
+
+
+# one client (and connection pool) for the whole process; boto3 clients are
+# thread-safe, so concurrent downloads can share it
+@lru_cache(maxsize=None)
+def get_s3_client(max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS):
+    import boto3
+    from botocore.config import Config
+
+    logger.info(f"Initiating S3 client (max_pool_connections={max_pool_connections})")
+    session = boto3.session.Session()
+    return session.client(
+        "s3", config=Config(max_pool_connections=max_pool_connections)
+    )
+
+
+# converts the DOWNLOADER.S3_TRANSFER settings into a boto3 TransferConfig
+def to_transfer_config(settings: Dict[str, Any]) -> TransferConfig:
+    from boto3.s3.transfer import TransferConfig
+
+    kwargs: Dict[str, Any] = {}
+    if settings.get("MULTIPART_THRESHOLD"):
+        kwargs["multipart_threshold"] = parse_file_size(settings["MULTIPART_THRESHOLD"])
+    if settings.get("MULTIPART_CHUNKSIZE"):
+        kwargs["multipart_chunksize"] = parse_file_size(settings["MULTIPART_CHUNKSIZE"])
+    if settings.get("MAX_CONCURRENCY"):
+        kwargs["max_concurrency"] = settings["MAX_CONCURRENCY"]
+    if settings.get("MAX_IO_QUEUE"):
+        kwargs["max_io_queue"] = settings["MAX_IO_QUEUE"]
+    if settings.get("USE_THREADS") is not None:
+        kwargs["use_threads"] = settings["USE_THREADS"]
+    return TransferConfig(**kwargs)
+
+
+def max_pool_connections_for(transfer_config: TransferConfig | None) -> int:
+    if transfer_config is None:
+        return DEFAULT_MAX_POOL_CONNECTIONS
+    # each concurrent part request needs its own connection
+    return max(DEFAULT_MAX_POOL_CONNECTIONS, transfer_config.max_request_concurrency)
+
+
+def max_concurrency_of(transfer_config: TransferConfig | None) -> int:
+    return (transfer_config or to_transfer_config({})).max_request_concurrency
+
+
+# lowers the number of concurrent part requests, e.g. to an origin's limit
+def limit_concurrency(
+    transfer_config: TransferConfig | None, max_concurrency: int
+) -> TransferConfig | None:
+    if max_concurrency >= max_concurrency_of(transfer_config):
+        return transfer_config
+    limited = copy.copy(transfer_config or to_transfer_config({}))
+    limited.max_request_concurrency = max_concurrency
+    return limited
+
+
+# a single GET below the multipart threshold, otherwise as many concurrent
+# ranged GETs as there are parts (up to the max concurrency)
+def planned_concurrency(transfer_config: TransferConfig | None, size: int) -> int:
+    config = transfer_config or to_transfer_config({})
+    if size < config.multipart_threshold:
+        return 1
+    num_parts = math.ceil(size / config.multipart_chunksize)
+    return max(1, min(config.max_request_concurrency, num_parts))
+
+
+class ObjectHead:
+    """The HEAD response of an S3 object, requested once per task (on first use)
+    and reused for its file info, transfer strategy, disk space reservation and
+    to validate an earlier download of it"""
+
+    def __init__(self, s3, bucket: str, key: str):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self._response: Dict[str, Any] | None = None
+
+    def get(self) -> Dict[str, Any]:
+        if self._response is None:
+            with span("head"):
+                self._response = self.s3.head_object(
+                    Bucket=self.bucket, Key=self.key, ChecksumMode="ENABLED"
+                )
+        return self._response
+
+    # the size of the object, -1 if unknown (the download reports the error)
+    def content_length(self) -> int:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            return self.get().get("ContentLength", -1)
+        except (BotoCoreError, ClientError) as e:
+            logger.info(
+                f"Could not determine the size of s3://{self.bucket}/{self.key} "
+                f"({str(e)})"
+            )
+            return -1
+
+    def is_unmodified(self, cached: DownloadMetadata) -> bool:
+        if not cached.etag:
+            logger.info(f"No ETag known for s3://{self.bucket}/{self.key}")
+            return False
+        if self.get().get("ETag", "") != cached.etag:
+            logger.info(f"s3://{self.bucket}/{self.key} was modified")
+            return False
+        return True
+
+    # after the object turned out to have changed since the HEAD request
+    def invalidate(self):
+        self._response = None
+
+
+# provides the size (and ETag) of the HEAD response to boto3, which requests
+# them itself otherwise, see s3transfer.subscribers.BaseSubscriber
+class _KnownObject:
+    def __init__(self, head: Dict[str, Any]):
+        self.head = head
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.head.get("ContentLength", 0))
+        # only in newer s3transfer versions (which then send If-Match the ETag)
+        if hasattr(future.meta, "provide_object_etag"):
+            future.meta.provide_object_etag(self.head.get("ETag"))
+
+
+# downloads the object described by the HEAD response: boto3 uses a single GET
+# below the multipart threshold and ranged GETs above it
+def transfer_object(
+    s3,
+    bucket: str,
+    key: str,
+    fileobj,
+    head: Dict[str, Any],
+    transfer_config: TransferConfig | None,
+    callback: Callable[[int], None],
+):
+    from boto3.s3.transfer import ProgressCallbackInvoker, create_transfer_manager
+
+    # the version of the HEAD response, in case the object changes meanwhile
+    extra_args = {"VersionId": head["VersionId"]} if head.get("VersionId") else {}
+    with create_transfer_manager(
+        s3, transfer_config or to_transfer_config({})
+    ) as manager:
+        future = manager.download(
+            bucket,
+            key,
+            fileobj,
+            extra_args=extra_args,
+            subscribers=[_KnownObject(head), ProgressCallbackInvoker(callback)],
+        )
+        future.result()
 
 
 def validate_s3_uri(s3_uri: str) -> bool:
@@ -65,7 +260,18 @@ def delete_already_downloaded(path: str):
 
 # https://stackoverflow.com/questions/57280767/s3-an-error-occurred-403-when-calling-the-headobject-operation-forbidden
 # https://stackoverflow.com/questions/36144757/aws-cli-s3-a-client-error-403-occurred-when-calling-the-headobject-operation
-def download_s3_uri(s3_uri: str, download_dir: str) -> DownloadResult:
+def download_s3_uri(
+    s3_uri: str,
+    download_dir: str,
+    revalidate: bool = False,
+    transfer_config: TransferConfig | None = None,
+    max_pool_connections: int | None = None,
+    checksums: List[str] | None = None,
+    limiter: OriginLimiter | None = None,
+    progress_callback: Callable[[int], None] | None = None,
+    reservation: DiskReservation | None = None,
+    head: ObjectHead | None = None,
+) -> DownloadResult:
     logger.info(f"Attempting to download {s3_uri}")
 
     # first validate the s3_uri
@@ -89,40 +295,216 @@ def download_s3_uri(s3_uri: str, download_dir: str) -> DownloadResult:
     bucket, key, fn = deconstruct_s3_uri(s3_uri)
     logger.info(f"bucket: {bucket}; key: {key}; fn: {fn}")
     download_file_path = os.path.join(download_dir, fn)
-
-    # first check if the file was already downloaded
-    if os.path.exists(download_file_path):
-        logger.info(f"Download path already exists: {download_file_path}")
-        return DownloadResult(
-            download_file_path,
-            DANEResponse(200, f"{download_file_path} was already downloaded"),
-            True,
-            {},  # no file_info
-        )
+    tmp_file_path = f"{download_file_path}{TMP_SUFFIX}"
 
     # go ahead with the download
     try:
-        logger.info("Initiating S3 client")
-        s3 = boto3.client("s3")
-        with codecs.open(download_file_path, "wb") as f:
-            logger.info("Starting download")
-            s3.download_fileobj(bucket, key, f)
-            logger.info("Download done")
+        s3 = get_s3_client(
+            max_pool_connections or max_pool_connections_for(transfer_config)
+        )
+        head = head or ObjectHead(s3, bucket, key)
+        # first check if the file was (completely) downloaded before
+        cached = find_downloaded_file(
+            download_file_path, s3_uri, partial(_describe_object, s3_uri, head)
+        )
+        with span("revalidate"):
+            unmodified = cached and (not revalidate or head.is_unmodified(cached[1]))
+        if cached and unmodified:
+            cached_file_path, metadata = cached
+            logger.info(f"Download path already exists: {cached_file_path}")
+            return DownloadResult(
+                cached_file_path,
+                DANEResponse(200, f"{cached_file_path} was already downloaded"),
+                True,
+                metadata.file_info,
+            )
+
+        response = head.get()
+        size = response.get("ContentLength", 0)
+        if reservation is not None:  # raises InsufficientDiskSpace
+            reservation.reserve(size)
+        # one connection per concurrent part request, within the bucket's limit
+        limiter = limiter or OriginLimiter()
+        with limiter.connections(
+            planned_concurrency(transfer_config, size)
+        ) as num_connections:
+            hasher = StreamHasher(checksums or [])
+            sniffer = ContentSniffer()  # the format, from the first bytes written
+            with span("transfer") as transfer, codecs.open(tmp_file_path, "wb") as f:
+                logger.info(f"Starting download of {size} bytes")
+                # hashing makes boto3 write the parts in order (no seeking)
+                transfer_object(
+                    s3,
+                    bucket,
+                    key,
+                    SniffingWriter(
+                        HashingWriter(f, hasher) if checksums else f, sniffer
+                    ),
+                    response,
+                    limit_concurrency(transfer_config, num_connections),
+                    _chunk_callback(
+                        limiter.throttle,
+                        progress_callback,
+                        reservation.on_chunk if reservation else None,
+                    ),
+                )
+                transfer.num_bytes = size
+                logger.info("Download done")
+        with span("verify"):
+            digests = hasher.hexdigests()
+            verify_checksums(digests, extract_declared_checksums(response))
+        sniffed = sniffer.sniffed(tmp_file_path)
+        if sniffed and not os.path.splitext(fn)[1]:  # like HTTP downloads
+            download_file_path = f"{download_file_path}{sniffed.extension}"
+        file_info = extract_file_info(response, digests, sniffed)
+        with span("publish"):
+            publish_download(
+                tmp_file_path,
+                download_file_path,
+                DownloadMetadata(
+                    s3_uri,
+                    os.path.getsize(tmp_file_path),
+                    response.get("ETag", ""),
+                    str(response.get("LastModified", "")),
+                    digests,
+                    file_info,
+                ),
+            )
         return DownloadResult(
             download_file_path,
             DANEResponse(200, "Success"),
             False,
-            {},  # TODO try to extract some file info
+            file_info,
         )
+    except InsufficientDiskSpace:
+        raise  # the worker refuses the task
     except Exception as e:
-        logger.exception(f"Error while downloading {s3_uri}")
-        delete_already_downloaded(download_file_path)
+        return _failed_download(s3_uri, download_file_path, tmp_file_path, e, head)
+
+
+def _failed_download(
+    s3_uri: str,
+    download_file_path: str,
+    tmp_file_path: str,
+    e: Exception,
+    head: ObjectHead | None,
+) -> DownloadResult:
+    if isinstance(e, ChecksumMismatch):
+        logger.warning(f"Corrupt download of {s3_uri}: {str(e)}")
+        delete_already_downloaded(tmp_file_path)
         return DownloadResult(
             download_file_path,
-            DANEResponse(500, f"Unkown error: {str(e)}"),
+            DANEResponse(502, f"Checksum verification failed: {str(e)}"),
             False,
             {},  # no file info in case of an error
         )
+    logger.exception(f"Error while downloading {s3_uri}")
+    delete_already_downloaded(tmp_file_path)
+    if head is not None and is_modified_error(e):
+        head.invalidate()  # the next attempt requests it again
+    return DownloadResult(
+        download_file_path,
+        DANEResponse(500, f"Unkown error: {str(e)}"),
+        False,
+        {},  # no file info in case of an error
+        is_transient_error(e) or is_modified_error(e),
+    )
+
+
+# throttling, server errors and lost connections are worth another attempt
+# (botocore already retried them a few times, see its retry config)
+def is_transient_error(e: Exception) -> bool:
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+    if isinstance(e, (ConnectionError, HTTPClientError)):
+        return True
+    if isinstance(e, ClientError):
+        error = e.response.get("Error", {})
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return error.get("Code") in TRANSIENT_ERROR_CODES or is_transient_status(status)
+    return False
+
+
+# a ranged GET of an object that changed since its HEAD request
+def is_modified_error(e: Exception) -> bool:
+    from botocore.exceptions import ClientError
+
+    return (
+        isinstance(e, ClientError)
+        and e.response.get("Error", {}).get("Code") == "PreconditionFailed"
+    )
+
+
+# the same file info as for HTTP downloads, from the HEAD response and content
+def extract_file_info(
+    head: Dict[str, Any], digests: Dict[str, str], sniffed: SniffedType | None
+) -> Dict[str, Any]:
+    file_info = to_file_info(
+        head.get("ContentType", ""), head.get("ContentLength", -1), sniffed
+    )
+    if digests:
+        file_info["checksums"] = digests
+    return file_info
+
+
+# the metadata a download of the object at file_path would have, from the HEAD
+# response, to adopt a download without sidecar (see adopt_legacy_download)
+def _describe_object(
+    s3_uri: str, head: ObjectHead, file_path: str
+) -> DownloadMetadata | None:
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    try:
+        response = head.get()
+    except (BotoCoreError, ClientError) as e:
+        logger.info(f"Could not describe {s3_uri} ({str(e)})")
+        return None
+    return DownloadMetadata(
+        s3_uri,
+        response.get("ContentLength", -1),
+        response.get("ETag", ""),
+        str(response.get("LastModified", "")),
+        {},
+        extract_file_info(response, {}, sniff_file(file_path)),
+    )
+
+
+# checksums S3 provides for the object, converted to hex
+def extract_declared_checksums(head: Dict[str, Any]) -> Dict[str, str]:
+    checksums = {}
+    # the ETag is the MD5 of the content, except for multipart uploads
+    # ("<md5 of md5s>-<parts>") and objects encrypted with SSE-KMS or SSE-C
+    etag = head.get("ETag", "").strip('"')
+    if (
+        etag
+        and "-" not in etag
+        and head.get("ServerSideEncryption") != "aws:kms"
+        and not head.get("SSECustomerAlgorithm")
+    ):
+        checksums["md5"] = etag
+    # additional checksums (only returned with ChecksumMode=ENABLED); the ones of
+    # multipart uploads are checksums of the part checksums ("<b64>-<parts>")
+    for alg, field in HEAD_CHECKSUM_FIELDS.items():
+        value = head.get(field, "")
+        hex_value = b64_to_hex(value) if value and "-" not in value else None
+        if hex_value:
+            checksums[alg] = hex_value
+    return checksums
+
+
+# boto3 calls it with the size of each received chunk
+def _chunk_callback(
+    *optional_callbacks: Callable[[int], None] | None
+) -> Callable[[int], None]:
+    callbacks = [c for c in optional_callbacks if c is not None]
+    if len(callbacks) == 1:
+        return callbacks[0]
+
+    def on_chunk(num_bytes: int):
+        for callback in callbacks:
+            callback(num_bytes)
+
+    return on_chunk
 
 
 if __name__ == "__main__":
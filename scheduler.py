@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+from urllib.parse import urlparse
+from base_util import parse_file_size
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_ORIGIN = "*"  # ORIGIN_LIMITS entry applied to each origin without its own
+
+
+class TokenBucket:
+    """Thread-safe token bucket, refilled with rate tokens (bytes) per second.
+    Consumers go into debt and sleep it off, so chunks larger than the
+    capacity are fine"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate  # allow bursts of one second
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        wait = self.take(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    # takes amount tokens without blocking, returns the seconds to sleep off
+    # the debt (for consumers that cannot block, e.g. on an event loop)
+    def take(self, amount: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last_refill) * self.rate
+            )
+            self._last_refill = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class OriginLimiter:
+    """Limits the concurrent connections and the bandwidth of all downloads
+    from one origin (0 means unlimited)"""
+
+    def __init__(self, max_connections: int = 0, max_bandwidth: int = 0):
+        self.max_connections = max_connections
+        self.max_bandwidth = max_bandwidth
+        self._bucket = TokenBucket(max_bandwidth) if max_bandwidth > 0 else None
+        self._in_use = 0
+        self._available = threading.Condition()
+
+    # reserves up to num connections at once (so a download never holds some
+    # while waiting for more) and yields the number it got
+    @contextmanager
+    def connections(self, num: int) -> Iterator[int]:
+        num = max(1, num)
+        if self.max_connections > 0:
+            num = min(num, self.max_connections)
+        with self._available:
+            self._available.wait_for(self._has_available(num))
+            self._in_use += num
+        try:
+            yield num
+        finally:
+            self._release(num)
+
+    # reserves the connections that are available of num more without waiting
+    # (for the extra segments of a download that already holds a connection)
+    # and yields the number it got, possibly 0
+    @contextmanager
+    def available_connections(self, num: int) -> Iterator[int]:
+        with self._available:
+            if self.max_connections > 0:
+                num = min(num, self.max_connections - self._in_use)
+            num = max(0, num)
+            self._in_use += num
+        try:
+            yield num
+        finally:
+            self._release(num)
+
+    def _release(self, num: int):
+        with self._available:
+            self._in_use -= num
+            self._available.notify_all()
+
+    def _has_available(self, num: int):
+        return lambda: (
+            self.max_connections <= 0 or self._in_use + num <= self.max_connections
+        )
+
+    # called for every chunk received, blocks while over the bandwidth limit
+    def throttle(self, num_bytes: int):
+        if self._bucket is not None:
+            self._bucket.consume(num_bytes)
+
+    # like throttle, but returns the seconds to wait instead of blocking
+    def delay(self, num_bytes: int) -> float:
+        return self._bucket.take(num_bytes) if self._bucket is not None else 0
+
+
+class OriginScheduler:
+    """Hands out one OriginLimiter per origin (URL host or S3 bucket), based on
+    the DOWNLOADER.ORIGIN_LIMITS setting"""
+
+    def __init__(self, origin_limits: List[Dict[str, Any]]):
+        self._limits = {
+            entry["ORIGIN"].lower(): (
+                entry.get("MAX_CONNECTIONS", 0) or 0,
+                parse_file_size(entry["MAX_BANDWIDTH"])
+                if entry.get("MAX_BANDWIDTH")
+                else 0,
+            )
+            for entry in origin_limits
+        }
+        self._limiters: Dict[str, OriginLimiter] = {}
+        self._lock = threading.Lock()
+
+    def limiter_for(self, origin: str) -> OriginLimiter:
+        origin = origin.lower()
+        with self._lock:
+            if origin not in self._limiters:
+                max_connections, max_bandwidth = self._limits.get(
+                    origin, self._limits.get(DEFAULT_ORIGIN, (0, 0))
+                )
+                logger.info(
+                    f"Limits for {origin}: {max_connections} connections, "
+                    f"{max_bandwidth} bytes/s (0 = unlimited)"
+                )
+                self._limiters[origin] = OriginLimiter(max_connections, max_bandwidth)
+            return self._limiters[origin]
+
+
+# the host of a URL, or s3://<bucket> for an S3 URI
+def to_origin(target_url: str) -> str:
+    parsed = urlparse(target_url)
+    if parsed.scheme == "s3":
+        return f"s3://{parsed.netloc}"
+    return parsed.hostname or ""
@@ -0,0 +1,73 @@
+import fcntl
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+
+logger = logging.getLogger(__name__)
+LOCK_SUFFIX = ".lock"  # e.g. video.mp4 -> video.mp4.lock, only while locked
+
+
+class SingleFlight:
+    """Makes sure only one download of a file path runs at the same time, over
+    all threads of this worker (a lock per path) and over all workers sharing
+    the volume (an fcntl lock on <path>.lock). Whoever comes later waits and
+    then finds the file already downloaded"""
+
+    def __init__(self) -> None:
+        self._locks: Dict[str, List] = {}  # path -> [lock, number of users]
+        self._locks_lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, path: str) -> Iterator[None]:
+        with self._locks_lock:
+            entry = self._locks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            # fcntl locks are per process, so the threads are serialized first
+            with entry[0], _file_lock(f"{path}{LOCK_SUFFIX}"):
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[path]
+
+
+@contextmanager
+def _file_lock(lock_path: str) -> Iterator[None]:
+    fd = _open_locked(lock_path)
+    try:
+        yield
+    finally:
+        if fd != -1:
+            os.remove(lock_path)  # before unlocking, so no one locks it in between
+            os.close(fd)  # releases the lock
+
+
+# the lock file is removed on release, so a waiter may have locked a file that
+# is no longer there: then it tries again with a new one; returns -1 if the
+# file cannot be locked (e.g. a volume without lock support)
+def _open_locked(lock_path: str) -> int:
+    while True:
+        fd = -1
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            logger.warning(f"Cannot lock {lock_path} ({str(e)}), not locking it")
+            if fd != -1:
+                os.close(fd)
+            return -1
+        if _is_same_file(fd, lock_path):
+            return fd
+        os.close(fd)
+
+
+def _is_same_file(fd: int, path: str) -> bool:
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except FileNotFoundError:
+        return False
@@ -0,0 +1,151 @@
+import os
+import base64
+import hashlib
+import pytest
+import time
+from concurrent.futures import ThreadPoolExecutor
+from async_download import AsyncHttpEngine
+from download_cache import read_sidecar
+from disk_ledger import DiskLedger, InsufficientDiskSpace
+from scheduler import OriginLimiter
+
+
+DUMMY_CONTENT = os.urandom(3 * 1024 * 1024 + 7)  # a few chunks
+
+
+@pytest.fixture
+def engine():
+    engine = AsyncHttpEngine(max_connections=8)
+    try:
+        yield engine
+    finally:
+        engine.close()
+
+
+def test_download(http_server, tmp_path, engine):
+    http_server.files["/viz/some-video"] = {
+        "content": DUMMY_CONTENT,
+        "headers": {"Content-Type": "video/mp4"},
+    }
+    url = f"{http_server.url}/viz/some-video"
+    result = engine.download(url, str(tmp_path), checksums=["sha256"])
+    assert result.dane_response.state == 200
+    assert result.download_file_path == os.path.join(str(tmp_path), "some-video.mp4")
+    assert result.file_info["Content-Length"] == len(DUMMY_CONTENT)
+    assert (
+        result.file_info["checksums"]["sha256"]
+        == hashlib.sha256(DUMMY_CONTENT).hexdigest()
+    )
+    with open(result.download_file_path, "rb") as f:
+        assert f.read() == DUMMY_CONTENT
+    assert sorted(os.listdir(str(tmp_path))) == [
+        "some-video.mp4",
+        "some-video.mp4.download.json",  # the sidecar, no part file is left
+    ]
+
+    # the second time the cached download is found without any request
+    result = engine.download(url, str(tmp_path))
+    assert result.already_downloaded
+    assert result.dane_response.state == 201
+    assert len(http_server.requests) == 1
+
+
+def test_download__many_small_files(http_server, tmp_path, engine):
+    for i in range(50):
+        http_server.files[f"/page-{i}.html"] = {"content": f"<p>{i}</p>".encode()}
+    with ThreadPoolExecutor(max_workers=10) as executor:  # like the task threads
+        results = list(
+            executor.map(
+                lambda i: engine.download(
+                    f"{http_server.url}/page-{i}.html", str(tmp_path)
+                ),
+                range(50),
+            )
+        )
+    assert all(r.dane_response.state == 200 for r in results)
+    assert len(os.listdir(str(tmp_path))) == 100  # the files and their sidecars
+
+
+@pytest.mark.parametrize("path, state", [("/missing.mp4", 404), ("/error.mp4", 503)])
+def test_download__error(http_server, tmp_path, engine, path, state):
+    result = engine.download(f"{http_server.url}{path}", str(tmp_path))
+    assert result.dane_response.state == state
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download__stalled_source(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT, "stall_after": 10}
+    engine = AsyncHttpEngine(read_timeout=0.2)
+    try:
+        start = time.perf_counter()
+        result = engine.download(f"{http_server.url}/video.mp4", str(tmp_path))
+        assert result.dane_response.state == 502 and result.transient
+        assert time.perf_counter() - start < 2  # not waiting for the source
+    finally:
+        engine.close()
+
+
+@pytest.mark.parametrize("corrupt", [False, True])
+def test_download__verify_checksums(http_server, tmp_path, engine, corrupt):
+    md5 = hashlib.md5(DUMMY_CONTENT if not corrupt else b"other").digest()
+    http_server.files["/video.mp4"] = {
+        "content": DUMMY_CONTENT,
+        "headers": {"Content-MD5": base64.b64encode(md5).decode()},
+    }
+    result = engine.download(
+        f"{http_server.url}/video.mp4", str(tmp_path), checksums=["md5"]
+    )
+    if corrupt:
+        assert result.dane_response.state == 502
+        assert os.listdir(str(tmp_path)) == []
+    else:
+        assert result.dane_response.state == 200
+        assert read_sidecar(result.download_file_path).checksums == {"md5": md5.hex()}
+
+
+def test_download__reserves_disk_space(http_server, tmp_path, engine):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    url = f"{http_server.url}/video.mp4"
+    ledger = DiskLedger(10**6, lambda download_dir: 10**6 + len(DUMMY_CONTENT))
+    with ledger.reservation(str(tmp_path)) as reservation:
+        with pytest.raises(InsufficientDiskSpace):  # just does not fit
+            engine.download(url, str(tmp_path), reservation=reservation)
+
+    ledger = DiskLedger(10**6, lambda download_dir: 10**6 + len(DUMMY_CONTENT) + 1)
+    with ledger.reservation(str(tmp_path)) as reservation:
+        result = engine.download(url, str(tmp_path), reservation=reservation)
+        assert result.dane_response.state == 200
+        assert reservation.remaining == 0  # all written
+
+
+def test_download__revalidate_redirect(http_server, tmp_path, engine):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    http_server.files["/redirect.mp4"] = {"redirect": "/video.mp4"}
+    url = f"{http_server.url}/redirect.mp4"
+    assert engine.download(url, str(tmp_path)).dane_response.state == 200
+    result = engine.download(url, str(tmp_path), revalidate=True)
+    assert result.already_downloaded  # the HEAD request followed the redirect
+    assert [r[0] for r in http_server.requests].count("GET") == 2  # one redirect
+
+
+def test_download__throttled_origin_does_not_block_others(http_server, tmp_path):
+    http_server.files["/slow.mp4"] = {"content": DUMMY_CONTENT}
+    http_server.files["/fast.mp4"] = {"content": b"0123456789"}
+    engine = AsyncHttpEngine(io_threads=1)  # shared by both downloads
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            slow = executor.submit(
+                engine.download,
+                f"{http_server.url}/slow.mp4",
+                str(tmp_path),
+                limiter=OriginLimiter(max_bandwidth=1024 * 1024),  # about 2s
+            )
+            time.sleep(0.2)
+            start = time.perf_counter()
+            fast = engine.download(f"{http_server.url}/fast.mp4", str(tmp_path))
+            assert time.perf_counter() - start < 0.5
+            assert not slow.done()
+            assert fast.dane_response.state == 200
+            assert slow.result().dane_response.state == 200
+    finally:
+        engine.close()
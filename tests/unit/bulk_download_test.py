@@ -0,0 +1,101 @@
+import json
+import os
+import pytest
+from bulk_download import (
+    ManifestEntry,
+    download_all,
+    main,
+    open_results,
+    read_done,
+    read_manifest,
+)
+from worker import DownloadWorker
+
+
+@pytest.mark.parametrize(
+    "file_name, content",
+    [
+        (
+            "manifest.csv",
+            "id,url,download_dir\n"
+            "a,http://127.0.0.1/a.mp4,/data/a\n"
+            ",http://127.0.0.1/b.mp4, /data/b\n",
+        ),
+        (
+            "manifest.jsonl",
+            '{"id": "a", "url": "http://127.0.0.1/a.mp4", "download_dir": "/data/a"}\n'
+            "\n"
+            '{"url": "http://127.0.0.1/b.mp4", "download_dir": " /data/b"}\n',
+        ),
+    ],
+)
+def test_read_manifest(tmp_path, file_name, content):
+    manifest_path = tmp_path / file_name
+    manifest_path.write_text(content)
+    assert list(read_manifest(str(manifest_path))) == [
+        ManifestEntry("a", "http://127.0.0.1/a.mp4", "/data/a"),
+        ManifestEntry("http://127.0.0.1/b.mp4", "http://127.0.0.1/b.mp4", "/data/b"),
+    ]
+
+
+def test_open_results__after_interrupted_run(tmp_path):
+    results_path = str(tmp_path / "results.jsonl")
+    with open(results_path, "w") as f:
+        f.write('{"id": "a", "state": 200}\n{"id": "c", "state": 201}\n')
+        f.write('{"id": "b", "st')  # killed mid-write
+    assert read_done(results_path) == {"a", "c"}
+    with open_results(results_path) as results:
+        results.write('{"id": "b", "state": 200}\n')
+    assert read_done(results_path) == {"a", "b", "c"}
+
+
+def _read_results(results_path: str) -> dict:
+    with open(results_path, "r") as f:
+        return {r["id"]: r for r in map(json.loads, f)}
+
+
+def test_download_all(config, http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": b"0123456789"}
+    download_dir = str(tmp_path / "downloads")
+    entries = [
+        ManifestEntry("ok", f"{http_server.url}/video.mp4", download_dir),
+        ManifestEntry("missing", f"{http_server.url}/missing.mp4", download_dir),
+        ManifestEntry("not-whitelisted", "http://example.com/video.mp4", download_dir),
+        ManifestEntry("no-dir", f"{http_server.url}/video.mp4", ""),
+    ]
+    worker = DownloadWorker(config, standalone=True)
+    worker.whitelist = ["127.0.0.1"]
+    results_path = str(tmp_path / "results.jsonl")
+    with open_results(results_path) as results:
+        states = download_all(worker, entries, results, 3)
+    assert states == {200: 1, 404: 1, 403: 1, 400: 1}
+
+    results = _read_results(results_path)
+    assert results["ok"]["payload"]["file_path"] == os.path.join(
+        download_dir, "video.mp4"
+    )
+    assert results["ok"]["payload"]["Content-Length"] == 10
+    assert "payload" not in results["missing"]
+    assert read_done(results_path) == {"ok"}
+
+    # a source already on disk (e.g. the results were lost) is done as well
+    with open_results(results_path) as results:
+        assert download_all(worker, [entries[0]], results, 1) == {201: 1}
+    assert _read_results(results_path)["ok"]["payload"]["Content-Length"] == 10
+
+
+def test_main__continues_where_it_stopped(config, tmp_path):
+    manifest_path = str(tmp_path / "manifest.jsonl")
+    results_path = str(tmp_path / "results.jsonl")
+    with open(manifest_path, "w") as f:
+        for id in ["done", "failed"]:
+            url = f"http://not-whitelisted.com/{id}.mp4"
+            f.write(json.dumps({"id": id, "url": url, "download_dir": str(tmp_path)}))
+            f.write("\n")
+    with open(results_path, "w") as f:
+        f.write('{"id": "done", "state": 200}\n')
+
+    assert main([manifest_path, results_path, "--parallel", "2"]) == 1
+    with open(results_path, "r") as f:
+        assert [json.loads(line)["id"] for line in f] == ["done", "failed"]
+    assert _read_results(results_path)["failed"]["state"] == 403
@@ -0,0 +1,74 @@
+import io
+import os
+import hashlib
+import pytest
+from checksum import (
+    ChecksumMismatch,
+    HashingWriter,
+    StreamHasher,
+    b64_to_hex,
+    hash_file,
+    verify_checksums,
+)
+
+
+DUMMY_CONTENT = os.urandom(3 * 1024 * 1024 + 5)
+
+
+def test_stream_hasher():
+    hasher = StreamHasher(["md5", "sha256"])
+    for i in range(0, len(DUMMY_CONTENT), 1000):
+        hasher.update(DUMMY_CONTENT[i : i + 1000])
+    assert hasher.num_bytes == len(DUMMY_CONTENT)
+    assert hasher.hexdigests() == {
+        "md5": hashlib.md5(DUMMY_CONTENT).hexdigest(),
+        "sha256": hashlib.sha256(DUMMY_CONTENT).hexdigest(),
+    }
+
+
+def test_hashing_writer():
+    out = io.BytesIO()
+    writer = HashingWriter(out, StreamHasher(["sha256"]))
+    writer.write(DUMMY_CONTENT)
+    assert not writer.seekable()  # so boto3 writes in order
+    assert out.getvalue() == DUMMY_CONTENT
+    assert (
+        writer.hasher.hexdigests()["sha256"]
+        == hashlib.sha256(DUMMY_CONTENT).hexdigest()
+    )
+
+
+@pytest.mark.parametrize("num_bytes", [-1, 0, 10, 1024 * 1024 + 1])
+def test_hash_file(tmp_path, num_bytes):
+    file_path = os.path.join(str(tmp_path), "dummy")
+    with open(file_path, "wb") as f:
+        f.write(DUMMY_CONTENT)
+    hasher = hash_file(file_path, StreamHasher(["sha256"]), num_bytes)
+    expected = DUMMY_CONTENT if num_bytes == -1 else DUMMY_CONTENT[:num_bytes]
+    assert hasher.hexdigests()["sha256"] == hashlib.sha256(expected).hexdigest()
+
+
+def test_verify_checksums():
+    computed = {"md5": hashlib.md5(DUMMY_CONTENT).hexdigest(), "sha256": "abc"}
+    verify_checksums(computed, {})  # nothing declared
+    verify_checksums(computed, {"md5": computed["md5"], "crc32c": "1234abcd"})
+    with pytest.raises(ChecksumMismatch):
+        verify_checksums(computed, {"sha256": "def"})
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("rL0Y20zC+Fzt72VPzMSk2A==", hashlib.md5(b"foo").hexdigest()),
+        ("not base64!", None),
+    ],
+)
+def test_b64_to_hex(value, expected):
+    assert b64_to_hex(value) == expected
+
+
+def test_crc32c():
+    pytest.importorskip("crc32c")
+    hasher = StreamHasher(["crc32c"])
+    hasher.update(b"123456789")
+    assert hasher.hexdigests()["crc32c"] == "e3069283"  # the CRC-32C check value
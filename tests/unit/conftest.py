@@ -1,5 +1,8 @@
 import pytest
 import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 @pytest.fixture(scope="session")
@@ -12,3 +15,97 @@ def config():
 @pytest.fixture(scope="session")
 def environment_variables():  # TODO migrate secrets from config.yml to env
     os.environ["DW_DOWNLOAD_UNIT_TESTING"] = "true"
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves the files registered in server.files (path -> dict with the
+    bytes in "content" and optional response "headers"), honouring
+    If-None-Match, and Range/If-Range unless "accept_ranges" is set to False,
+    or redirects (302) to the path in "redirect".
+    With "stall_after" set, it stops sending (for a while) after that many
+    bytes of the body"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # keep the test output clean
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body: bool):
+        self.server.requests.append(  # type: ignore[attr-defined]
+            (self.command, self.path, dict(self.headers))
+        )
+        f = self.server.files.get(self.path)  # type: ignore[attr-defined]
+        if f is None:
+            self.send_error(500 if self.path.startswith("/error") else 404)
+            return
+        if "redirect" in f:
+            self.send_response(302)
+            self.send_header("Location", f["redirect"])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        content = f["content"]
+        etag = f.get("etag", f'"{hash(content)}"')
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        start, end, status = 0, len(content) - 1, 200
+        byte_range = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if (
+            byte_range
+            and f.get("accept_ranges", True)
+            and (if_range is None or if_range == etag)
+        ):
+            start_s, end_s = byte_range.replace("bytes=", "").split("-")
+            start = int(start_s)
+            end = int(end_s) if end_s else len(content) - 1
+            status = 206
+        body = content[start : end + 1]
+        self.send_response(status)
+        for k, v in f.get("headers", {}).items():
+            self.send_header(k, v)
+        if f.get("accept_ranges", True):
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self._send_body(body, f.get("stall_after"))
+
+    def _send_body(self, body: bytes, stall_after: int | None):
+        try:
+            if stall_after is not None:
+                self.wfile.write(body[:stall_after])
+                self.wfile.flush()
+                time.sleep(5)
+                body = body[stall_after:]  # the rest, after the stall
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stopped reading (e.g. after its first segment)
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.daemon_threads = True
+    server.files = {}
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,113 @@
+import io
+import os
+import pytest
+from content_sniff import (
+    SNIFF_SIZE,
+    ContentSniffer,
+    SniffingWriter,
+    sniff,
+    to_file_info,
+)
+
+
+TS_PACKET = b"\x47" + b"\x00" * 187
+
+
+@pytest.mark.parametrize(
+    "head, extension, mime_type",
+    [
+        (b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00", ".mp4", "video/mp4"),
+        (b"\x00\x00\x00\x14ftypqt  \x00\x00\x00\x00", ".mov", "video/quicktime"),
+        (b"\x00\x00\x00\x20ftypM4A \x00\x00\x00\x00", ".m4a", "audio/mp4"),
+        (b"\x00\x00\x00\x08wide\x00\x00\x00\x00mdat", ".mov", "video/quicktime"),
+        (
+            b"\x06\x0e\x2b\x34\x02\x05\x01\x01\x0d\x01\x02\x01\x01\x02\x04\x00",
+            ".mxf",
+            "application/mxf",
+        ),
+        (b"RIFF\x24\x08\x00\x00WAVEfmt ", ".wav", "audio/wav"),
+        (b"RF64\xff\xff\xff\xffWAVEds64", ".wav", "audio/wav"),
+        (b"RIFF\x24\x08\x00\x00AVI LIST", ".avi", "video/x-msvideo"),
+        (
+            b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\x82\x84webm",
+            ".webm",
+            "video/webm",
+        ),
+        (b"\x1a\x45\xdf\xa3\xa3\x42\x86\x81\x01\x42\x82\x88matroska", ".mkv", None),
+        (TS_PACKET * 3, ".ts", "video/mp2t"),
+        ((b"\x00" * 4 + TS_PACKET) * 3, ".m2ts", "video/mp2t"),
+        (b"ID3\x04\x00\x00\x00\x00\x00\x00", ".mp3", "audio/mpeg"),
+        (b"\xff\xfb\x90\x64\x00", ".mp3", "audio/mpeg"),
+        (b"MThd\x00\x00\x00\x06", ".mid", "audio/midi"),
+        (b"\xef\xbb\xbf\n  <!DOCTYPE html><html>", ".html", "text/html"),
+        (b"<html><head>", ".html", "text/html"),
+    ],
+)
+def test_sniff(head, extension, mime_type):
+    sniffed = sniff(head)
+    assert sniffed is not None and sniffed.extension == extension
+    if mime_type:
+        assert sniffed.mime_type == mime_type
+
+
+@pytest.mark.parametrize(
+    "head",
+    [
+        b"",
+        b"\x00" * 512,
+        TS_PACKET * 2,  # a single sync byte is too weak a signal
+        b"\xff\xf1\x50\x80",  # AAC (ADTS), not MP3
+        b'{"json": true}',
+    ],
+)
+def test_sniff__unknown(head):
+    assert sniff(head) is None
+
+
+def test_content_sniffer(tmp_path):
+    content = b"\x00\x00\x00\x18ftypisom" + os.urandom(2 * SNIFF_SIZE)
+    file_path = str(tmp_path / "video")
+    with open(file_path, "wb") as f:
+        f.write(b"\x00" * len(content))  # so reading it back would not work
+
+    sniffer = ContentSniffer()
+    sniffer.feed(100, content[100:200])  # not from the start: ignored
+    for offset in range(0, len(content), 100):
+        sniffer.feed(offset, memoryview(content)[offset : offset + 100])
+    assert sniffer.is_full()
+    assert sniffer.sniffed(file_path).extension == ".mp4"
+
+
+def test_content_sniffer__reads_file(tmp_path):
+    file_path = str(tmp_path / "page")
+    with open(file_path, "wb") as f:
+        f.write(b"<html></html>")
+    sniffer = ContentSniffer()
+    sniffer.feed(SNIFF_SIZE, b"<p>resumed</p>")  # e.g. after a resume
+    assert sniffer.sniffed(file_path).extension == ".html"
+    assert sniffer.sniffed(str(tmp_path / "missing")) is None
+
+
+def test_sniffing_writer():
+    sniffer = ContentSniffer()
+    f = io.BytesIO()
+    writer = SniffingWriter(f, sniffer)
+    assert writer.seekable()
+    writer.seek(SNIFF_SIZE)  # a later part first (e.g. boto3's parallel parts)
+    writer.write(b"\x00" * 100)
+    writer.seek(0)
+    writer.write(b"RIFF\x24\x08\x00\x00WAVE")
+    writer.write(b"\x00" * SNIFF_SIZE)
+    assert writer.tell() == 12 + SNIFF_SIZE
+    assert sniffer.sniffed("unused").extension == ".wav"
+    assert f.getvalue().startswith(b"RIFF")
+
+
+def test_to_file_info():
+    assert to_file_info("application/octet-stream", 10, sniff(b"ID3")) == {
+        "file_type": "audio",
+        "Content-Type": "application/octet-stream",
+        "Content-Length": 10,
+        "sniffed_type": "audio/mpeg",
+    }
+    assert to_file_info("", -1, None)["file_type"] == "unknown"
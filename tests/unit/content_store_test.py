@@ -0,0 +1,124 @@
+import os
+import hashlib
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from content_store import ContentStore, DIGEST_ALGORITHM
+from download_cache import publish_download, read_sidecar
+from model import DownloadMetadata
+
+
+DUMMY_CONTENT = b"dummy content"
+DUMMY_SOURCE = "http://dummy.com/video.mp4"
+
+
+def _publish(
+    download_dir: str, source: str, with_digest: bool = True, etag: str = ""
+) -> str:
+    os.makedirs(download_dir, exist_ok=True)
+    download_file_path = os.path.join(download_dir, "video.mp4")
+    with open(f"{download_file_path}.part", "wb") as f:
+        f.write(DUMMY_CONTENT)
+    checksums = {}
+    if with_digest:
+        checksums[DIGEST_ALGORITHM] = hashlib.sha256(DUMMY_CONTENT).hexdigest()
+    publish_download(
+        f"{download_file_path}.part",
+        download_file_path,
+        DownloadMetadata(source, len(DUMMY_CONTENT), etag, "", checksums, {}),
+    )
+    return download_file_path
+
+
+@pytest.mark.parametrize("with_digest", [True, False])
+def test_add_and_link_into(tmp_path, with_digest):
+    store = ContentStore(os.path.join(str(tmp_path), "store"))
+    first = _publish(os.path.join(str(tmp_path), "doc1"), DUMMY_SOURCE, with_digest)
+    store.add(first)
+
+    filename, metadata = store.lookup(DUMMY_SOURCE)
+    assert filename == "video.mp4"
+    assert (
+        metadata.checksums[DIGEST_ALGORITHM]
+        == hashlib.sha256(DUMMY_CONTENT).hexdigest()
+    )
+
+    # the source is linked into another document dir, without downloading it
+    linked = store.link_into(DUMMY_SOURCE, os.path.join(str(tmp_path), "doc1"))
+    assert linked is None  # already downloaded in this dir
+    doc2_dir = os.path.join(str(tmp_path), "doc2")
+    os.makedirs(doc2_dir)
+    download_file_path, metadata = store.link_into(DUMMY_SOURCE, doc2_dir)
+    assert os.path.samefile(download_file_path, first)
+    assert read_sidecar(download_file_path).source == DUMMY_SOURCE
+
+
+def test_add__same_content_other_source(tmp_path):
+    store = ContentStore(os.path.join(str(tmp_path), "store"))
+    first = _publish(os.path.join(str(tmp_path), "doc1"), DUMMY_SOURCE)
+    store.add(first)
+    other_source = "http://dummy.com/copy-of-video.mp4"
+    second = _publish(os.path.join(str(tmp_path), "doc2"), other_source)
+    assert not os.path.samefile(first, second)
+
+    store.add(second)
+    assert os.path.samefile(first, second)  # deduplicated
+    assert store.lookup(other_source)[0] == "video.mp4"
+
+
+def test_link_into__outdated(tmp_path):
+    store = ContentStore(os.path.join(str(tmp_path), "store"))
+    store.add(_publish(os.path.join(str(tmp_path), "doc1"), DUMMY_SOURCE))
+    doc2_dir = os.path.join(str(tmp_path), "doc2")
+    os.makedirs(doc2_dir)
+    assert store.link_into(DUMMY_SOURCE, doc2_dir, lambda m: False) is None
+    assert store.link_into("http://dummy.com/unknown.mp4", doc2_dir) is None
+
+
+def test_link_into__validator(tmp_path):
+    store = ContentStore(os.path.join(str(tmp_path), "store"))
+    store.add(_publish(os.path.join(str(tmp_path), "doc1"), DUMMY_SOURCE, etag='"v1"'))
+    doc2_dir = os.path.join(str(tmp_path), "doc2")
+    os.makedirs(doc2_dir)
+    assert store.link_into(DUMMY_SOURCE, doc2_dir) is None  # not revalidated
+    download_file_path, metadata = store.link_into(
+        DUMMY_SOURCE, doc2_dir, lambda m: m.etag == '"v1"'
+    )
+    assert metadata.etag == '"v1"'
+
+
+def test_other_file_system(tmp_path):
+    store = ContentStore(os.path.join(str(tmp_path), "store"))
+    assert store.check_roots([str(tmp_path), str(tmp_path / "mount")]) == [
+        str(tmp_path),
+        str(tmp_path / "mount"),  # not mounted yet, checked by its parent
+    ]
+    store.add(_publish(os.path.join(str(tmp_path), "doc1"), DUMMY_SOURCE))
+
+    store.device = -1  # as if the download dirs are on another file system
+    assert store.check_roots([str(tmp_path)]) == []
+    doc2_dir = os.path.join(str(tmp_path), "doc2")
+    os.makedirs(doc2_dir)
+    assert store.link_into(DUMMY_SOURCE, doc2_dir) is None
+    store.add(_publish(os.path.join(str(tmp_path), "doc3"), "http://dummy.com/other"))
+    assert store.lookup("http://dummy.com/other") is None  # not added
+
+
+def test_add__concurrently(tmp_path):
+    store = ContentStore(os.path.join(str(tmp_path), "store"))
+    download_file_paths = [
+        _publish(os.path.join(str(tmp_path), f"doc{i}"), DUMMY_SOURCE) for i in range(8)
+    ]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(store.add, download_file_paths))  # raises any error
+
+    filename, metadata = store.lookup(DUMMY_SOURCE)
+    assert filename == "video.mp4"
+    for download_file_path in download_file_paths:
+        with open(download_file_path, "rb") as f:
+            assert f.read() == DUMMY_CONTENT
+    assert not [
+        name
+        for _, _, names in os.walk(str(tmp_path))
+        for name in names
+        if ".link" in name or ".tmp" in name
+    ]
@@ -0,0 +1,157 @@
+import os
+import threading
+import pytest
+from mockito import when, verify, unstub, ANY
+import disk_io
+from disk_io import (
+    IntervalSyncer,
+    PageCacheDropper,
+    StreamWriter,
+    ThreadedStreamWriter,
+    WriteOptions,
+    open_stream_writer,
+    preallocate,
+)
+
+
+@pytest.mark.parametrize(
+    "drop_cache_size, content_length, drops_cache",
+    [
+        (0, 10**12, False),  # disabled
+        (10**9, 10**9, True),
+        (10**9, 10**9 - 1, False),
+        (10**9, -1, False),  # unknown size
+    ],
+)
+def test_drops_cache(drop_cache_size, content_length, drops_cache):
+    options = WriteOptions(drop_cache_size=drop_cache_size)
+    assert options.drops_cache(content_length) is drops_cache
+
+
+def test_preallocate(tmp_path):
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        assert preallocate(f.fileno(), 10**6)
+        assert os.fstat(f.fileno()).st_size == 10**6
+        assert not preallocate(f.fileno(), -1)  # unknown size
+
+
+def test_preallocate__unsupported(tmp_path):
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        try:
+            when(os).posix_fallocate(f.fileno(), 0, 10**6).thenRaise(
+                OSError(95, "Operation not supported")
+            )
+            assert not preallocate(f.fileno(), 10**6)
+        finally:
+            unstub()
+
+
+def test_page_cache_dropper(tmp_path):
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        try:
+            when(os).posix_fadvise(...).thenReturn(None)
+            dropper = PageCacheDropper(f.fileno(), 0)
+            dropper.written(0, disk_io.DROP_CACHE_INTERVAL - 1)
+            verify(os, times=0).posix_fadvise(...)
+            dropper.written(disk_io.DROP_CACHE_INTERVAL - 1, 1)
+            verify(os, times=1).posix_fadvise(
+                f.fileno(), 0, disk_io.DROP_CACHE_INTERVAL, os.POSIX_FADV_DONTNEED
+            )
+            dropper.drop()  # nothing written since
+            verify(os, times=1).posix_fadvise(ANY, ANY, ANY, ANY)
+        finally:
+            unstub()
+
+
+def test_interval_syncer(tmp_path):
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        try:
+            when(os).fdatasync(f.fileno()).thenReturn(None)
+            syncer = IntervalSyncer(f.fileno(), 100)
+            syncer.written(99)
+            verify(os, times=0).fdatasync(...)
+            syncer.written(1)
+            syncer.written(99)
+            verify(os, times=1).fdatasync(f.fileno())
+            IntervalSyncer(f.fileno(), 0).written(10**12)  # never
+            verify(os, times=1).fdatasync(...)
+        finally:
+            unstub()
+
+
+@pytest.mark.parametrize(
+    "write_buffers, size, length, writer_class",
+    [
+        (1, 10**5 + 7, -1, StreamWriter),
+        (3, 10**5 + 7, -1, ThreadedStreamWriter),  # unknown length
+        (3, 10**5 + 7, 10**5 + 7, ThreadedStreamWriter),
+        (3, 2000, 2000, StreamWriter),  # fits in the buffers, not worth a thread
+    ],
+)
+def test_open_stream_writer(tmp_path, write_buffers, size, length, writer_class):
+    content = os.urandom(size)
+    written = []
+    options = WriteOptions(buffer_size=1000, write_buffers=write_buffers)
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        f.write(b"x" * 10)  # the stream starts at an offset
+        with open_stream_writer(
+            f.fileno(),
+            10,
+            options,
+            lambda chunk: written.append(bytes(chunk)),
+            length=length,
+        ) as writer:
+            assert isinstance(writer, writer_class)
+            for start in range(0, len(content), 1000):
+                buffer = writer.next_buffer()
+                chunk = content[start : start + 1000]
+                buffer[: len(chunk)] = chunk
+                writer.submit(buffer, len(chunk))
+    assert b"".join(written) == content  # in order, after writing
+    with open(tmp_path / "video.mp4.part", "rb") as f:
+        assert f.read() == b"x" * 10 + content
+
+
+def test_threaded_stream_writer__reader_waits_for_disk(tmp_path):
+    disk_stalled = threading.Event()
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        options = WriteOptions(buffer_size=10, write_buffers=2)
+        writer = ThreadedStreamWriter(f.fileno(), 0, options, lambda c: None)
+        try:
+            when(os).pwrite(...).thenAnswer(lambda *args: disk_stalled.wait(5))
+            for _ in range(2):  # received while the disk stalls
+                writer.submit(writer.next_buffer(), 10)
+            threading.Timer(0.2, disk_stalled.set).start()
+            writer.next_buffer()  # all buffers wait to be written
+            assert writer.blocked_on_disk >= 0.1
+        finally:
+            disk_stalled.set()
+            unstub()
+            writer.close()
+
+
+def test_threaded_stream_writer__lazy(tmp_path):
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        options = WriteOptions(buffer_size=10, write_buffers=3)
+        with ThreadedStreamWriter(f.fileno(), 0, options, lambda c: None) as writer:
+            assert writer._thread.ident is None  # nothing to write (yet)
+            buffers = [writer.next_buffer() for _ in range(2)]
+            assert buffers[0].obj is not buffers[1].obj
+            assert writer._unallocated == 1  # allocated one by one
+            writer.submit(buffers[0], 0)
+            assert writer._thread.is_alive()
+
+
+def test_threaded_stream_writer__write_error(tmp_path):
+    with open(tmp_path / "video.mp4.part", "wb") as f:
+        options = WriteOptions(buffer_size=10, write_buffers=2)
+        try:
+            when(os).pwrite(...).thenRaise(OSError(5, "Input/output error"))
+            with pytest.raises(OSError):
+                with ThreadedStreamWriter(
+                    f.fileno(), 0, options, lambda c: None
+                ) as writer:
+                    for _ in range(10):  # fails once the error is seen
+                        writer.submit(writer.next_buffer(), 10)
+        finally:
+            unstub()
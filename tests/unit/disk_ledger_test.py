@@ -0,0 +1,56 @@
+import pytest
+from disk_ledger import DiskLedger, InsufficientDiskSpace
+
+
+@pytest.mark.parametrize(
+    "threshold, expected_size, fits, free_disk_space",
+    [  # 10MB free disk for most examples
+        (10**6, 0, True, 10**7),  # 1MB
+        (10**7 - 1, 0, True, 10**7),  # 10MB minus one byte
+        (10**7, 0, False, 10**7),  # the same as the bytes free is not accepted
+        (10**8, 0, False, 10**7),  # 100MB
+        (10**6, 9 * 10**6 - 1, True, 10**7),  # fits just above the threshold
+        (10**6, 9 * 10**6, False, 10**7),  # the file would reach the threshold
+        (10**9, 10**9, True, 10**10),  # 1GB (now 10GB free)
+    ],
+)
+def test_reserve(tmp_path, threshold, expected_size, fits, free_disk_space):
+    ledger = DiskLedger(threshold, lambda download_dir: free_disk_space)
+    with ledger.reservation(str(tmp_path)) as reservation:
+        if fits:
+            reservation.reserve(expected_size)
+            assert ledger.reserved(str(tmp_path)) == expected_size
+        else:
+            with pytest.raises(InsufficientDiskSpace):
+                reservation.reserve(expected_size)
+
+
+def test_reserve__downloads_in_flight(tmp_path):
+    ledger = DiskLedger(10**6, lambda download_dir: 10**8)
+    with ledger.reservation(str(tmp_path)) as first:
+        first.reserve(6 * 10**7)
+        with ledger.reservation(str(tmp_path)) as second:
+            with pytest.raises(InsufficientDiskSpace):
+                second.reserve(4 * 10**7)  # only 39MB left above the threshold
+
+        # the written bytes are part of the (mocked) free space from now on
+        first.on_chunk(10**7)
+        assert ledger.reserved(str(tmp_path)) == 5 * 10**7
+
+    # released when done (also after an error)
+    with pytest.raises(InsufficientDiskSpace):
+        with ledger.reservation(str(tmp_path)) as reservation:
+            reservation.reserve(9 * 10**7)
+            raise InsufficientDiskSpace("some other error")
+    assert ledger.reserved(str(tmp_path)) == 0
+
+
+def test_reserve__preallocated(tmp_path):
+    ledger = DiskLedger(0, lambda download_dir: 10**8)
+    with ledger.reservation(str(tmp_path)) as reservation:
+        reservation.reserve(10**7)
+        reservation.on_chunk(10**6)  # written before preallocating (resumed)
+        reservation.on_allocated(9 * 10**6)  # in the free space from now on
+        assert ledger.reserved(str(tmp_path)) == 0
+        reservation.on_chunk(9 * 10**6)  # into the preallocated blocks
+        assert reservation.remaining == 0 and reservation._allocated == 0
@@ -0,0 +1,124 @@
+import os
+import pytest
+from download_cache import (
+    find_downloaded_file,
+    publish_download,
+    read_sidecar,
+    record_result,
+    recorded_result,
+    to_sidecar_path,
+    validate_cached_download,
+)
+from model import DownloadMetadata
+
+
+DUMMY_SOURCE = "http://dummy.com/video.mp4"
+DUMMY_CONTENT = b"dummy content"
+DUMMY_SIZE = len(DUMMY_CONTENT)
+
+
+def _dummy_metadata(source: str = DUMMY_SOURCE, size: int = DUMMY_SIZE):
+    return DownloadMetadata(source, size, '"etag"', "", {}, {"file_type": "video"})
+
+
+def test_publish_download(tmp_path):
+    tmp_file_path = os.path.join(str(tmp_path), "video.mp4.part")
+    download_file_path = os.path.join(str(tmp_path), "video.mp4")
+    with open(tmp_file_path, "wb") as f:
+        f.write(DUMMY_CONTENT)
+
+    publish_download(tmp_file_path, download_file_path, _dummy_metadata())
+    assert not os.path.exists(tmp_file_path)
+    assert os.path.exists(download_file_path)
+    assert read_sidecar(download_file_path) == _dummy_metadata()
+
+
+@pytest.mark.parametrize(
+    "metadata, valid",
+    [
+        (_dummy_metadata(), True),
+        (None, False),  # no sidecar (e.g. a truncated legacy download)
+        (_dummy_metadata(size=DUMMY_SIZE + 1), False),  # truncated
+        (_dummy_metadata(source="http://dummy.com/other.mp4"), False),
+    ],
+)
+def test_validate_cached_download(tmp_path, metadata, valid):
+    download_file_path = os.path.join(str(tmp_path), "video.mp4")
+    tmp_file_path = f"{download_file_path}.part"
+    with open(tmp_file_path, "wb") as f:
+        f.write(DUMMY_CONTENT)
+    if metadata:
+        publish_download(tmp_file_path, download_file_path, metadata)
+    else:
+        os.replace(tmp_file_path, download_file_path)
+
+    assert (
+        validate_cached_download(download_file_path, DUMMY_SOURCE) is not None
+    ) is valid
+
+
+def test_record_result(tmp_path):
+    download_file_path = os.path.join(str(tmp_path), "video.mp4")
+    payload = {"file_path": download_file_path, "file_type": "video"}
+    record_result(download_file_path, "doc-1", payload)  # no sidecar, no record
+    assert recorded_result(download_file_path, "doc-1") is None
+
+    with open(f"{download_file_path}.part", "wb") as f:
+        f.write(DUMMY_CONTENT)
+    publish_download(
+        f"{download_file_path}.part", download_file_path, _dummy_metadata()
+    )
+    assert recorded_result(download_file_path, "doc-1") is None
+    record_result(download_file_path, "doc-1", payload)
+    assert recorded_result(download_file_path, "doc-1") == payload
+    assert recorded_result(download_file_path, "doc-2") is None  # of another doc
+    assert validate_cached_download(download_file_path, DUMMY_SOURCE) is not None
+
+    other_path = os.path.join(str(tmp_path), "copy.mp4")  # e.g. linked into it
+    os.link(download_file_path, other_path)
+    os.link(to_sidecar_path(download_file_path), to_sidecar_path(other_path))
+    assert recorded_result(other_path, "doc-1") is None
+
+
+def test_read_sidecar__corrupt(tmp_path):
+    download_file_path = os.path.join(str(tmp_path), "video.mp4")
+    with open(to_sidecar_path(download_file_path), "w") as f:
+        f.write("{not json")
+    assert read_sidecar(download_file_path) is None
+
+
+def test_find_downloaded_file__adopts_legacy_download(tmp_path):
+    path_prefix = os.path.join(str(tmp_path), "video")  # extension not known yet
+    for name in ["video.part", "video.part.json", "video.mp4"]:
+        with open(os.path.join(str(tmp_path), name), "wb") as f:
+            f.write(DUMMY_CONTENT)
+    described = []
+
+    def describe_source(file_path: str):
+        described.append(file_path)
+        return _dummy_metadata()
+
+    assert find_downloaded_file(path_prefix, DUMMY_SOURCE) is None  # not trusted
+    download_file_path, metadata = find_downloaded_file(
+        path_prefix, DUMMY_SOURCE, describe_source
+    )
+    assert download_file_path == f"{path_prefix}.mp4"
+    assert described == [download_file_path]  # not the part file
+    assert read_sidecar(download_file_path) == metadata == _dummy_metadata()
+
+    # verified by its sidecar from now on
+    assert find_downloaded_file(path_prefix, DUMMY_SOURCE, describe_source)
+    assert len(described) == 1
+
+
+def test_find_downloaded_file__legacy_download_size_differs(tmp_path):
+    download_file_path = os.path.join(str(tmp_path), "video.mp4")
+    with open(download_file_path, "wb") as f:
+        f.write(DUMMY_CONTENT[:-1])  # e.g. truncated
+    assert (
+        find_downloaded_file(
+            download_file_path, DUMMY_SOURCE, lambda file_path: _dummy_metadata()
+        )
+        is None
+    )
+    assert read_sidecar(download_file_path) is None
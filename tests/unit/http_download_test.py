@@ -1,9 +1,33 @@
-# import pytest
-# from mockito import unstub
+import os
+import base64
+import hashlib
+import time
+import pytest
+import requests
+from mockito import when, ARGS
+import http_download
 from http_download import (
     download_http,
+    extract_declared_checksums,
     extract_file_info,
+    is_unmodified,
+    split_into_segments,
+    save_progress,
+    SegmentError,
+    PART_SUFFIX,
+    PROGRESS_SUFFIX,
 )
+from download_cache import read_sidecar, write_sidecar
+from http_util import get_http_session
+from scheduler import OriginLimiter
+from disk_ledger import DiskLedger, InsufficientDiskSpace
+from disk_io import WriteOptions
+from model import DownloadProgress, DownloadMetadata
+
+
+DUMMY_CONTENT = os.urandom(10**6 + 7)  # odd size, so segments are uneven
+FOO_MD5 = hashlib.md5(b"foo").hexdigest()
+FOO_SHA256 = hashlib.sha256(b"foo").hexdigest()
 
 
 def test_download_http():
@@ -12,3 +36,498 @@ def test_download_http():
 
 def test_extract_file_info():
     assert callable(extract_file_info)
+
+
+@pytest.mark.parametrize(
+    "size, num_segments, expected_ranges",
+    [
+        (10, 1, [(0, 9)]),
+        (10, 2, [(0, 4), (5, 9)]),
+        (10, 3, [(0, 3), (4, 6), (7, 9)]),  # remainder goes to the first segments
+        (2, 4, [(0, 0), (1, 1)]),  # never return empty ranges
+    ],
+)
+def test_split_into_segments(size, num_segments, expected_ranges):
+    assert split_into_segments(size, num_segments) == expected_ranges
+
+
+@pytest.mark.parametrize(
+    "accept_ranges, segments, expected_range_requests",
+    [
+        (True, 4, 3),  # first segment is read from the initial GET
+        (True, 1, 0),  # segmenting disabled
+        (False, 4, 0),  # server does not support ranges: single stream
+    ],
+)
+def test_download_http__segmented(
+    http_server, tmp_path, accept_ranges, segments, expected_range_requests
+):
+    http_server.files["/video.mp4"] = {
+        "content": DUMMY_CONTENT,
+        "headers": {"Content-Type": "video/mp4"},
+        "accept_ranges": accept_ranges,
+    }
+    result = download_http(
+        f"{http_server.url}/video.mp4",
+        str(tmp_path),
+        segments=segments,
+        min_segment_size=10**5,
+    )
+    assert result.dane_response.state == 200
+    assert result.file_info["Content-Length"] == len(DUMMY_CONTENT)
+    with open(result.download_file_path, "rb") as f:
+        assert f.read() == DUMMY_CONTENT
+
+    range_requests = [r for r in http_server.requests if "Range" in r[2]]
+    assert len(range_requests) == expected_range_requests
+    assert all(r[2].get("If-Range") for r in range_requests)
+
+
+def test_download_http__404(http_server, tmp_path):
+    result = download_http(f"{http_server.url}/missing.mp4", str(tmp_path))
+    assert result.dane_response.state == 404
+    assert not result.transient  # another attempt would not help
+
+
+def test_download_http__transient_errors(http_server, tmp_path):
+    result = download_http(f"{http_server.url}/error.mp4", str(tmp_path))
+    assert result.dane_response.state == 503 and result.transient
+
+    # nothing listens on port 1
+    result = download_http("http://127.0.0.1:1/video.mp4", str(tmp_path))
+    assert result.dane_response.state == 502 and result.transient
+
+
+def test_download_http__connection_reset(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    url = f"{http_server.url}/video.mp4"
+    with when(http_download)._copy_range(*ARGS).thenRaise(ConnectionResetError()):
+        result = download_http(url, str(tmp_path))
+    assert result.dane_response.state == 502 and result.transient
+    assert os.path.exists(f"{result.download_file_path}{PART_SUFFIX}")  # resumable
+
+
+def test_download_http__stalled_source(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT, "stall_after": 10}
+    start = time.perf_counter()
+    result = download_http(
+        f"{http_server.url}/video.mp4",
+        str(tmp_path),
+        session=get_http_session(read_timeout=0.2),
+    )
+    assert result.dane_response.state == 502 and result.transient
+    assert time.perf_counter() - start < 2  # not waiting for the source
+
+
+def test_download_http__segment_changed_source(http_server, tmp_path):
+    # simulate the source changing between requests (If-Range mismatch)
+    http_server.files["/video.mp4"] = {
+        "content": DUMMY_CONTENT,
+        "etag": '"v1"',
+    }
+    with when(http_download)._download_range(*ARGS).thenRaise(
+        SegmentError("Expected 206 for bytes 0-1, got 200")
+    ):
+        result = download_http(
+            f"{http_server.url}/video.mp4",
+            str(tmp_path),
+            segments=4,
+            min_segment_size=10**5,
+        )
+    assert result.dane_response.state == 502
+    assert not os.path.exists(result.download_file_path)
+
+
+def _write_partial_download(download_dir, fn: str, url: str, num_bytes: int, etag):
+    part_file_path = os.path.join(download_dir, f"{fn}{PART_SUFFIX}")
+    with open(part_file_path, "wb") as f:
+        f.write(DUMMY_CONTENT[:num_bytes])
+    save_progress(
+        f"{part_file_path}{PROGRESS_SUFFIX}",
+        DownloadProgress(
+            url,
+            etag,
+            len(DUMMY_CONTENT),
+            {"Content-Type": "video/mp4", "Content-Length": str(len(DUMMY_CONTENT))},
+            [[0, len(DUMMY_CONTENT) - 1, num_bytes]],
+        ),
+    )
+    return part_file_path
+
+
+@pytest.mark.parametrize(
+    "etag, source_changed",
+    [
+        ('"v1"', False),  # same ETag, so only the missing tail is fetched
+        ('"v0"', True),  # the source changed, so If-Range returns the full file
+    ],
+)
+def test_download_http__resume(http_server, tmp_path, etag, source_changed):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT, "etag": '"v1"'}
+    url = f"{http_server.url}/video.mp4"
+    part_file_path = _write_partial_download(
+        str(tmp_path), "video.mp4", url, 1000, etag
+    )
+
+    result = download_http(url, str(tmp_path))
+    assert result.dane_response.state == 200
+    assert result.file_info["Content-Length"] == len(DUMMY_CONTENT)
+    with open(result.download_file_path, "rb") as f:
+        assert f.read() == DUMMY_CONTENT
+    assert not os.path.exists(part_file_path)
+    assert not os.path.exists(f"{part_file_path}{PROGRESS_SUFFIX}")
+
+    method, path, headers = http_server.requests[0]
+    assert headers["Range"] == "bytes=1000-"
+    assert headers["If-Range"] == etag
+
+
+def test_download_http__keeps_part_file_of_incomplete_download(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    url = f"{http_server.url}/video.mp4"
+    with when(http_download)._copy_range(*ARGS).thenReturn(None):  # no bytes
+        result = download_http(url, str(tmp_path))
+    assert result.dane_response.state == 502 and result.transient
+    assert not os.path.exists(result.download_file_path)
+    assert os.path.exists(f"{result.download_file_path}{PART_SUFFIX}")
+    assert os.path.exists(f"{result.download_file_path}{PART_SUFFIX}{PROGRESS_SUFFIX}")
+
+
+@pytest.mark.parametrize(
+    "sidecar, revalidate, etag, expect_download",
+    [
+        (True, False, '"v1"', False),  # verified cache hit
+        (True, True, '"v1"', False),  # revalidated with a 304
+        (True, True, '"v2"', True),  # the source changed since the download
+    ],
+)
+def test_download_http__cache(
+    http_server, tmp_path, sidecar, revalidate, etag, expect_download
+):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT, "etag": etag}
+    url = f"{http_server.url}/video.mp4"
+    download_file_path = os.path.join(str(tmp_path), "video.mp4")
+    with open(download_file_path, "wb") as f:
+        f.write(DUMMY_CONTENT)
+    if sidecar:
+        write_sidecar(
+            download_file_path,
+            DownloadMetadata(
+                url, len(DUMMY_CONTENT), '"v1"', "", {}, {"file_type": "video"}
+            ),
+        )
+
+    result = download_http(url, str(tmp_path), revalidate=revalidate)
+    assert result.already_downloaded is not expect_download
+    assert result.dane_response.state == (200 if expect_download else 201)
+    assert result.file_info["file_type"] == "video" or expect_download
+    assert read_sidecar(download_file_path).etag == etag
+    assert any(r[0] == "GET" for r in http_server.requests) is expect_download
+
+
+@pytest.mark.parametrize(
+    "legacy_content, adopted", [(DUMMY_CONTENT, True), (b"x", False)]
+)
+def test_download_http__legacy_download(http_server, tmp_path, legacy_content, adopted):
+    http_server.files["/video.mp4"] = {
+        "content": DUMMY_CONTENT,
+        "headers": {"Content-Type": "video/mp4"},
+    }
+    download_file_path = os.path.join(str(tmp_path), "video.mp4")
+    with open(download_file_path, "wb") as f:  # by a worker without sidecars
+        f.write(legacy_content)
+
+    result = download_http(f"{http_server.url}/video.mp4", str(tmp_path))
+    assert result.already_downloaded is adopted
+    assert result.file_info["file_type"] == "video"
+    assert read_sidecar(download_file_path).size == len(DUMMY_CONTENT)
+    assert [r[0] for r in http_server.requests] == (
+        ["HEAD"] if adopted else ["HEAD", "GET"]  # a smaller file is replaced
+    )
+
+
+@pytest.mark.parametrize("path", ["/video.mp4", "/redirect.mp4"])
+def test_is_unmodified(http_server, path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT, "etag": '"v1"'}
+    http_server.files["/redirect.mp4"] = {"redirect": "/video.mp4"}
+    url = f"{http_server.url}{path}"
+    cached = DownloadMetadata(url, len(DUMMY_CONTENT), '"v1"', "", {}, {})
+    assert is_unmodified(get_http_session(), url, cached)
+    cached.etag = '"v0"'
+    assert not is_unmodified(get_http_session(), url, cached)
+
+
+def test_download_http__extension_from_get_response(http_server, tmp_path):
+    http_server.files["/viz/some-video"] = {
+        "content": DUMMY_CONTENT,
+        "headers": {"Content-Type": "video/mp4"},
+    }
+    url = f"{http_server.url}/viz/some-video"
+    result = download_http(url, str(tmp_path))
+    assert result.dane_response.state == 200
+    assert result.download_file_path == os.path.join(str(tmp_path), "some-video.mp4")
+    assert [r[0] for r in http_server.requests] == ["GET"]  # no extra HEAD
+
+    # the second time the cached download is found without any request
+    result = download_http(url, str(tmp_path))
+    assert result.already_downloaded
+    assert result.download_file_path == os.path.join(str(tmp_path), "some-video.mp4")
+    assert len(http_server.requests) == 1
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_download_http__extension_from_content(http_server, tmp_path, segments):
+    content = b"\x00\x00\x00\x18ftypisom" + DUMMY_CONTENT
+    http_server.files["/viz/some-video"] = {
+        "content": content,
+        "headers": {"Content-Type": "application/octet-stream"},
+    }
+    url = f"{http_server.url}/viz/some-video"
+    result = download_http(url, str(tmp_path), segments=segments)
+    assert result.dane_response.state == 200
+    assert result.download_file_path == os.path.join(str(tmp_path), "some-video.mp4")
+    assert result.file_info["file_type"] == "video"
+    assert result.file_info["sniffed_type"] == "video/mp4"
+    assert result.file_info["Content-Type"] == "application/octet-stream"
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_download_http__checksums(http_server, tmp_path, segments):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    result = download_http(
+        f"{http_server.url}/video.mp4",
+        str(tmp_path),
+        segments=segments,
+        min_segment_size=10**5,
+        checksums=["sha256"],
+    )
+    assert result.dane_response.state == 200
+    assert (
+        read_sidecar(result.download_file_path).checksums["sha256"]
+        == hashlib.sha256(DUMMY_CONTENT).hexdigest()
+    )
+
+
+def test_download_http__checksums_after_resume(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT, "etag": '"v1"'}
+    url = f"{http_server.url}/video.mp4"
+    _write_partial_download(str(tmp_path), "video.mp4", url, 1000, '"v1"')
+    result = download_http(url, str(tmp_path), checksums=["sha256"])
+    assert (
+        read_sidecar(result.download_file_path).checksums["sha256"]
+        == hashlib.sha256(DUMMY_CONTENT).hexdigest()
+    )
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({}, {}),
+        ({"Content-MD5": "rL0Y20zC+Fzt72VPzMSk2A=="}, {"md5": FOO_MD5}),
+        (
+            {"Digest": "SHA-256=LCa0a2j/xo/5m0U8HTBBNBNCLXBkg7+g+YpeiGJm564="},
+            {"sha256": FOO_SHA256},
+        ),
+        ({"Digest": "unixsum=30637, md5=rL0Y20zC+Fzt72VPzMSk2A=="}, {"md5": FOO_MD5}),
+        (
+            {"x-goog-hash": "crc32c=z8SuHQ==,md5=rL0Y20zC+Fzt72VPzMSk2A=="},
+            {"crc32c": "cfc4ae1d", "md5": FOO_MD5},
+        ),
+        (
+            {"x-amz-checksum-sha256": "LCa0a2j/xo/5m0U8HTBBNBNCLXBkg7+g+YpeiGJm564="},
+            {"sha256": FOO_SHA256},
+        ),
+        (
+            {"x-amz-checksum-sha256": "LCa0a2j/xo/5m0U8HTBBNBNCLXBkg7+g+YpeiGJm564=-2"},
+            {},
+        ),  # composite
+        ({"Content-MD5": "invalid!"}, {}),
+    ],
+)
+def test_extract_declared_checksums(headers, expected):
+    assert extract_declared_checksums(headers) == expected
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+@pytest.mark.parametrize("corrupt", [False, True])
+def test_download_http__verify_checksums(http_server, tmp_path, segments, corrupt):
+    md5 = hashlib.md5(DUMMY_CONTENT if not corrupt else b"other").digest()
+    http_server.files["/video.mp4"] = {
+        "content": DUMMY_CONTENT,
+        "headers": {"Content-MD5": base64.b64encode(md5).decode()},
+    }
+    result = download_http(
+        f"{http_server.url}/video.mp4",
+        str(tmp_path),
+        segments=segments,
+        min_segment_size=10**5,
+        checksums=["md5", "sha256"],
+    )
+    if corrupt:
+        assert result.dane_response.state == 502
+        assert os.listdir(str(tmp_path)) == []  # nothing published, nothing to resume
+    else:
+        assert result.dane_response.state == 200
+        assert result.file_info["checksums"] == {
+            "md5": md5.hex(),
+            "sha256": hashlib.sha256(DUMMY_CONTENT).hexdigest(),
+        }
+
+
+def test_download_http__origin_limits(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    limiter = OriginLimiter(max_connections=2, max_bandwidth=5 * 10**5)
+    start = time.monotonic()
+    result = download_http(
+        f"{http_server.url}/video.mp4",
+        str(tmp_path),
+        segments=4,
+        min_segment_size=10**5,
+        limiter=limiter,
+    )
+    assert result.dane_response.state == 200
+    range_requests = [r for r in http_server.requests if "Range" in r[2]]
+    assert len(range_requests) == 1  # 2 segments: the initial GET + 1 range
+    assert time.monotonic() - start > 0.8  # 0.5MB burst, then 0.5MB at 0.5MB/s
+
+
+def test_download_http__origin_limits__busy(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    limiter = OriginLimiter(max_connections=2)
+    with limiter.connections(1):  # another download from the origin
+        result = download_http(
+            f"{http_server.url}/video.mp4",
+            str(tmp_path),
+            segments=4,
+            min_segment_size=10**5,
+            limiter=limiter,
+        )
+    assert result.dane_response.state == 200
+    assert not [r for r in http_server.requests if "Range" in r[2]]  # one segment
+
+
+@pytest.mark.parametrize("max_connections", [1, 2])
+def test_download_http__resume_within_origin_limits(
+    http_server, tmp_path, monkeypatch, max_connections
+):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT, "etag": '"v1"'}
+    url = f"{http_server.url}/video.mp4"
+    part_file_path = os.path.join(str(tmp_path), f"video.mp4{PART_SUFFIX}")
+    with open(part_file_path, "wb") as f:
+        f.write(DUMMY_CONTENT[:1000])
+        f.truncate(len(DUMMY_CONTENT))  # sparse, like a segmented download
+    save_progress(
+        f"{part_file_path}{PROGRESS_SUFFIX}",
+        DownloadProgress(
+            url,
+            '"v1"',
+            len(DUMMY_CONTENT),
+            {"Content-Length": str(len(DUMMY_CONTENT))},
+            [
+                [start, end, 1000 if start == 0 else 0]
+                for start, end in split_into_segments(len(DUMMY_CONTENT), 4)
+            ],
+        ),
+    )
+
+    # the ranges of the 3 other pending segments, on the connections left
+    active, max_active = [0], [0]
+    download_range = http_download._download_range
+
+    def counting_download_range(*args):
+        active[0] += 1
+        max_active[0] = max(max_active[0], active[0])
+        try:
+            time.sleep(0.05)  # overlap with the others, if they run in parallel
+            download_range(*args)
+        finally:
+            active[0] -= 1
+
+    monkeypatch.setattr(http_download, "_download_range", counting_download_range)
+    limiter = OriginLimiter(max_connections=max_connections)
+    result = download_http(url, str(tmp_path), limiter=limiter)
+    assert result.dane_response.state == 200
+    with open(result.download_file_path, "rb") as f:
+        assert f.read() == DUMMY_CONTENT
+    assert max_active[0] == 1  # + the initial request, within the limit
+    assert len([r for r in http_server.requests if "Range" in r[2]]) == 4
+
+
+def test_download_http__reserves_disk_space(http_server, tmp_path):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    url = f"{http_server.url}/video.mp4"
+    ledger = DiskLedger(10**6, lambda download_dir: 10**6 + len(DUMMY_CONTENT))
+    with ledger.reservation(str(tmp_path)) as reservation:
+        with pytest.raises(InsufficientDiskSpace):  # just does not fit
+            download_http(url, str(tmp_path), reservation=reservation)
+
+    ledger = DiskLedger(10**6, lambda download_dir: 10**6 + len(DUMMY_CONTENT) + 1)
+    with ledger.reservation(str(tmp_path)) as reservation:
+        result = download_http(url, str(tmp_path), reservation=reservation)
+        assert result.dane_response.state == 200
+        assert reservation.remaining == 0  # all written
+
+
+@pytest.mark.parametrize("preallocate", [True, False])
+def test_download_http__preallocated_disk_space(http_server, tmp_path, preallocate):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    ledger = DiskLedger(0, lambda download_dir: 10**9)
+    reserved = []  # while receiving the first chunk
+    with ledger.reservation(str(tmp_path)) as reservation:
+        result = download_http(
+            f"{http_server.url}/video.mp4",
+            str(tmp_path),
+            progress_callback=lambda n: reserved.append(ledger.reserved(str(tmp_path))),
+            reservation=reservation,
+            write_options=WriteOptions(preallocate=preallocate),
+        )
+        assert result.dane_response.state == 200
+        assert reservation.remaining == 0
+    # preallocated blocks are part of the free space already
+    assert reserved[0] == (0 if preallocate else len(DUMMY_CONTENT))
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+@pytest.mark.parametrize(
+    "write_options",
+    [
+        WriteOptions(buffer_size=1000, preallocate=False),
+        WriteOptions(buffer_size=64 * 1024, preallocate=True),
+        WriteOptions(drop_cache_size=1),
+        WriteOptions(write_buffers=1),  # written by the reading thread
+        WriteOptions(buffer_size=1000, write_buffers=2, fsync=True),
+        WriteOptions(fsync=True, fsync_interval=10**5),
+    ],
+)
+def test_download_http__write_options(http_server, tmp_path, segments, write_options):
+    http_server.files["/video.mp4"] = {"content": DUMMY_CONTENT}
+    result = download_http(
+        f"{http_server.url}/video.mp4",
+        str(tmp_path),
+        segments=segments,
+        min_segment_size=10**5,
+        checksums=["md5"],
+        write_options=write_options,
+    )
+    assert result.dane_response.state == 200
+    assert (
+        result.file_info["checksums"]["md5"] == hashlib.md5(DUMMY_CONTENT).hexdigest()
+    )
+    with open(result.download_file_path, "rb") as f:
+        assert f.read() == DUMMY_CONTENT
+
+
+def test_download_http__reuses_connections(http_server, tmp_path):
+    http_server.files["/a.mp4"] = {"content": DUMMY_CONTENT}
+    http_server.files["/b.mp4"] = {"content": DUMMY_CONTENT}
+    session = requests.Session()
+    for name in ["a.mp4", "b.mp4"]:
+        url = f"{http_server.url}/{name}"
+        assert (
+            download_http(url, str(tmp_path), session=session).dane_response.state
+            == 200
+        )
+    pools = session.get_adapter(http_server.url).poolmanager.pools
+    (pool,) = [pools[key] for key in pools.keys()]
+    assert pool.num_connections == 1
+    assert pool.pool.get().sock is not None  # released to the pool, still open
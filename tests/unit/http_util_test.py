@@ -1,9 +1,11 @@
 import pytest
 from mockito import unstub
 from urllib.parse import quote
+from content_sniff import SniffedType
 from http_util import (
     extract_extension_from_content_disposition,
-    determine_url_extension,
+    get_http_session,
+    to_output_filename,
     url_to_safe_filename,
     preprocess_url,
     extract_filename_from_url,
@@ -16,27 +18,6 @@ DUMMY_PATH = "path/forward"
 DUMMY_FILE = "test.mp3"
 
 
-# TODO test the function internals a bit more (better: split up / improve the function)
-@pytest.mark.parametrize(
-    "url, extension",
-    [
-        # (
-        #     "http://low-res-throttler/viz/DE_TOEKOMST_I-KRO000071S9",
-        #     ".mp4",
-        # ),
-        (
-            "https://www.nu.nl/",
-            ".html",
-        ),
-    ],
-)
-def test_determine_url_extension(url: str, extension: str):
-    try:
-        assert determine_url_extension(url) == extension
-    finally:
-        unstub()
-
-
 # see: https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Disposition
 # see: https://datatracker.ietf.org/doc/html/rfc5987
 @pytest.mark.parametrize(
@@ -203,3 +184,39 @@ def test_url_to_safe_filename(url: str, safe_fn: str):
         assert url_to_safe_filename(url) == safe_fn
     finally:
         unstub()
+
+
+@pytest.mark.parametrize(
+    "safe_fn, headers, output_fn",
+    [
+        ("test.mp3", {"Content-Type": "video/mp4"}, "test.mp3"),  # URL extension wins
+        ("test", {"Content-Type": "video/mp4"}, "test.mp4"),
+        ("test", {"Content-Type": "text/html; charset=utf-8"}, "test.html"),
+        (
+            "test",
+            {
+                "Content-Type": "video/mp4",
+                "Content-Disposition": 'attachment; filename="test.mxf"',
+            },
+            "test.mxf",
+        ),  # Content-Disposition before Content-Type
+        ("test", {}, "test"),  # nothing to go on
+    ],
+)
+def test_to_output_filename(safe_fn: str, headers: dict, output_fn: str):
+    assert to_output_filename(safe_fn, headers) == output_fn
+
+
+def test_to_output_filename__sniffed():
+    sniffed = SniffedType(".mxf", "application/mxf")
+    headers = {"Content-Type": "application/octet-stream"}
+    assert to_output_filename("test", headers, sniffed) == "test.mxf"
+    headers = {"Content-Type": "video/mp4"}  # the content is what it is
+    assert to_output_filename("test", headers, sniffed) == "test.mxf"
+    headers = {"Content-Disposition": 'attachment; filename="test.mov"'}
+    assert to_output_filename("test", headers, sniffed) == "test.mov"
+
+
+def test_get_http_session__is_reused():
+    assert get_http_session() is get_http_session()
+    assert get_http_session().headers["Accept-Encoding"] == "identity"
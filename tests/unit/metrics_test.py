@@ -0,0 +1,33 @@
+import time
+from prometheus_client import REGISTRY
+from metrics import DownloadMeter
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_download_meter():
+    labels = {"source_type": "http", "host": "meter-test.example"}
+    in_flight = _sample("dane_download_bytes_in_flight")
+    with DownloadMeter(**labels) as meter:
+        meter.on_chunk(1000)
+        meter.on_chunk(24)
+        assert _sample("dane_download_bytes_in_flight") == in_flight + 1024
+        time.sleep(0.01)
+        meter.observe()
+    assert _sample("dane_download_bytes_in_flight") == in_flight  # done
+
+    assert _sample("dane_download_duration_seconds_count", **labels) == 1
+    assert _sample("dane_download_throughput_bytes_per_second_count", **labels) == 1
+    assert (
+        0 < _sample("dane_download_throughput_bytes_per_second_sum", **labels) < 10**6
+    )
+
+
+def test_download_meter__no_bytes():
+    labels = {"source_type": "s3", "host": "s3://meter-test"}
+    with DownloadMeter(**labels) as meter:
+        meter.observe()  # e.g. a complete .part file that only had to be published
+    assert _sample("dane_download_duration_seconds_count", **labels) == 1
+    assert _sample("dane_download_throughput_bytes_per_second_count", **labels) == 0
@@ -0,0 +1,83 @@
+import os
+import pytest
+from placement import (
+    PLACEMENT_HASH,
+    PLACEMENT_MOST_FREE,
+    PLACEMENT_ROUND_ROBIN,
+    DownloadRoots,
+)
+
+
+def _roots(tmp_path, names) -> list:
+    roots = [str(tmp_path / name) for name in names]
+    for root in roots:
+        os.mkdir(root)
+    return roots
+
+
+def test_place__most_free(tmp_path):
+    roots = _roots(tmp_path, ["a", "b", "c"])
+    bytes_available = {roots[0]: 10, roots[1]: 30, roots[2]: 20}
+    download_roots = DownloadRoots(roots, PLACEMENT_MOST_FREE, bytes_available.get)
+    download_dir = download_roots.place("doc", os.path.join("do", "doc"))
+    assert download_dir == os.path.join(roots[1], "do", "doc")
+    assert os.path.isdir(download_dir)
+
+
+def test_place__round_robin(tmp_path):
+    roots = _roots(tmp_path, ["a", "b"])
+    download_roots = DownloadRoots(roots, PLACEMENT_ROUND_ROBIN)
+    placed = [download_roots.place(doc_id, doc_id) for doc_id in "wxyz"]
+    assert [download_roots.root_of(d) for d in placed] == roots + roots
+
+
+def test_place__hash(tmp_path):
+    roots = _roots(tmp_path, ["a", "b", "c", "d"])
+    doc_ids = [f"doc-{i}" for i in range(100)]
+    download_roots = DownloadRoots(roots, PLACEMENT_HASH)
+    placed = {d: download_roots._choose(d, roots) for d in doc_ids}
+    assert set(placed.values()) == set(roots)  # spread over all of them
+
+    # removing a root only moves its own docs
+    fewer = DownloadRoots(roots[:3], PLACEMENT_HASH)
+    for doc_id, root in placed.items():
+        if root != roots[3]:
+            assert fewer._choose(doc_id, roots[:3]) == root
+
+
+def test_place__existing_dir(tmp_path):
+    roots = _roots(tmp_path, ["a", "b"])
+    os.makedirs(os.path.join(roots[0], "doc"))  # placed (or downloaded) before
+    download_roots = DownloadRoots(roots, PLACEMENT_MOST_FREE, {roots[1]: 1}.get)
+    assert download_roots.place("doc", "doc") == os.path.join(roots[0], "doc")
+
+
+@pytest.mark.parametrize("mounted, expected_root", [(["b"], "b"), ([], None)])
+def test_place__unavailable_root(tmp_path, mounted, expected_root):
+    _roots(tmp_path, mounted)
+    download_roots = DownloadRoots(
+        [str(tmp_path / "a"), str(tmp_path / "b")], PLACEMENT_ROUND_ROBIN
+    )
+    for _ in range(2):
+        download_dir = download_roots.place("doc-id", "doc-id")
+        if expected_root is None:
+            assert download_dir is None
+        else:
+            assert download_dir == str(tmp_path / expected_root / "doc-id")
+    assert not os.path.exists(tmp_path / "a")  # not created on the root volume
+
+
+def test_place__create_roots(tmp_path):
+    temp_folder = str(tmp_path / "mount")  # not created yet
+    download_roots = DownloadRoots([temp_folder], create_roots=True)
+    download_dir = download_roots.place("doc-id", os.path.join("do", "doc-id"))
+    assert download_dir == os.path.join(temp_folder, "do", "doc-id")
+    assert os.path.isdir(download_dir)
+
+
+def test_root_of(tmp_path):
+    download_roots = DownloadRoots([str(tmp_path / "a"), str(tmp_path / "ab")])
+    assert download_roots.root_of(str(tmp_path / "ab" / "file.mp4")) == str(
+        tmp_path / "ab"
+    )
+    assert download_roots.root_of(str(tmp_path / "file.mp4")) is None
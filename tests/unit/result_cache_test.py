@@ -0,0 +1,46 @@
+import time
+from mockito import when, unstub
+import result_cache
+from result_cache import ResultCache
+
+
+PAYLOAD = {"file_path": "/mnt/dane-fs/input-files/dummy.mp3", "file_type": "audio"}
+
+
+def test_get_put():
+    cache = ResultCache()
+    assert cache.get("doc-1") is None
+    cache.put("doc-1", PAYLOAD)
+    assert cache.get("doc-1") == PAYLOAD
+    cache.put("doc-1", {**PAYLOAD, "file_type": "video"})  # replaced
+    assert cache.get("doc-1")["file_type"] == "video"
+    assert len(cache) == 1
+
+
+def test_persistent(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    ResultCache(path).put("doc-1", PAYLOAD)
+    assert ResultCache(path).get("doc-1") == PAYLOAD  # e.g. after a restart
+
+
+def test_ttl():
+    cache = ResultCache(ttl=60)
+    cache.put("doc-1", PAYLOAD)
+    later = time.time() + 61
+    try:
+        when(time).time().thenReturn(later)
+        assert cache.get("doc-1") is None
+        assert len(cache) == 0  # expired entries are removed
+    finally:
+        unstub()
+
+
+def test_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(result_cache, "EVICT_INTERVAL", 1)
+    cache = ResultCache(max_entries=2)
+    cache.put("doc-1", PAYLOAD)
+    cache.put("doc-2", PAYLOAD)
+    cache.get("doc-1")  # doc-2 is now the least recently used
+    cache.put("doc-3", PAYLOAD)
+    assert cache.get("doc-2") is None
+    assert cache.get("doc-1") == PAYLOAD and cache.get("doc-3") == PAYLOAD
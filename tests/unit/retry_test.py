@@ -0,0 +1,142 @@
+import pytest
+from model import DANEResponse, DownloadResult
+from retry import (
+    CircuitBreaker,
+    CircuitOpen,
+    RetryPolicy,
+    download_with_retries,
+    is_transient_status,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _result(state: int, transient: bool = False) -> DownloadResult:
+    return DownloadResult("", DANEResponse(state, ""), False, {}, transient)
+
+
+@pytest.mark.parametrize(
+    "status_code, transient",
+    [(500, True), (503, True), (429, True), (404, False), (403, False)],
+)
+def test_is_transient_status(status_code, transient):
+    assert is_transient_status(status_code) == transient
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(5, base_delay=1.0, max_delay=3.0)
+    for attempt, max_delay in [(0, 1.0), (1, 2.0), (2, 3.0), (10, 3.0)]:
+        delays = [policy.delay(attempt) for _ in range(100)]
+        assert all(0 <= d <= max_delay for d in delays)
+        assert len(set(delays)) > 1  # jittered
+
+
+def test_download_with_retries():
+    outcomes = [_result(503, True), _result(502, True), _result(200)]
+    delays = []
+    result = download_with_retries(
+        lambda: outcomes.pop(0),
+        RetryPolicy(3),
+        CircuitBreaker("a.com"),
+        delays.append,
+    )
+    assert result.dane_response.state == 200
+    assert len(delays) == 2
+
+
+@pytest.mark.parametrize(
+    "outcome, max_attempts, attempts",
+    [
+        (_result(503, True), 3, 3),  # gives up after max_attempts
+        (_result(503, True), 1, 1),  # no retries
+        (_result(404), 3, 1),  # not transient
+    ],
+)
+def test_download_with_retries__fails(outcome, max_attempts, attempts):
+    calls = []
+
+    def download():
+        calls.append(1)
+        return outcome
+
+    result = download_with_retries(
+        download, RetryPolicy(max_attempts), CircuitBreaker("a.com"), lambda s: None
+    )
+    assert result is outcome
+    assert len(calls) == attempts
+
+
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker(
+        "a.com", failure_threshold=2, reset_timeout=60, clock=clock
+    )
+    breaker.record_failure()
+    breaker.before_attempt()  # still closed
+    breaker.record_failure()
+    with pytest.raises(CircuitOpen) as e:
+        breaker.before_attempt()
+    assert e.value.retry_after == 60
+    assert "retry after 60s" in str(e.value)
+
+    clock.now = 61
+    breaker.before_attempt()  # the probe
+    with pytest.raises(CircuitOpen):
+        breaker.before_attempt()  # only one at a time
+    breaker.record_failure()  # the probe failed: open again
+    assert breaker.retry_after() == 60
+
+    clock.now = 122
+    breaker.before_attempt()
+    breaker.record_success()  # the probe succeeded: closed
+    assert breaker.retry_after() == 0
+    breaker.record_failure()
+    breaker.before_attempt()  # counting from 0 again
+
+
+def test_circuit_breaker__disabled():
+    breaker = CircuitBreaker("a.com", failure_threshold=0)
+    for _ in range(100):
+        breaker.record_failure()
+    breaker.before_attempt()
+
+
+def test_download_with_retries__circuit_opens():
+    breaker = CircuitBreaker("a.com", failure_threshold=2)
+    calls = []
+
+    def download():
+        calls.append(1)
+        return _result(503, True)
+
+    result = download_with_retries(download, RetryPolicy(5), breaker, lambda s: None)
+    assert result.transient and len(calls) == 2  # no use retrying
+    with pytest.raises(CircuitOpen):
+        download_with_retries(download, RetryPolicy(5), breaker, lambda s: None)
+    assert len(calls) == 2
+
+
+def test_download_with_retries__probe_raises():
+    clock = Clock()
+    breaker = CircuitBreaker(
+        "a.com", failure_threshold=1, reset_timeout=60, clock=clock
+    )
+    breaker.record_failure()
+    clock.now = 61
+
+    def download():  # e.g. InsufficientDiskSpace, nothing to do with the origin
+        raise OSError("No space left on device")
+
+    with pytest.raises(OSError):
+        download_with_retries(download, RetryPolicy(3), breaker, lambda s: None)
+    assert breaker.retry_after() == 0  # the next attempt probes instead
+    result = download_with_retries(
+        lambda: _result(200), RetryPolicy(3), breaker, lambda s: None
+    )
+    assert result.dane_response.state == 200
@@ -1,9 +1,10 @@
 import pytest
-import boto3
 import os
-from mockito import when, ARGS, KWARGS, mock
+import hashlib
+from mockito import when, verify, ARGS, KWARGS, mock
 import s3_download
-from model import DownloadResult, DANEResponse
+from model import DownloadResult, DANEResponse, DownloadMetadata
+from download_cache import read_sidecar, write_sidecar
 import codecs
 
 # from mockito import when
@@ -14,6 +15,7 @@ DUMMY_SUB_DIR = "path/forward"
 DUMMY_KEY = f"{DUMMY_SUB_DIR}/{DUMMY_FILE}"
 DUMMY_S3_URI = f"s3://{DUMMY_BUCKET}/{DUMMY_KEY}"
 DUMMY_DOWNLOAD_DIR = "download"
+DUMMY_MD5 = hashlib.md5(b"dummy").hexdigest()
 
 
 @pytest.mark.parametrize(
@@ -54,10 +56,10 @@ def test_deconstruct_s3_uri__always_returns_string(uri):
     ],
 )
 def test_download_s3_uri__always_returns_download_result(uri, download_dir):
-    s3_client_mock = mock({"download_fileobj": lambda x, y, z: None})
-    with when(boto3).client("s3").thenReturn(s3_client_mock), when(
-        s3_client_mock
-    ).download_fileobj(**KWARGS).thenReturn():
+    s3_client_mock = mock({"head_object": lambda **kwargs: {}})
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenReturn():
         result = s3_download.download_s3_uri(uri, download_dir)
         assert isinstance(result, DownloadResult)
         assert isinstance(result.dane_response, DANEResponse)
@@ -78,56 +80,72 @@ def test_download_s3_uri__400(uri, download_dir):
     assert result.dane_response.state == 400
 
 
-def test_download_s3_uri__200():
-    s3_client_mock = mock({"download_fileobj": lambda x, y, z: None})
-    fd_mock = mock(
-        {"__enter__": lambda: None, "__exit__": lambda x, y, z: None}
-    )  # context manager functions expected, since with statement is used
-    with when(boto3).client("s3").thenReturn(s3_client_mock), when(
-        s3_client_mock
-    ).download_fileobj(**KWARGS).thenReturn(), when(s3_download).validate_download_dir(
-        DUMMY_DOWNLOAD_DIR
-    ).thenReturn(
-        True
-    ), when(  # mock the opening of the file
-        codecs
-    ).open(
-        *ARGS
-    ).thenReturn(
-        fd_mock
-    ):
+def test_download_s3_uri__200(tmp_path):
+    s3_client_mock = mock(
+        {
+            "head_object": lambda **kwargs: {"ETag": '"etag"'},
+        }
+    )
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenAnswer(lambda s3, b, k, f, *args: f.write(b"dummy")):
         result = s3_download.download_s3_uri(
-            DUMMY_S3_URI, DUMMY_DOWNLOAD_DIR
+            DUMMY_S3_URI, str(tmp_path)
         )  # good uri and download dir
         assert result.dane_response.state == 200
+        assert not result.already_downloaded
+        assert os.path.exists(result.download_file_path)
+        assert not os.path.exists(f"{result.download_file_path}.part")
 
+        metadata = read_sidecar(result.download_file_path)
+        assert metadata.source == DUMMY_S3_URI
+        assert metadata.size == len(b"dummy")
+        assert metadata.etag == '"etag"'
 
-def test_download_s3_uri__200_already_downloaded():
-    s3_client_mock = mock({"download_fileobj": lambda x, y, z: None})
-    with when(boto3).client("s3").thenReturn(s3_client_mock), when(
-        s3_client_mock
-    ).download_fileobj(**KWARGS).thenReturn(), when(s3_download).validate_download_dir(
-        DUMMY_DOWNLOAD_DIR
-    ).thenReturn(
-        True
-    ), when(  # force earlier existence of the download file
-        os.path
-    ).exists(
-        *ARGS
-    ).thenReturn(
-        True
-    ):
+
+@pytest.mark.parametrize(
+    "sidecar, content_length, already_downloaded",
+    [
+        (True, 5, True),
+        (False, 5, True),  # a download without sidecar of the same size is adopted
+        (False, 6, False),  # but not if the size differs
+    ],
+)
+def test_download_s3_uri__200_already_downloaded(
+    tmp_path, sidecar, content_length, already_downloaded
+):
+    download_file_path = os.path.join(str(tmp_path), DUMMY_FILE)
+    with open(download_file_path, "wb") as f:
+        f.write(b"dummy")
+    if sidecar:
+        write_sidecar(
+            download_file_path,
+            DownloadMetadata(DUMMY_S3_URI, len(b"dummy"), '"etag"', "", {}, {}),
+        )
+    s3_client_mock = mock(
+        {
+            "head_object": lambda **kwargs: {
+                "ETag": '"etag"',
+                "ContentLength": content_length,
+            },
+        }
+    )
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenReturn():
         result = s3_download.download_s3_uri(
-            DUMMY_S3_URI, DUMMY_DOWNLOAD_DIR
+            DUMMY_S3_URI, str(tmp_path)
         )  # good uri and download dir
         assert result.dane_response.state == 200
+        assert result.already_downloaded is already_downloaded
+        assert read_sidecar(download_file_path) is not None
 
 
 def test_download_s3_uri__500():
-    s3_client_mock = mock({"download_fileobj": lambda x, y, z: None})
-    with when(boto3).client("s3").thenReturn(s3_client_mock), when(
-        s3_client_mock
-    ).download_fileobj(**KWARGS).thenReturn(), when(s3_download).validate_download_dir(
+    s3_client_mock = mock({"head_object": lambda **kwargs: {}})
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenReturn(), when(s3_download).validate_download_dir(
         DUMMY_DOWNLOAD_DIR
     ).thenReturn(
         True
@@ -142,3 +160,222 @@ def test_download_s3_uri__500():
             DUMMY_S3_URI, DUMMY_DOWNLOAD_DIR
         )  # good uri and download dir
         assert result.dane_response.state == 500
+
+
+@pytest.mark.parametrize(
+    "head, expected",
+    [
+        ({"ETag": f'"{DUMMY_MD5}"'}, {"md5": DUMMY_MD5}),
+        ({"ETag": f'"{DUMMY_MD5}-3"'}, {}),  # multipart upload
+        ({"ETag": f'"{DUMMY_MD5}"', "ServerSideEncryption": "aws:kms"}, {}),
+        (
+            {"ETag": '"abc-2"', "ChecksumCRC32C": "z8SuHQ==", "ChecksumSHA1": "x-2"},
+            {"crc32c": "cfc4ae1d"},
+        ),
+    ],
+)
+def test_extract_declared_checksums(head, expected):
+    assert s3_download.extract_declared_checksums(head) == expected
+
+
+@pytest.mark.parametrize("etag, expected_state", [(DUMMY_MD5, 200), ("0" * 32, 502)])
+def test_download_s3_uri__verify_checksums(tmp_path, etag, expected_state):
+    s3_client_mock = mock(
+        {
+            "head_object": lambda **kwargs: {"ETag": f'"{etag}"'},
+        }
+    )
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenAnswer(lambda s3, b, k, f, *args: f.write(b"dummy")):
+        result = s3_download.download_s3_uri(
+            DUMMY_S3_URI, str(tmp_path), checksums=["md5"]
+        )
+    assert result.dane_response.state == expected_state
+    if expected_state == 200:
+        assert result.file_info["checksums"] == {"md5": DUMMY_MD5}
+        assert read_sidecar(result.download_file_path).file_info == result.file_info
+    else:
+        assert os.listdir(str(tmp_path)) == []
+
+
+def test_to_transfer_config():
+    transfer_config = s3_download.to_transfer_config(
+        {
+            "MULTIPART_THRESHOLD": "16MB",
+            "MULTIPART_CHUNKSIZE": "32MB",
+            "MAX_CONCURRENCY": 64,
+            "USE_THREADS": True,
+        }
+    )
+    assert transfer_config.multipart_threshold == 16 * 10**6
+    assert transfer_config.multipart_chunksize == 32 * 10**6
+    assert transfer_config.max_request_concurrency == 64
+    assert s3_download.max_pool_connections_for(transfer_config) == 64
+    assert s3_download.max_pool_connections_for(None) == 10
+
+
+def test_get_s3_client__is_reused():
+    assert s3_download.get_s3_client() is s3_download.get_s3_client()
+
+
+def test_limit_concurrency():
+    transfer_config = s3_download.to_transfer_config({"MAX_CONCURRENCY": 32})
+    limited = s3_download.limit_concurrency(transfer_config, 8)
+    assert limited.max_request_concurrency == 8
+    assert transfer_config.max_request_concurrency == 32  # not changed in place
+    assert s3_download.limit_concurrency(transfer_config, 64) is transfer_config
+    assert s3_download.limit_concurrency(None, 4).max_request_concurrency == 4
+    assert s3_download.limit_concurrency(None, 10) is None
+
+
+def test_download_s3_uri__sniffs_content(tmp_path):
+    content = b"\x00\x00\x00\x18ftypisom" + b"\x00" * 1024
+    s3_client_mock = mock(
+        {
+            "head_object": lambda **kwargs: {
+                "ContentType": "binary/octet-stream",
+                "ContentLength": len(content),
+            },
+        }
+    )
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenAnswer(
+        lambda s3, b, k, f, *args: [f.write(content[:100]), f.write(content[100:])]
+    ):
+        uri = f"s3://{DUMMY_BUCKET}/{DUMMY_SUB_DIR}/video"  # no extension
+        result = s3_download.download_s3_uri(uri, str(tmp_path))
+        assert result.dane_response.state == 200
+        assert result.download_file_path == str(tmp_path / "video.mp4")
+        assert result.file_info["file_type"] == "video"
+        assert result.file_info["sniffed_type"] == "video/mp4"
+
+        result = s3_download.download_s3_uri(uri, str(tmp_path))
+        assert result.already_downloaded  # found with the added extension
+        assert result.download_file_path == str(tmp_path / "video.mp4")
+
+
+@pytest.mark.parametrize(
+    "size, expected_concurrency",
+    [
+        (10**6, 1),  # below the multipart threshold: a single GET
+        (16 * 10**6, 2),  # only as many connections as there are parts
+        (10**9, 10),  # the max concurrency
+    ],
+)
+def test_planned_concurrency(size, expected_concurrency):
+    transfer_config = s3_download.to_transfer_config(
+        {"MULTIPART_THRESHOLD": "8MB", "MULTIPART_CHUNKSIZE": "8MB"}
+    )
+    assert (
+        s3_download.planned_concurrency(transfer_config, size) == expected_concurrency
+    )
+
+
+@pytest.mark.parametrize(
+    "cached_etag, revalidate, expected_cached",
+    [
+        ('"etag"', True, True),
+        ('"old"', True, False),  # modified, downloaded again with the same HEAD
+        ('"old"', False, True),
+    ],
+)
+def test_download_s3_uri__single_head_request(
+    tmp_path, cached_etag, revalidate, expected_cached
+):
+    download_file_path = os.path.join(str(tmp_path), DUMMY_FILE)
+    with open(download_file_path, "wb") as f:
+        f.write(b"dummy")
+    write_sidecar(
+        download_file_path,
+        DownloadMetadata(DUMMY_S3_URI, len(b"dummy"), cached_etag, "", {}, {}),
+    )
+    s3_client_mock = mock(
+        {"head_object": lambda **kwargs: {"ETag": '"etag"', "ContentLength": 5}}
+    )
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenAnswer(
+        lambda s3, b, k, f, head, *args: f.write(b"dummy")
+    ):
+        result = s3_download.download_s3_uri(
+            DUMMY_S3_URI, str(tmp_path), revalidate=revalidate
+        )
+        assert result.dane_response.state == 200
+        assert result.already_downloaded is expected_cached
+        num_head_requests = 1 if revalidate else 0
+        verify(s3_client_mock, times=num_head_requests).head_object(**KWARGS)
+        if not expected_cached:
+            assert result.file_info["Content-Length"] == 5
+            assert read_sidecar(download_file_path).etag == '"etag"'
+
+
+def test_download_s3_uri__modified_during_download(tmp_path):
+    from botocore.exceptions import ClientError
+
+    error = ClientError({"Error": {"Code": "PreconditionFailed"}}, "GetObject")
+    s3_client_mock = mock({"head_object": lambda **kwargs: {"ETag": '"etag"'}})
+    head = s3_download.ObjectHead(s3_client_mock, DUMMY_BUCKET, DUMMY_KEY)
+    with when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock), when(
+        s3_download
+    ).transfer_object(*ARGS).thenRaise(error):
+        result = s3_download.download_s3_uri(DUMMY_S3_URI, str(tmp_path), head=head)
+        assert result.dane_response.state == 500
+        assert result.transient  # worth another attempt, with a new HEAD request
+        s3_download.download_s3_uri(DUMMY_S3_URI, str(tmp_path), head=head)
+        verify(s3_client_mock, times=2).head_object(**KWARGS)
+
+
+@pytest.mark.parametrize("size, expected_gets", [(5, 1), (12 * 10**6, 3)])
+def test_transfer_object(size, expected_gets):
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+    from s3transfer.futures import TransferMeta
+    import io
+
+    content = os.urandom(size)
+    s3 = s3_download.get_s3_client()
+    transfer_config = s3_download.to_transfer_config(
+        {
+            "MULTIPART_THRESHOLD": "5MB",
+            "MULTIPART_CHUNKSIZE": "5MB",
+            "USE_THREADS": False,
+        }
+    )
+    head = {"ContentLength": size, "ETag": '"etag"'}
+    with Stubber(s3) as stubber:  # fails on any other request, e.g. a HEAD
+        for start in range(0, size, transfer_config.multipart_chunksize):
+            end = min(start + transfer_config.multipart_chunksize, size)
+            expected_params = {"Bucket": DUMMY_BUCKET, "Key": DUMMY_KEY}
+            if expected_gets > 1:
+                last = f"{end - 1}" if end < size else ""  # the last is open
+                expected_params["Range"] = f"bytes={start}-{last}"
+                if hasattr(TransferMeta, "provide_object_etag"):
+                    expected_params["IfMatch"] = '"etag"'
+            stubber.add_response(
+                "get_object",
+                {
+                    "Body": StreamingBody(io.BytesIO(content[start:end]), end - start),
+                    "ContentLength": end - start,
+                },
+                expected_params,
+            )
+        f = io.BytesIO()
+        chunks = []
+        s3_download.transfer_object(
+            s3, DUMMY_BUCKET, DUMMY_KEY, f, head, transfer_config, chunks.append
+        )
+        stubber.assert_no_pending_responses()
+    assert f.getvalue() == content
+    assert sum(chunks) == size
+
+
+def test_known_object__without_etag_support():
+    class TransferMeta:  # of the s3transfer versions without If-Match
+        def provide_transfer_size(self, size):
+            self.size = size
+
+    future = mock({"meta": TransferMeta()})
+    s3_download._KnownObject({"ContentLength": 5, "ETag": '"etag"'}).on_queued(future)
+    assert future.meta.size == 5
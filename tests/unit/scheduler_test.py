@@ -0,0 +1,91 @@
+import threading
+import time
+import pytest
+from scheduler import OriginLimiter, OriginScheduler, TokenBucket, to_origin
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10**6)  # starts with a burst of one second
+    start = time.monotonic()
+    bucket.consume(10**6)
+    assert time.monotonic() - start < 0.1
+    bucket.consume(2 * 10**5)  # in debt: sleeps until it is paid off
+    assert time.monotonic() - start >= 0.15
+
+
+def test_origin_limiter__connections():
+    limiter = OriginLimiter(max_connections=4)
+    with limiter.connections(8) as num_connections:
+        assert num_connections == 4  # capped at the origin's limit
+
+    acquired = threading.Event()
+
+    def other_download():
+        with limiter.connections(1):
+            acquired.set()
+
+    with limiter.connections(4):
+        thread = threading.Thread(target=other_download)
+        thread.start()
+        assert not acquired.wait(0.1)  # all connections in use
+    assert acquired.wait(1)  # available again
+    thread.join()
+
+
+def test_origin_limiter__available_connections():
+    limiter = OriginLimiter(max_connections=4)
+    with limiter.connections(1):
+        with limiter.available_connections(8) as num_connections:
+            assert num_connections == 3  # what is left, without waiting
+            with limiter.available_connections(2) as more:
+                assert more == 0
+        with limiter.available_connections(2) as num_connections:
+            assert num_connections == 2  # released again
+    with OriginLimiter().available_connections(8) as num_connections:
+        assert num_connections == 8
+
+
+def test_origin_limiter__unlimited():
+    limiter = OriginLimiter()
+    with limiter.connections(8) as num_connections, limiter.connections(8):
+        assert num_connections == 8
+    start = time.monotonic()
+    limiter.throttle(10**9)
+    assert time.monotonic() - start < 0.1
+
+
+def test_origin_limiter__delay():
+    limiter = OriginLimiter(max_bandwidth=1000)
+    assert limiter.delay(1000) == 0  # a burst of one second
+    assert limiter.delay(500) == pytest.approx(0.5, abs=0.05)  # without blocking
+    assert OriginLimiter().delay(10**9) == 0
+
+
+def test_origin_scheduler():
+    scheduler = OriginScheduler(
+        [
+            {"ORIGIN": "Archive.example", "MAX_CONNECTIONS": 2},
+            {"ORIGIN": "*", "MAX_CONNECTIONS": 8, "MAX_BANDWIDTH": "10MB"},
+        ]
+    )
+    limiter = scheduler.limiter_for("archive.example")
+    assert limiter is scheduler.limiter_for("archive.example")  # shared by tasks
+    assert (limiter.max_connections, limiter.max_bandwidth) == (2, 0)
+
+    other = scheduler.limiter_for("s3://bucket")
+    assert other is not scheduler.limiter_for("other.example")  # not shared
+    assert (other.max_connections, other.max_bandwidth) == (8, 10**7)
+
+    assert OriginScheduler([]).limiter_for("archive.example").max_connections == 0
+
+
+@pytest.mark.parametrize(
+    "url, origin",
+    [
+        ("https://Archive.example:8080/video.mp4", "archive.example"),
+        ("http://archive.example/path/to?id=1", "archive.example"),
+        ("s3://bucket/path/to/video.mp4", "s3://bucket"),
+    ],
+)
+def test_to_origin(url, origin):
+    assert to_origin(url) == origin
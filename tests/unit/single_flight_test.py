@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+import threading
+import time
+from single_flight import SingleFlight, LOCK_SUFFIX
+
+
+def _hold_lock(path: str, locked, release):
+    with SingleFlight().acquire(path):
+        locked.set()
+        release.wait(5)
+
+
+def test_acquire__threads(tmp_path):
+    single_flight = SingleFlight()
+    path = str(tmp_path / "video.mp4")
+    events = []
+
+    def download(name: str):
+        with single_flight.acquire(path):
+            events.append(f"{name}-start")
+            time.sleep(0.05)
+            events.append(f"{name}-end")
+
+    threads = [threading.Thread(target=download, args=(n,)) for n in "ab"]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the downloads of the same path did not overlap
+    assert events[0][0] == events[1][0] and events[2][0] == events[3][0]
+    assert single_flight._locks == {}
+    assert os.listdir(str(tmp_path)) == []  # the lock file is removed
+
+
+def test_acquire__processes(tmp_path):
+    path = str(tmp_path / "video.mp4")
+    context = multiprocessing.get_context("fork")
+    locked, release = context.Event(), context.Event()
+    other_worker = context.Process(target=_hold_lock, args=(path, locked, release))
+    other_worker.start()
+    try:
+        assert locked.wait(5)
+        assert os.path.exists(f"{path}{LOCK_SUFFIX}")
+        threading.Timer(0.2, release.set).start()
+        start = time.monotonic()
+        with SingleFlight().acquire(path):  # waits for the other worker
+            assert time.monotonic() - start >= 0.15
+    finally:
+        release.set()
+        other_worker.join(5)
+    assert not os.path.exists(f"{path}{LOCK_SUFFIX}")
+
+
+def test_acquire__without_lock_support(tmp_path):
+    path = str(tmp_path / "missing-dir" / "video.mp4")  # lock file cannot be made
+    with SingleFlight().acquire(path):
+        pass
@@ -0,0 +1,51 @@
+import threading
+import pytest
+from timing import Timings, current, recording, span
+
+
+def test_span():
+    timings = Timings()
+    with recording(timings):
+        assert current() is timings
+        with span("transfer") as s:
+            s.num_bytes = 10
+        with span("transfer") as s:  # adds up
+            s.num_bytes = 5
+        with span("publish"):
+            pass
+    assert current() is None
+    assert set(timings.durations) == {"transfer", "publish"}
+    assert timings.num_bytes == {"transfer": 15}  # only phases that moved bytes
+
+
+def test_span__error():
+    timings = Timings()
+    with recording(timings), pytest.raises(ValueError):
+        with span("verify"):
+            raise ValueError("corrupt")
+    assert "verify" in timings.durations
+
+
+def test_span__not_recording():
+    with span("transfer") as s:
+        s.num_bytes = 10  # nothing to record it in
+    assert current() is None
+
+
+def test_recording__per_thread():
+    timings = Timings()
+    seen = []
+    with recording(timings):
+        thread = threading.Thread(target=lambda: seen.append(current()))
+        thread.start()
+        thread.join()
+    assert seen == [None]  # each task thread records its own timings
+
+
+def test_to_json():
+    timings = Timings()
+    timings.add("download", 1.23456789, 100)
+    assert timings.to_json() == {
+        "seconds": {"download": 1.234568},
+        "bytes": {"download": 100},
+    }
@@ -1,8 +1,19 @@
+import hashlib
 import json
+import subprocess
+import sys
+import threading
+import time
 import os
 import pytest
 from mockito import unstub, when, verify
+from prometheus_client import REGISTRY
 from worker import DownloadWorker
+from disk_ledger import DiskLedger
+from download_cache import publish_download
+from model import DownloadMetadata
+from placement import PLACEMENT_ROUND_ROBIN, DownloadRoots
+from retry import CircuitBreakers, RetryPolicy
 from dane import Result, Document, Task
 from dane import errors
 
@@ -112,38 +123,6 @@ def test_check_whitelist(config, url, whitelist, in_whitelist):
         unstub()
 
 
-@pytest.mark.parametrize(
-    "threshold, file_within_threshold, free_disk_space",
-    [  # 10MB free disk for most examples
-        (10**6, True, 10**7),  # 1MB
-        (10**7 - 1, True, 10**7),  # 10MB minus one byte
-        (
-            10**7,
-            False,
-            10**7,
-        ),  # 10MB is the same as the bytes free, which is not accepted
-        (10**8, False, 10**7),  # 100MB
-        (10**9, False, 10**7),  # 1GB
-        (10**9, True, 10**10),  # 1GB (now 10GB free)
-    ],
-)
-def test_check_download_threshold(
-    config, threshold, file_within_threshold, free_disk_space
-):
-    try:
-        w = DownloadWorker(config)
-        when(w)._get_bytes_free(DUMMY_DOWNLOAD_DIR).thenReturn(
-            free_disk_space
-        )  # 10 MB free
-        assert (
-            w._check_download_threshold(threshold, DUMMY_DOWNLOAD_DIR)
-            is file_within_threshold
-        )
-        verify(w, times=1)._get_bytes_free(DUMMY_DOWNLOAD_DIR)
-    finally:
-        unstub()
-
-
 # TODO test with Task.args.PATHS.TEMP_FOLDER (now it is always None)
 @pytest.mark.parametrize(
     "doc, task, download_path_exists",
@@ -181,3 +160,369 @@ def test_determine_download_dir(config, doc, task, download_path_exists):
         verify(os.path, times=1).exists(dane_dirs["TEMP_FOLDER"])
     finally:
         unstub()
+
+
+def test_generate_dane_dirs_for_doc__creates_temp_folder(config, tmp_path):
+    config = config.clone()
+    config.defrost()
+    config.PATHS.TEMP_FOLDER = str(tmp_path / "mount")  # not created yet
+    config.freeze()
+    try:
+        w = DownloadWorker(config)
+        download_dir = w._generate_dane_dirs_for_doc(DUMMY_DOC)
+        assert download_dir.startswith(config.PATHS.TEMP_FOLDER)
+        assert download_dir.endswith(DUMMY_DOC._id)
+        assert os.path.isdir(download_dir)
+    finally:
+        unstub()
+
+
+def test_lock_download_path(config):
+    try:
+        w = DownloadWorker(config)
+        events = []
+
+        def download(name: str):
+            with w._lock_download_path(DUMMY_FILE_PATH):
+                events.append(f"{name}-start")
+                time.sleep(0.05)
+                events.append(f"{name}-end")
+
+        threads = [threading.Thread(target=download, args=(n,)) for n in "ab"]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # the downloads of the same path did not overlap
+        assert events[0][0] == events[1][0] and events[2][0] == events[3][0]
+        assert w.single_flight._locks == {}  # no locks are kept around
+    finally:
+        unstub()
+
+
+@pytest.mark.parametrize(
+    "url, is_s3, download_path",
+    [
+        ("http://dummy.nl/path/to/file.mp3", False, f"{DUMMY_DOWNLOAD_DIR}/file.mp3"),
+        ("http://dummy.nl/path/to/file", False, f"{DUMMY_DOWNLOAD_DIR}/file"),
+        ("s3://bucket/path/to/file.mp3", True, f"{DUMMY_DOWNLOAD_DIR}/file.mp3"),
+    ],
+)
+def test_to_download_path(config, url, is_s3, download_path):
+    w = DownloadWorker(config)
+    assert w._to_download_path(url, DUMMY_DOWNLOAD_DIR, is_s3) == download_path
+
+
+def test_callback__counts_responses(config):
+    try:
+        w = DownloadWorker(config)
+        count = (
+            REGISTRY.get_sample_value("dane_download_responses_total", {"state": "403"})
+            or 0
+        )
+        when(w)._process_download_task(DUMMY_TASK, DUMMY_DOC).thenReturn(
+            {"state": 403, "message": "Source URL not in whitelist"}
+        )
+        assert w.callback(DUMMY_TASK, DUMMY_DOC)["state"] == 403
+        assert (
+            REGISTRY.get_sample_value("dane_download_responses_total", {"state": "403"})
+            == count + 1
+        )
+    finally:
+        unstub()
+
+
+def test_download__asyncio_engine(config, http_server, tmp_path):
+    http_server.files["/page.html"] = {"content": b"<p>foo</p>"}
+    w = DownloadWorker(config)
+    try:
+        result = w._download(
+            f"{http_server.url}/page.html", str(tmp_path), False, None, "asyncio"
+        )
+        assert result.dane_response.state == 200
+        assert w._async_http_engine is not None  # started on first use
+    finally:
+        if w._async_http_engine:
+            w._async_http_engine.close()
+
+
+def test_process_download_task__invalid_http_engine(config):
+    w = DownloadWorker(config)
+    doc = Document.from_json(
+        json.dumps(
+            {
+                "target": {
+                    "id": "dummy_id_12345",
+                    "url": "http://myownvideos.com/dummy.mp3",
+                    "type": "Video",
+                },
+                "creator": {"id": "UNIT TEST", "type": "Organization"},
+            }
+        )
+    )
+    task = Task("DOWNLOAD", args={"HTTP_ENGINE": "curl"})
+    assert w._process_download_task(task, doc)["state"] == 400
+
+
+def test_save_prior_download_result__recorded(config, tmp_path):
+    try:
+        w = DownloadWorker(config)
+        file_path = str(tmp_path / "dummy.mp3")
+        with open(f"{file_path}.part", "wb") as f:
+            f.write(b"dummy")
+        publish_download(
+            f"{file_path}.part",
+            file_path,
+            DownloadMetadata("http://dummy.com/dummy.mp3", 5, "", "", {}, {}),
+        )
+        when(Result).save(DUMMY_TASK._id).thenReturn()
+        w._remember_result(DUMMY_DOC._id, {"file_path": file_path})
+
+        w = DownloadWorker(config)  # e.g. restarted, with an empty result cache
+        when(w)._get_prior_download_results(DUMMY_DOC._id).thenReturn([])
+        assert w._save_prior_download_result(DUMMY_DOC, DUMMY_TASK, file_path)
+        verify(w, times=0)._get_prior_download_results(DUMMY_DOC._id)  # no ES
+    finally:
+        unstub()
+
+
+def test_save_prior_download_result__cached(config, tmp_path):
+    try:
+        w = DownloadWorker(config)
+        file_path = str(tmp_path / "dummy.mp3")
+        open(file_path, "wb").close()
+        w.result_cache.put(DUMMY_DOC._id, {"file_path": file_path})
+        when(w)._get_prior_download_results(DUMMY_DOC._id).thenReturn([])
+        when(Result).save(DUMMY_TASK._id).thenReturn()
+        assert w._save_prior_download_result(DUMMY_DOC, DUMMY_TASK) is True
+        verify(w, times=0)._get_prior_download_results(DUMMY_DOC._id)  # no ES
+
+        os.remove(file_path)  # a cached result of a removed file is not used
+        assert w._save_prior_download_result(DUMMY_DOC, DUMMY_TASK) is False
+        verify(w, times=1)._get_prior_download_results(DUMMY_DOC._id)
+    finally:
+        unstub()
+
+
+def _doc_with_url(url: str) -> Document:
+    return Document.from_json(
+        json.dumps(
+            {
+                "target": {"id": "dummy_id_12345", "url": url, "type": "Video"},
+                "creator": {"id": "UNIT TEST", "type": "Organization"},
+                "_id": "dummy-uuid-12345-43214",
+            }
+        )
+    )
+
+
+def _prefetching_worker(config, http_server) -> DownloadWorker:
+    w = DownloadWorker(config)
+    w.whitelist = ["127.0.0.1"]
+    w.prefetch = 2
+    http_server.files["/video.mp4"] = {"content": b"0123456789"}
+    return w
+
+
+def test_prepare_download(config, http_server, tmp_path):
+    w = _prefetching_worker(config, http_server)
+    task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": str(tmp_path)}})
+    url = f"{http_server.url}/video.mp4"
+    prepared = w._prepare_download(task, _doc_with_url(url))
+    assert prepared.download_path == os.path.join(str(tmp_path), "video.mp4")
+    assert not prepared.cached
+    assert prepared.expected_size == 10  # HEAD while prefetching
+    assert [r[0] for r in http_server.requests] == ["HEAD"]
+
+    w._download(url, str(tmp_path), False)
+    prepared = w._prepare_download(task, _doc_with_url(url))
+    assert prepared.cached and prepared.expected_size == -1  # no HEAD needed
+
+
+def test_prepare_download__s3_head_is_reused(config, tmp_path):
+    import s3_download
+    import worker
+    from mockito import ARGS, KWARGS, mock
+
+    etag = f'"{hashlib.md5(b"dummy").hexdigest()}"'  # checksums may be verified
+    s3_client_mock = mock(
+        {"head_object": lambda **kwargs: {"ETag": etag, "ContentLength": 5}}
+    )
+    try:
+        when(s3_download).get_s3_client(*ARGS).thenReturn(s3_client_mock)
+        when(worker).get_s3_client(*ARGS).thenReturn(s3_client_mock)
+        when(s3_download).transfer_object(*ARGS).thenAnswer(
+            lambda s3, b, k, f, head, *args: f.write(b"dummy")
+        )
+        w = DownloadWorker(config)
+        task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": str(tmp_path)}})
+        doc = _doc_with_url("s3://bucket/path/video.mp4")
+        prepared = w._prepare_download(task, doc)
+        assert prepared.expected_size == 5  # also without prefetching
+        result = w._download(
+            prepared.target_url,
+            prepared.download_dir,
+            True,
+            s3_head=prepared.s3_head,
+        )
+        assert result.dane_response.state == 200
+        assert result.file_info["Content-Length"] == 5
+        verify(s3_client_mock, times=1).head_object(**KWARGS)
+    finally:
+        unstub()
+
+
+def _run_with_timeout(func, *args):
+    outcome = []
+    thread = threading.Thread(
+        target=lambda: outcome.append(_call_capturing(func, *args)), daemon=True
+    )
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive(), "waited for a download slot"
+    return outcome[0]
+
+
+def _call_capturing(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return e
+
+
+def test_process_download_task__cached_needs_no_slot(config, http_server, tmp_path):
+    try:
+        w = _prefetching_worker(config, http_server)
+        task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": str(tmp_path)}})
+        doc = _doc_with_url(f"{http_server.url}/video.mp4")
+        w._download(doc.target["url"], str(tmp_path), False)
+        when(w)._save_prior_download_result(doc, task, ...).thenReturn(True)
+        with w._download_slots:  # all slots are taken by other downloads
+            response = _run_with_timeout(w._process_download_task, task, doc)
+        assert response["state"] == 201
+    finally:
+        unstub()
+
+
+def test_process_download_task__refused_before_slot(config, http_server, tmp_path):
+    w = _prefetching_worker(config, http_server)
+    w.disk_ledger = DiskLedger(0, lambda download_dir: 5)  # the source is 10 bytes
+    task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": str(tmp_path)}})
+    doc = _doc_with_url(f"{http_server.url}/video.mp4")
+    with w._download_slots:
+        outcome = _run_with_timeout(w._process_download_task, task, doc)
+    assert isinstance(outcome, errors.RefuseJobException)
+    assert [r[0] for r in http_server.requests] == ["HEAD"]
+
+
+def test_process_download_task__single_flight(config, http_server, tmp_path):
+    try:
+        w = _prefetching_worker(config, http_server)
+        w.prefetch = 0
+        task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": str(tmp_path)}})
+        task._id = "dummy-task-id"
+        doc = _doc_with_url(f"{http_server.url}/video.mp4")
+        when(Result).save(task._id).thenReturn()
+        when(w)._save_prior_download_result(doc, task, ...).thenReturn(True)
+        responses = []
+        threads = [
+            threading.Thread(
+                target=lambda: responses.append(w._process_download_task(task, doc))
+            )
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(r["state"] for r in responses) == [200, 201, 201, 201]
+        assert [r[0] for r in http_server.requests] == ["GET"]  # downloaded once
+    finally:
+        unstub()
+
+
+def test_callback__timings(config, http_server, tmp_path, caplog):
+    try:
+        w = _prefetching_worker(config, http_server)
+        w.result_timings = True
+        task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": str(tmp_path)}})
+        task._id = "dummy-task-id"
+        doc = _doc_with_url(f"{http_server.url}/video.mp4")
+        when(Result).save(task._id).thenReturn()
+        with caplog.at_level("INFO", logger="timing"):
+            assert w.callback(task, doc)["state"] == 200
+
+        payload = w.result_cache.get(doc._id)
+        assert {"prepare", "wait", "download", "request", "transfer"} <= set(
+            payload["timings"]["seconds"]
+        )
+        assert payload["timings"]["bytes"] == {"transfer": 10}
+        record = next(r for r in caplog.records if r.name == "timing")
+        assert record.timings["task_id"] == task._id
+        assert record.timings["state"] == 200
+        assert "save_result" in record.timings["seconds"]  # after the payload
+    finally:
+        unstub()
+
+
+def test_callback__download_roots(config, http_server, tmp_path):
+    try:
+        w = _prefetching_worker(config, http_server)
+        roots = [str(tmp_path / "volume-1"), str(tmp_path / "volume-2")]
+        for root in roots:
+            os.mkdir(root)
+        w.download_roots = DownloadRoots(roots, PLACEMENT_ROUND_ROBIN)
+        task = Task("DOWNLOAD")  # no TEMP_FOLDER, placed on a download root
+        task._id = "dummy-task-id"
+        when(Result).save(task._id).thenReturn()
+        payloads = []
+        for doc_id in ["doc-1", "doc-2"]:
+            doc = _doc_with_url(f"{http_server.url}/video.mp4")
+            doc._id = doc_id
+            assert w.callback(task, doc)["state"] == 200
+            payloads.append(w.result_cache.get(doc._id))
+
+        assert [p["download_root"] for p in payloads] == roots
+        for payload in payloads:
+            assert payload["file_path"].startswith(payload["download_root"])
+            assert os.path.exists(payload["file_path"])
+    finally:
+        unstub()
+
+
+def test_startup__no_boto3():
+    # in a fresh process, this one has long loaded boto3 for the S3 tests
+    code = (
+        "import sys; from dane.config import cfg; from worker import DownloadWorker; "
+        "DownloadWorker(cfg); print('boto3' in sys.modules)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "DW_DOWNLOAD_UNIT_TESTING": "true"},
+    ).stdout
+    assert output.strip().splitlines()[-1] == "False"  # loaded on first S3 use
+
+
+def test_download__retries(config, http_server, tmp_path):
+    w = DownloadWorker(config)
+    w.retry_policy = RetryPolicy(3, base_delay=0, max_delay=0)
+    w.circuit_breakers = CircuitBreakers(failure_threshold=5)
+    url = f"{http_server.url}/error.mp4"
+    result = w._download(url, str(tmp_path), False)
+    assert result.dane_response.state == 503
+    assert len(http_server.requests) == 3
+
+    result = w._download(url, str(tmp_path), False)  # the circuit opens on the 5th
+    assert len(http_server.requests) == 5
+    result = w._download(url, str(tmp_path), False)
+    assert result.dane_response.state == 503
+    assert "retry after 60s" in result.dane_response.message
+    assert len(http_server.requests) == 5  # failed fast
+
+    w.whitelist = ["127.0.0.1"]  # refused before waiting for a download slot
+    task = Task("DOWNLOAD", args={"PATHS": {"TEMP_FOLDER": str(tmp_path)}})
+    assert w._prepare_download(task, _doc_with_url(url)).state == 503
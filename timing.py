@@ -0,0 +1,80 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+
+class Timings:
+    """Durations and bytes per phase of one task (a phase that occurs more than
+    once adds up), recorded by the spans that run while it is active"""
+
+    def __init__(self) -> None:
+        self.durations: Dict[str, float] = {}
+        self.num_bytes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float, num_bytes: int = 0):
+        with self._lock:
+            self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+            if num_bytes:
+                self.num_bytes[phase] = self.num_bytes.get(phase, 0) + num_bytes
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "seconds": {k: round(v, 6) for k, v in self.durations.items()},
+                "bytes": dict(self.num_bytes),
+            }
+
+
+class Span:
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.num_bytes = 0  # set by the instrumented code, if it moves bytes
+
+
+# the Timings of the task running in this thread (None outside of a task)
+_current: ContextVar[Timings | None] = ContextVar("timings", default=None)
+
+
+def current() -> Timings | None:
+    return _current.get()
+
+
+@contextmanager
+def recording(timings: Timings) -> Iterator[Timings]:
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+# times its block for the active Timings; without one it only costs a lookup
+@contextmanager
+def span(phase: str) -> Iterator[Span]:
+    s = Span(phase)
+    timings = _current.get()
+    start = time.perf_counter()
+    try:
+        yield s
+    finally:
+        if timings is not None:
+            timings.add(phase, time.perf_counter() - start, s.num_bytes)
+
+
+# one structured record per task: the fields, total and phase durations as
+# JSON in the message and as the "timings" attribute of the log record
+def log(timings: Timings, total_seconds: float, **fields):
+    record = {
+        **fields,
+        "total_seconds": round(total_seconds, 6),
+        **timings.to_json(),
+    }
+    logger.info(f"Task timings: {json.dumps(record)}", extra={"timings": record})
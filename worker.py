@@ -1,17 +1,76 @@
 import sys
 import logging
+import threading
+import time
+from contextlib import ExitStack, nullcontext
+from functools import cached_property
 from requests.utils import requote_uri
 from urllib.parse import urlparse
 import os
-import validators
 from dane.base_classes import base_worker
 from dane.config import cfg
 from dane import Result, Task, Document
 from dane import errors
 from base_util import validate_config, parse_file_size, LOG_FORMAT
-from s3_download import download_s3_uri
-from http_download import download_http
-from model import DANEResponse
+from s3_download import (
+    download_s3_uri,
+    to_transfer_config,
+    deconstruct_s3_uri,
+    get_s3_client,
+    max_pool_connections_for,
+    ObjectHead,
+)
+from http_download import (
+    download_http,
+    DEFAULT_MIN_SEGMENT_SIZE,
+    is_unmodified as http_is_unmodified,
+    head_content_length as http_head_content_length,
+)
+from http_util import (
+    get_http_session,
+    url_to_safe_filename,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_POOL_MAXSIZE,
+    DEFAULT_READ_TIMEOUT,
+    HTTP_ENGINES,
+    HTTP_ENGINE_ASYNCIO,
+    HTTP_ENGINE_THREADS,
+)
+from async_download import AsyncHttpEngine, DEFAULT_MAX_CONNECTIONS
+from content_store import ContentStore, DIGEST_ALGORITHM
+from disk_io import (
+    WriteOptions,
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_WRITE_BUFFERS,
+    FSYNC_AT_END,
+)
+from result_cache import ResultCache, IN_MEMORY, DEFAULT_TTL, DEFAULT_MAX_ENTRIES
+from scheduler import OriginScheduler, to_origin
+from disk_ledger import DiskLedger, DiskReservation, InsufficientDiskSpace
+from placement import PLACEMENT_MOST_FREE, DownloadRoots, volume_bytes_free
+from single_flight import SingleFlight
+from retry import (
+    CircuitBreakers,
+    CircuitOpen,
+    RetryPolicy,
+    download_with_retries,
+    DEFAULT_MAX_ATTEMPTS,
+    DEFAULT_BASE_DELAY,
+    DEFAULT_MAX_DELAY,
+    DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_RESET_TIMEOUT,
+)
+from timing import Timings, recording, span
+import timing
+from metrics import (
+    CACHE_HITS,
+    BYTES_FREE,
+    RESPONSES,
+    DownloadMeter,
+    start_metrics_server,
+)
+from download_cache import find_downloaded_file, record_result, recorded_result
+from model import DANEResponse, DownloadMetadata, DownloadResult, PreparedDownload
 
 
 # initialises the root logger
@@ -28,7 +87,9 @@ class DownloadWorker(base_worker):
     # listen to the same queue
     __queue_name = "DOWNLOAD"
 
-    def __init__(self, config):
+    # standalone: without RabbitMQ and Elasticsearch, only to call download_to
+    # (see bulk_download.py)
+    def __init__(self, config, standalone: bool = False):
         logger.debug(config)
 
         self.UNIT_TESTING = os.getenv("DW_DOWNLOAD_UNIT_TESTING", False)
@@ -38,20 +99,142 @@ class DownloadWorker(base_worker):
             quit()
 
         self.whitelist = config.DOWNLOADER.WHITELIST
+        # connection and bandwidth limits per origin, shared by all tasks
+        self.scheduler = OriginScheduler(config.DOWNLOADER.get("ORIGIN_LIMITS", []))
         self.threshold = None
         if "FS_THRESHOLD" in config.DOWNLOADER.keys():
             # in bytes, might only work on Unix
             self.threshold = parse_file_size(config.DOWNLOADER.FS_THRESHOLD)
+        # disk space reserved for the downloads in flight, based on their size
+        self.disk_ledger = DiskLedger(self.threshold or 0, self._get_bytes_free)
+        # the volumes the download dirs of the docs are spread over
+        # (PATHS.TEMP_FOLDER by default, created if needed like DANE does)
+        download_roots = list(config.DOWNLOADER.get("DOWNLOAD_ROOTS", None) or [])
+        self.download_roots = DownloadRoots(
+            download_roots or [config.PATHS.TEMP_FOLDER],
+            config.DOWNLOADER.get("PLACEMENT", None) or PLACEMENT_MOST_FREE,
+            self._get_bytes_available,
+            not download_roots,
+        )
+
+        # parallel Range requests per HTTP download (1 means a single stream)
+        self.http_segments = config.DOWNLOADER.get("HTTP_SEGMENTS", None) or 1
+        self.http_min_segment_size = DEFAULT_MIN_SEGMENT_SIZE
+        if config.DOWNLOADER.get("HTTP_MIN_SEGMENT_SIZE", None):
+            self.http_min_segment_size = parse_file_size(
+                config.DOWNLOADER.HTTP_MIN_SEGMENT_SIZE
+            )
+
+        # how HTTP downloads are written: read buffer, preallocation, page cache,
+        # buffers between the network and the writer thread, syncing to disk
+        http_fsync = config.DOWNLOADER.get("HTTP_FSYNC", None) or ""
+        self.http_write_options = WriteOptions(
+            parse_file_size(config.DOWNLOADER.HTTP_BUFFER_SIZE)
+            if config.DOWNLOADER.get("HTTP_BUFFER_SIZE", None)
+            else DEFAULT_BUFFER_SIZE,
+            config.DOWNLOADER.get("HTTP_PREALLOCATE", True),
+            parse_file_size(config.DOWNLOADER.HTTP_DROP_CACHE_SIZE)
+            if config.DOWNLOADER.get("HTTP_DROP_CACHE_SIZE", None)
+            else 0,
+            config.DOWNLOADER.get("HTTP_WRITE_BUFFERS", None) or DEFAULT_WRITE_BUFFERS,
+            http_fsync != "",
+            parse_file_size(http_fsync) if http_fsync not in ["", FSYNC_AT_END] else 0,
+        )
+
+        # check already downloaded files with the source (conditional request)
+        self.cache_revalidate = config.DOWNLOADER.get("CACHE_REVALIDATE", False)
+
+        # number of tasks downloading at the same time (also the queue prefetch)
+        self.concurrency = config.DOWNLOADER.get("CONCURRENCY", None) or 1
+        self._download_slots = threading.BoundedSemaphore(self.concurrency)
+        # extra tasks received (and prepared) while the slots are taken
+        self.prefetch = config.DOWNLOADER.get("PREFETCH", None) or 0
+        # one download per file path, over all tasks and workers (shared volume)
+        self.single_flight = SingleFlight()
+
+        # transient failures (5xx, lost connections, throttling) are retried with
+        # backoff, origins that keep failing are not tried for a while
+        retry = config.DOWNLOADER.get("RETRY", None) or {}
+        self.retry_policy = RetryPolicy(
+            retry.get("MAX_ATTEMPTS", None) or DEFAULT_MAX_ATTEMPTS,
+            retry.get("BASE_DELAY", DEFAULT_BASE_DELAY),
+            retry.get("MAX_DELAY", DEFAULT_MAX_DELAY),
+        )
+        circuit_breaker = config.DOWNLOADER.get("CIRCUIT_BREAKER", None) or {}
+        self.circuit_breakers = CircuitBreakers(
+            circuit_breaker.get("FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD),
+            circuit_breaker.get("RESET_TIMEOUT", DEFAULT_RESET_TIMEOUT),
+        )
+
+        # keep-alive connection pool per whitelisted host, shared by all tasks
+        # (connect, read) timeouts of HTTP requests, so stalled sources fail
+        self.http_timeouts = (
+            config.DOWNLOADER.get("HTTP_CONNECT_TIMEOUT", None)
+            or DEFAULT_CONNECT_TIMEOUT,
+            config.DOWNLOADER.get("HTTP_READ_TIMEOUT", None) or DEFAULT_READ_TIMEOUT,
+        )
+        self.http_session = get_http_session(
+            max(1, len(self.whitelist)),
+            max(DEFAULT_POOL_MAXSIZE, self.http_segments * self.concurrency),
+            *self.http_timeouts,
+        )
+
+        # "asyncio" runs the HTTP downloads on one event loop (for small files),
+        # tasks can override it with the HTTP_ENGINE argument
+        self.http_engine = config.DOWNLOADER.get("HTTP_ENGINE", HTTP_ENGINE_THREADS)
+        self.async_http_connections = (
+            config.DOWNLOADER.get("ASYNC_HTTP_CONNECTIONS", None)
+            or DEFAULT_MAX_CONNECTIONS
+        )
+        self._async_http_engine: AsyncHttpEngine | None = None  # started when used
+        self._async_http_engine_lock = threading.Lock()
+
+        # multipart settings for S3 downloads, see s3_transfer_config
+        self.s3_transfer_settings = config.DOWNLOADER.get("S3_TRANSFER", {})
+
+        # optional content-addressed store, to download identical sources once
+        # (disabled if it cannot link into any download root, so downloads do
+        # not pay for its digest in vain)
+        self.content_store = None
+        if config.DOWNLOADER.get("CONTENT_STORE", None):
+            content_store = ContentStore(config.DOWNLOADER.CONTENT_STORE)
+            if content_store.check_roots(self.download_roots.roots):
+                self.content_store = content_store
+            else:
+                logger.error("Content store disabled: no download root to link into")
+
+        # digests computed while downloading (the content store needs sha256)
+        checksums = list(config.DOWNLOADER.get("CHECKSUMS", []))
+        if self.content_store and DIGEST_ALGORITHM not in checksums:
+            checksums.append(DIGEST_ALGORITHM)
+        self.checksums = checksums or None
+
+        # add the time spent per phase of the task to the payload of its Result
+        self.result_timings = config.DOWNLOADER.get("RESULT_TIMINGS", False)
+
+        # payloads of the saved results per doc, so re-runs need not search ES
+        # (also recorded in the sidecars of the downloads, see _remember_result)
+        self.result_cache = ResultCache(
+            config.DOWNLOADER.get("RESULT_CACHE_FILE", None) or IN_MEMORY,
+            config.DOWNLOADER.get("RESULT_CACHE_TTL", None) or DEFAULT_TTL,
+            config.DOWNLOADER.get("RESULT_CACHE_SIZE", None) or DEFAULT_MAX_ENTRIES,
+        )
+
+        # Prometheus metrics endpoint (0 means disabled)
+        metrics_port = config.DOWNLOADER.get("METRICS_PORT", 0)
+        if metrics_port and not self.UNIT_TESTING:
+            start_metrics_server(metrics_port)
 
         super().__init__(
             queue=self.__queue_name,
             binding_key="#.DOWNLOAD",
             config=config,
-            auto_connect=not self.UNIT_TESTING,
-            no_api=self.UNIT_TESTING,
+            auto_connect=not (self.UNIT_TESTING or standalone),
+            no_api=self.UNIT_TESTING or standalone,
         )
 
         # NOTE: cannot be automaticcally filled, because no git client is present
+        self.generator: dict | None  # set by base_worker
         if not self.generator:
             logger.info("Generator was None, creating it now")
             self.generator = {
@@ -61,22 +244,104 @@ class DownloadWorker(base_worker):
                 "homepage": "https://github.com/beeldengeluid/dane-download-worker",
             }
 
-    def callback(self, task, doc):  # noqa: C901 #TODO
+    # prefetch as many tasks as can be downloaded at the same time, plus the
+    # ones to prepare in the meantime; DANE's base_worker already processes
+    # each received task in its own thread
+    def connect(self):
+        super().connect()
+        prefetch_count = self.concurrency + self.prefetch
+        logger.info(f"Setting queue prefetch to {prefetch_count}")
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    # counts the returned DANE responses per state and logs the time spent in
+    # each phase of the task, for monitoring
+    def callback(self, task, doc):
+        timings = Timings()
+        start = time.perf_counter()
+        with recording(timings):
+            response = self._process_download_task(task, doc)
+        RESPONSES.labels(response["state"]).inc()
+        timing.log(
+            timings,
+            time.perf_counter() - start,
+            task_id=task._id,
+            doc_id=doc._id,
+            state=response["state"],
+        )
+        return response
+
+    def _process_download_task(self, task, doc):
+        with span("prepare"):
+            prepared = self._prepare_download(task, doc)
+        if isinstance(prepared, DANEResponse):
+            return prepared.to_json()
+        target_url = prepared.target_url
+
+        try:
+            result = self._download_prepared(prepared)
+        except InsufficientDiskSpace as e:  # the expected size does not fit
+            logger.error(f"Insufficient disk space: {str(e)}")
+            raise errors.RefuseJobException("Insufficient disk space")
+
+        dane_result_saved = False
+        if result.already_downloaded:  # TODO or result.dane_result.state == 201
+            logger.info("File was already downloaded, trying to save prior DANE result")
+            dane_result_saved = self._save_prior_download_result(
+                doc, task, result.download_file_path
+            )
+
+        # in case of no error go ahead with writing the DANE Result
+        if result.dane_response.state == 200 and not dane_result_saved:
+            payload = {
+                "file_path": result.download_file_path,  # TODO extract file info from the file
+                **result.file_info,  # add any extracted file info
+            }
+            download_root = self.download_roots.root_of(result.download_file_path)
+            if download_root:  # for workers that do not use the file_path
+                payload["download_root"] = download_root
+            timings = timing.current()
+            if self.result_timings and timings is not None:
+                payload["timings"] = timings.to_json()  # the phases up to here
+            r = Result(self.generator, payload=payload, api=self.handler)
+            with span("save_result"):
+                r.save(task._id)
+            self._remember_result(doc._id, r.payload)
+            logger.debug(f"Succesfully downloaded: {target_url}")
+            return result.dane_response.to_json()
+
+        # it must be an error, return it to DANE
+        return result.dane_response.to_json()
+
+    # downloads the target_url into download_dir like a task would, but
+    # without DANE (no Result is saved); raises InsufficientDiskSpace if it
+    # does not fit
+    def download_to(
+        self, target_url: str, download_dir: str, http_engine: str | None = None
+    ) -> DownloadResult:
+        target_url = requote_uri(target_url)
+        with span("prepare"):
+            prepared = self._check_source(target_url) or self._prepare_source(
+                target_url, download_dir, http_engine or self.http_engine
+            )
+        if isinstance(prepared, DANEResponse):
+            return DownloadResult("", prepared, False, {})
+        return self._download_prepared(prepared)
+
+    # the first stage of a task, run as soon as it is received (also for the
+    # prefetched ones, while the current downloads hold the slots): checks the
+    # target and resolves where it goes, whether it is already there and, for
+    # prefetched tasks, its size
+    def _prepare_download(self, task, doc) -> PreparedDownload | DANEResponse:
         # encode the URI, make sure it's safe
         target_url = requote_uri(doc.target["url"])
-        is_s3 = self._is_s3_uri(target_url)
         logger.info(f"Download task for: {target_url}")
+        invalid = self._check_source(target_url)
+        if invalid:
+            return invalid
 
-        # check the white list in case it's not an S3 URI
-        if not is_s3:
-            if not self._check_whitelist(target_url, self.whitelist):
-                return DANEResponse(
-                    403, f"Source URL not in whitelist: {target_url}"
-                ).to_json()
-            if validators.url(target_url) is not True:
-                return DANEResponse(
-                    400, f"Invalid URL provided: {target_url}"
-                ).to_json()
+        http_engine = task.args.get("HTTP_ENGINE", self.http_engine)
+        if http_engine not in HTTP_ENGINES:
+            return DANEResponse(400, f"Invalid HTTP_ENGINE: {http_engine}")
 
         # define the download/temp dir by checking task arguments and default DANE config
         download_dir = self._determine_download_dir(doc, task)
@@ -84,52 +349,269 @@ class DownloadWorker(base_worker):
         # only continue if the dir is accessible by this dane-download-worker
         if download_dir is None:
             logger.error(f"Download dir does not exist: {download_dir}")
+            return DANEResponse(500, "Non existing TEMP_FOLDER, cannot handle request")
+        return self._prepare_source(target_url, download_dir, http_engine)
+
+    # check the white list in case it's not an S3 URI
+    def _check_source(self, target_url: str) -> DANEResponse | None:
+        if self._is_s3_uri(target_url):
+            return None
+        if not self._check_whitelist(target_url, self.whitelist):
+            return DANEResponse(403, f"Source URL not in whitelist: {target_url}")
+        import validators  # slow to import, only needed for HTTP sources
+
+        if validators.url(target_url) is not True:
+            return DANEResponse(400, f"Invalid URL provided: {target_url}")
+        return None
+
+    def _prepare_source(
+        self, target_url: str, download_dir: str, http_engine: str
+    ) -> PreparedDownload | DANEResponse:
+        is_s3 = self._is_s3_uri(target_url)
+        download_path = self._to_download_path(target_url, download_dir, is_s3)
+        cached = self._is_downloaded(target_url, download_path)
+        origin = to_origin(target_url)
+        retry_after = self.circuit_breakers.breaker_for(origin).retry_after()
+        if retry_after > 0 and not cached:  # no need to wait for a slot first
             return DANEResponse(
-                500, "Non existing TEMP_FOLDER, cannot handle request"
-            ).to_json()
+                503, f"Source unavailable: {CircuitOpen(origin, retry_after)}"
+            )
+        # one HEAD request per S3 task (its download needs it anyway), which
+        # also gives the size to reserve disk space for before the slot
+        s3_head = self._s3_head(target_url) if is_s3 else None
+        expected_size = -1
+        if s3_head and not cached:
+            expected_size = s3_head.content_length()
+        elif self.prefetch and not cached:
+            expected_size = http_head_content_length(self.http_session, target_url)
+        return PreparedDownload(
+            target_url,
+            is_s3,
+            download_dir,
+            download_path,
+            http_engine,
+            cached,
+            expected_size,
+            s3_head,
+        )
 
-        # check if the file fits the download threshhold
-        if not self._check_download_threshold(self.threshold, download_dir):
-            logger.error("Insufficient disk space")
-            raise errors.RefuseJobException("Insufficient disk space")
+    # tasks for the same file wait for each other (also in other workers),
+    # the later ones will then find the file already downloaded
+    def _download_prepared(self, prepared: PreparedDownload) -> DownloadResult:
+        with ExitStack() as stack:
+            with span("wait"):  # for the path lock, disk space and a slot
+                stack.enter_context(self._lock_download_path(prepared.download_path))
+                reservation = stack.enter_context(
+                    self.disk_ledger.reservation(prepared.download_dir)
+                )
+                # another task or worker may just have downloaded it
+                prepared.cached = prepared.cached or self._is_downloaded(
+                    prepared.target_url, prepared.download_path
+                )
+                if prepared.expected_size > -1 and not prepared.cached:
+                    reservation.reserve(prepared.expected_size)  # before the slot
+                stack.enter_context(self._transfer_slot(prepared))
+            with span("download"):
+                result = self._download(
+                    prepared.target_url,
+                    prepared.download_dir,
+                    prepared.is_s3,
+                    reservation,
+                    prepared.http_engine,
+                    prepared.s3_head,
+                )
+        return result
 
-        # call the correct downloader
-        if is_s3:
-            result = download_s3_uri(target_url, download_dir)
-        else:
-            result = download_http(target_url, download_dir)
+    # only tasks that transfer bytes need a download slot
+    def _transfer_slot(self, prepared: PreparedDownload):
+        return nullcontext() if prepared.cached else self._download_slots
 
-        dane_result_saved = False
-        if result.already_downloaded:  # TODO or result.dane_result.state == 201
-            logger.info("File was already downloaded, trying to save prior DANE result")
-            dane_result_saved = self._save_prior_download_result(doc, task)
+    # for both S3 and HTTP (an extension may have been added to the path)
+    def _is_downloaded(self, target_url: str, download_path: str) -> bool:
+        return find_downloaded_file(download_path, target_url) is not None
 
-        # in case of no error go ahead with writing the DANE Result
-        if result.dane_response.state == 200 and not dane_result_saved:
-            r = Result(
-                self.generator,
-                payload={
-                    "file_path": result.download_file_path,  # TODO extract file info from the file
-                    **result.file_info,  # add any extracted file info
-                },
-                api=self.handler,
+    def _s3_head(self, target_url: str) -> ObjectHead:
+        bucket, key, _ = deconstruct_s3_uri(target_url)
+        return ObjectHead(get_s3_client(self.s3_max_pool_connections), bucket, key)
+
+    # call the correct downloader (unless the content store has the source)
+    def _download(
+        self,
+        target_url: str,
+        download_dir: str,
+        is_s3: bool,
+        reservation: DiskReservation | None = None,
+        http_engine: str = HTTP_ENGINE_THREADS,
+        s3_head: ObjectHead | None = None,
+    ) -> DownloadResult:
+        source_type = "s3" if is_s3 else "http"
+        if is_s3 and s3_head is None:
+            s3_head = self._s3_head(target_url)
+        if self.content_store:
+            stored = self.content_store.link_into(
+                target_url,
+                download_dir,
+                # always revalidated: other docs stored it, possibly long ago
+                lambda m: self._is_unmodified(target_url, m, s3_head),
             )
-            r.save(task._id)
-            logger.debug(f"Succesfully downloaded: {target_url}")
-            return result.dane_response.to_json()
+            if stored:
+                CACHE_HITS.labels(source_type, "content_store").inc()
+                download_file_path, metadata = stored
+                return DownloadResult(
+                    download_file_path,
+                    DANEResponse(200, "Success (linked from content store)"),
+                    False,
+                    metadata.file_info,
+                )
 
-        # it must be an error, return it to DANE
-        return result.dane_response.to_json()
+        origin = to_origin(target_url)
+        try:
+            result = download_with_retries(
+                lambda: self._download_from_source(
+                    target_url, download_dir, reservation, http_engine, s3_head
+                ),
+                self.retry_policy,
+                self.circuit_breakers.breaker_for(origin),
+            )
+        except CircuitOpen as e:  # fail fast, instead of waiting for a timeout
+            logger.warning(f"Not downloading {target_url}: {str(e)}")
+            return DownloadResult(
+                "", DANEResponse(503, f"Source unavailable: {str(e)}"), False, {}, True
+            )
+
+        if (
+            self.content_store
+            and result.dane_response.state == 200
+            and not result.already_downloaded
+        ):
+            try:
+                self.content_store.add(result.download_file_path)
+            except OSError as e:  # the download itself succeeded
+                logger.warning(
+                    f"Could not add {result.download_file_path} to the content "
+                    f"store: {str(e)}"
+                )
+        return result
+
+    # one attempt to download the target_url (with the origin's limits)
+    def _download_from_source(
+        self,
+        target_url: str,
+        download_dir: str,
+        reservation: DiskReservation | None,
+        http_engine: str,
+        s3_head: ObjectHead | None,
+    ) -> DownloadResult:
+        source_type = "s3" if s3_head else "http"
+        origin = to_origin(target_url)
+        limiter = self.scheduler.limiter_for(origin)
+        with DownloadMeter(source_type, origin) as meter:
+            if s3_head:
+                result = download_s3_uri(
+                    target_url,
+                    download_dir,
+                    revalidate=self.cache_revalidate,
+                    transfer_config=self.s3_transfer_config,
+                    max_pool_connections=self.s3_max_pool_connections,
+                    checksums=self.checksums,
+                    limiter=limiter,
+                    progress_callback=meter.on_chunk,
+                    reservation=reservation,
+                    head=s3_head,
+                )
+            elif http_engine == HTTP_ENGINE_ASYNCIO:
+                result = self._get_async_http_engine().download(
+                    target_url,
+                    download_dir,
+                    revalidate=self.cache_revalidate,
+                    checksums=self.checksums,
+                    limiter=limiter,
+                    progress_callback=meter.on_chunk,
+                    reservation=reservation,
+                )
+            else:
+                result = download_http(
+                    target_url,
+                    download_dir,
+                    segments=self.http_segments,
+                    min_segment_size=self.http_min_segment_size,
+                    revalidate=self.cache_revalidate,
+                    session=self.http_session,
+                    checksums=self.checksums,
+                    limiter=limiter,
+                    progress_callback=meter.on_chunk,
+                    reservation=reservation,
+                    write_options=self.http_write_options,
+                )
+            if result.already_downloaded:
+                CACHE_HITS.labels(source_type, "download_dir").inc()
+            elif result.dane_response.state == 200:
+                meter.observe()
+        return result
+
+    def _get_async_http_engine(self) -> AsyncHttpEngine:
+        with self._async_http_engine_lock:
+            if self._async_http_engine is None:
+                self._async_http_engine = AsyncHttpEngine(
+                    self.async_http_connections,
+                    write_options=self.http_write_options,
+                    connect_timeout=self.http_timeouts[0],
+                    read_timeout=self.http_timeouts[1],
+                )
+            return self._async_http_engine
+
+    # multipart settings for S3 downloads (boto3 defaults for missing ones),
+    # built on first use, so a worker that only downloads over HTTP never
+    # loads boto3
+    @cached_property
+    def s3_transfer_config(self):
+        return to_transfer_config(self.s3_transfer_settings)
+
+    @cached_property
+    def s3_max_pool_connections(self) -> int:
+        return max_pool_connections_for(self.s3_transfer_config) * self.concurrency
+
+    def _is_unmodified(
+        self, target_url: str, metadata: DownloadMetadata, s3_head: ObjectHead | None
+    ) -> bool:
+        if s3_head:
+            return s3_head.is_unmodified(metadata)
+        return http_is_unmodified(self.http_session, target_url, metadata)
 
-    # try to copy the DANE Result for a possibly earlier download
-    def _save_prior_download_result(self, doc: Document, task: Task) -> bool:
+    # the file path (without extension for HTTP) a download will be written to
+    def _to_download_path(self, target_url: str, download_dir: str, is_s3: bool):
+        if is_s3:
+            return os.path.join(download_dir, deconstruct_s3_uri(target_url)[2])
+        return os.path.join(download_dir, url_to_safe_filename(target_url))
+
+    def _lock_download_path(self, download_path: str):
+        return self.single_flight.acquire(download_path)
+
+    # try to copy the DANE Result for a possibly earlier download (from the
+    # result cache or the sidecar of the download at download_file_path if this
+    # worker saved it, otherwise searched in ES)
+    def _save_prior_download_result(
+        self, doc: Document, task: Task, download_file_path: str = ""
+    ) -> bool:
         try:
-            results = self._get_prior_download_results(doc._id)
+            payload = self._get_cached_download_result(doc._id, download_file_path)
+            if payload is not None:
+                with span("save_result"):
+                    Result(self.generator, payload=payload, api=self.handler).save(
+                        task._id
+                    )
+                logger.info(f"Saved cached result for task: {task._id}")
+                return True
+
+            with span("search_result"):
+                results = self._get_prior_download_results(doc._id)
             if results and len(results) > 0:
                 # arbitrarly choose the first one to copy, perhaps should have some
                 # timestamp mechanism..
                 r = self._copy_result(results[0])
-                r.save(task._id)
+                with span("save_result"):
+                    r.save(task._id)
+                self._remember_result(doc._id, r.payload)
                 logger.info("Successfully saved result for task: {}".format(task._id))
                 return True
         except (errors.ResultExistsError, errors.TaskAssignedError):
@@ -142,6 +624,26 @@ class DownloadWorker(base_worker):
             )
         return False
 
+    # only usable while the downloaded file it points to still exists
+    def _get_cached_download_result(
+        self, doc_id: str, download_file_path: str = ""
+    ) -> dict | None:
+        payload = self.result_cache.get(doc_id)
+        if payload is None and download_file_path:
+            payload = recorded_result(download_file_path, doc_id)
+        if payload and os.path.exists(payload.get("file_path", "")):
+            return payload
+        return None
+
+    # in the result cache and in the sidecar of the download, which survives a
+    # restart of the worker
+    def _remember_result(self, doc_id: str, payload: dict):
+        self.result_cache.put(doc_id, payload)
+        try:
+            record_result(payload.get("file_path", ""), doc_id, payload)
+        except OSError as e:  # the Result itself was saved
+            logger.warning(f"Could not record the result of {doc_id}: {str(e)}")
+
     def _get_prior_download_results(
         self, doc_id: str
     ) -> list:  # list with Result objects
@@ -151,15 +653,13 @@ class DownloadWorker(base_worker):
         return Result(self.generator, payload=result.payload, api=self.handler)
 
     def _get_bytes_free(self, download_dir: str) -> int:
-        disk_stats = os.statvfs(download_dir)
-        return disk_stats.f_frsize * disk_stats.f_bfree
-
-    def _check_download_threshold(self, threshold: int, download_dir: str) -> bool:
-        if threshold is not None:
-            bytes_free = self._get_bytes_free(download_dir)
-            if bytes_free <= threshold:
-                return False
-        return True
+        bytes_free = volume_bytes_free(download_dir)
+        BYTES_FREE.set(bytes_free)
+        return bytes_free
+
+    # what the downloads in flight leave of the free space of a download root
+    def _get_bytes_available(self, root: str) -> int:
+        return volume_bytes_free(root) - self.disk_ledger.reserved(root)
 
     def _check_whitelist(self, target_url: str, whitelist: list) -> bool:
         parse = urlparse(target_url)
@@ -170,12 +670,19 @@ class DownloadWorker(base_worker):
             return False
         return True
 
-    # returns this "chunked" dir based on the doc id
-    # (see dane.base_classes.getDirs())
-    def _generate_dane_dirs_for_doc(self, doc: Document) -> dict:
-        return self.getDirs(doc, create_output_dir=False).get("TEMP_FOLDER", None)
+    # returns this "chunked" dir based on the doc id (see
+    # dane.base_classes.getDirs()), under the download root it is placed on
+    def _generate_dane_dirs_for_doc(self, doc: Document) -> str | None:
+        dane_dir = self.getDirs(
+            doc, create_input_dir=False, create_output_dir=False
+        ).get("TEMP_FOLDER", None)
+        if dane_dir is None:
+            return None
+        return self.download_roots.place(
+            doc._id, os.path.relpath(dane_dir, self.config.PATHS.TEMP_FOLDER)
+        )
 
-    def _determine_download_dir(self, doc: Document, task: Task) -> str:
+    def _determine_download_dir(self, doc: Document, task: Task) -> str | None:
         download_dir = task.args.get("PATHS", {}).get("TEMP_FOLDER", None)
 
         # use the provided Task.args.PATHS.TEMP_FOLDER if it exists,